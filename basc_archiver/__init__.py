@@ -5,7 +5,11 @@ from __future__ import absolute_import
 from __future__ import print_function
 import threading
 
-from .sites import default_archivers
+from . import board_index, postprocess, utils
+from .events import EventBus, DEFAULT_QUEUE_SIZE
+from .metrics import MetricsServer, StatsFileWriter, DEFAULT_STATS_INTERVAL
+from .sites import default_plugins
+from .sites.base import DEFAULT_POOL_CONCURRENCY, DEFAULT_POOL_PER_HOST
 
 version = '1.0.0'
 _default_base_dir = './archive'
@@ -16,17 +20,38 @@ class Options:
 
     def __init__(self, base_dir, use_ssl=False,
                  silent=False, verbose=False,
-                 delay=2, thread_check_delay=90,
+                 delay=0, thread_check_delay=90,
                  dl_threads_per_site=5, dl_thread_wait=1,
                  skip_thumbs=False, thumbs_only=False,
                  skip_js=False, skip_css=False,
                  follow_child_threads=False, follow_to_other_boards=False,
-                 run_once=False,):
+                 run_once=False,
+                 connect_timeout=utils.DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=utils.DEFAULT_READ_TIMEOUT,
+                 dns_cache_ttl=utils.DEFAULT_DNS_TTL,
+                 engine='thread',
+                 pool_concurrency=DEFAULT_POOL_CONCURRENCY,
+                 pool_per_host=DEFAULT_POOL_PER_HOST,
+                 pretty_json=True,
+                 media_store=None,
+                 use_manifest=False,
+                 burst=1,
+                 event_queue_size=DEFAULT_QUEUE_SIZE,
+                 metrics_port=None,
+                 stats_file=None,
+                 stats_interval=DEFAULT_STATS_INTERVAL,
+                 postprocess_workers=postprocess.DEFAULT_WORKERS,
+                 postprocess_queue_size=postprocess.DEFAULT_QUEUE_SIZE,
+                 chan_zip=False,
+                 chan_zip_remove=False,
+                 thumb_store='files',
+                 board_index=True,
+                 html_parser='html.parser',):
         self.base_dir = base_dir
         self.use_ssl = use_ssl
         self.silent = silent
         self.verbose = verbose
-        self.delay = float(delay)  # wait 2 seconds by default
+        self.delay = float(delay)  # between downloads from the same host
         self.thread_check_delay = float(thread_check_delay)  # between checks of the same thread
         self.dl_threads_per_site = int(dl_threads_per_site)
         self.dl_thread_wait = float(dl_thread_wait)
@@ -37,6 +62,27 @@ class Options:
         self.follow_child_threads = follow_child_threads
         self.follow_to_other_boards = follow_to_other_boards
         self.run_once = run_once
+        self.connect_timeout = float(connect_timeout)
+        self.read_timeout = float(read_timeout)
+        self.dns_cache_ttl = float(dns_cache_ttl)
+        self.engine = engine  # 'thread' or 'pool'
+        self.pool_concurrency = int(pool_concurrency)
+        self.pool_per_host = int(pool_per_host)
+        self.pretty_json = pretty_json
+        self.media_store = media_store  # path to shared, deduplicated media
+        self.use_manifest = use_manifest
+        self.burst = float(burst)  # downloads allowed at once before delay kicks in
+        self.event_queue_size = int(event_queue_size)  # undelivered status events before we drop progress ones
+        self.metrics_port = int(metrics_port) if metrics_port else None  # serve Prometheus metrics here
+        self.stats_file = stats_file  # or write them to this file
+        self.stats_interval = float(stats_interval)
+        self.postprocess_workers = int(postprocess_workers)  # processes for parsing and rewriting, 0 to do it inline
+        self.postprocess_queue_size = int(postprocess_queue_size)  # jobs waiting on them before downloads block
+        self.chan_zip = chan_zip  # pack threads into a .chan.zip once they 404 or get archived
+        self.chan_zip_remove = chan_zip_remove  # and delete the thread folder afterwards
+        self.thumb_store = thumb_store  # 'files', or 'pack' to keep thumbnails together in pack files
+        self.board_index = board_index  # write metadata.json for each thread, and keep each board's index
+        self.html_parser = html_parser  # BeautifulSoup parser for FoolFuuka pages, 'lxml' is faster if installed
 
 
 class Archiver:
@@ -51,31 +97,96 @@ class Archiver:
             'all': []
         }  # info callbacks
 
-        # add our default site-specific archivers
+        # callbacks run on their own thread, so slow handlers can't hold up downloads
+        self.events = EventBus(self._dispatch_status, max_size=self.options.event_queue_size)
+
+        # keep-alive connections, enough for every download thread of a site
+        if self.options.engine == 'pool':
+            pool_size = self.options.pool_per_host
+        else:
+            pool_size = self.options.dl_threads_per_site
+        utils.sessions.configure(pool_size=pool_size,
+                                 connect_timeout=self.options.connect_timeout,
+                                 read_timeout=self.options.read_timeout,
+                                 dns_ttl=self.options.dns_cache_ttl,
+                                 rate=1 / self.options.delay if self.options.delay > 0 else 0,
+                                 burst=self.options.burst)
+
+        # parsing and rewriting happens in other processes, so it doesn't hold up downloads
+        postprocess.jobs.configure(workers=self.options.postprocess_workers,
+                                   max_size=self.options.postprocess_queue_size)
+
+        # site-specific archivers, each one is only loaded and started once a URL needs it
+        self.plugins = list(default_plugins)
+        self.archivers_lock = threading.Lock()
         self.archivers = []
-        for archiver in default_archivers:
-            self.archivers.append(archiver(self.update_status, self.options))
+        self._site_archivers = {}  # plugin name -> running archiver
+
+        # metrics exporters
+        self.exporters = []
+        if self.options.metrics_port:
+            self.exporters.append(MetricsServer(self, self.options.metrics_port))
+        if self.options.stats_file:
+            self.exporters.append(StatsFileWriter(self, self.options.stats_file, self.options.stats_interval))
 
     def shutdown(self):
         """Shutdown the archiver."""
-        for archiver in self.archivers:
+        with self.archivers_lock:
+            archivers = list(self.archivers)
+        for archiver in archivers:
             archiver.shutdown()
+        postprocess.jobs.shutdown()
+        # the board indexes are only appended to as we go, tidy them up
+        board_index.compact_all()
+        self.events.shutdown()
+        for exporter in self.exporters:
+            exporter.shutdown()
 
     # threads
+    def site_archiver(self, url):
+        """Return the site archiver for the given URL, starting it if need be, or None if no site handles it."""
+        for plugin in self.plugins:
+            if plugin.url_valid(url):
+                break
+        else:
+            return None
+
+        with self.archivers_lock:
+            if plugin.name not in self._site_archivers:
+                archiver = plugin.load()(self.update_status, self.options)
+                self._site_archivers[plugin.name] = archiver
+                self.archivers.append(archiver)
+            return self._site_archivers[plugin.name]
+
     def add_thread(self, url):
         """Archive the given thread if possible"""
-        url_archived = False
-        for archiver in self.archivers:
-            if archiver.url_valid(url):
-                archiver.add_thread(url)
-                url_archived = True
-
-        if url_archived:
-            return True
-        else:
+        archiver = self.site_archiver(url)
+        if archiver is None:
             print('We could not find a valid archiver for:', url)
             return False
 
+        archiver.add_thread(url)
+        return True
+
+    def add_threads(self, urls, check_exists=False, checkpoint=None):
+        """Archive many threads at once, returns how many were added.
+
+        Threads are queued without being checked one by one, see
+        FourChanSiteArchiver.add_threads for check_exists and checkpoint.
+        """
+        site_urls = {}
+        for url in urls:
+            archiver = self.site_archiver(url)
+            if archiver is None:
+                print('We could not find a valid archiver for:', url)
+            else:
+                site_urls.setdefault(archiver, []).append(url)
+
+        added = 0
+        for archiver, archiver_urls in site_urls.items():
+            added += archiver.add_threads(archiver_urls, check_exists=check_exists, checkpoint=checkpoint)
+        return added
+
     @property
     def existing_threads(self):
         """Return how many threads exist."""
@@ -92,6 +203,21 @@ class Archiver:
                 return True
         return False
 
+    @property
+    def connection_stats(self):
+        """Return HTTP request/connection reuse counts for each host."""
+        return utils.sessions.stats()
+
+    @property
+    def event_stats(self):
+        """Return status event delivery, coalescing and drop counts."""
+        return self.events.stats()
+
+    @property
+    def postprocess_stats(self):
+        """Return post-processing job counts."""
+        return postprocess.jobs.stats()
+
     # callbacks
     def register_callback(self, cb_type, handler):
         """Register a callback."""
@@ -109,16 +235,17 @@ class Archiver:
                 self.callbacks[cb_type].remove(handler)
 
     def update_status(self, cb_type, info):
-        """Update thread status, call callbacks where appropriate."""
+        """Update thread status, queueing an event for the callbacks."""
+        self.events.publish(cb_type, info)
+
+    def _dispatch_status(self, cb_type, info):
+        """INTERNAL: Call callbacks for the given event, runs on the event thread."""
         with self.callbacks_lock:
+            handlers = list(self.callbacks.get(cb_type, []))
             # to stop us calling same handler twice
-            called = []
-
-            if cb_type in self.callbacks:
-                for handler in self.callbacks[cb_type]:
-                    handler(cb_type, info)
-                    called.append(handler)
-
             for handler in self.callbacks['all']:
-                if handler not in called:
-                    handler(cb_type, info)
+                if handler not in handlers:
+                    handlers.append(handler)
+
+        for handler in handlers:
+            handler(cb_type, info)
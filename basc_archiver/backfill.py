@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# BASC Imageboard Archiver Backfill Checkpoints
+from __future__ import absolute_import
+from __future__ import print_function
+import codecs
+import os
+import threading
+
+from . import utils
+
+
+class BackfillCheckpoint(object):
+    """Remembers which threads of a backfill have been completely archived.
+
+    Finished threads are appended to a text file one per line, as
+    board/thread_id, so an interrupted backfill can skip them next time.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._done = set()
+
+        if os.path.exists(filename):
+            with codecs.open(filename, 'r', encoding='utf-8') as checkpoint_file:
+                self._done.update(line.strip() for line in checkpoint_file if line.strip())
+        else:
+            utils.mkdirs(os.path.dirname(os.path.abspath(filename)))
+
+    def __len__(self):
+        return len(self._done)
+
+    def has(self, board_name, thread_id):
+        """Return whether the given thread has already been archived."""
+        return '{}/{}'.format(board_name, thread_id) in self._done
+
+    def add(self, board_name, thread_id):
+        """Record the given thread as completely archived."""
+        key = '{}/{}'.format(board_name, thread_id)
+        with self._lock:
+            if key in self._done:
+                return
+            self._done.add(key)
+            with codecs.open(self.filename, 'a', encoding='utf-8') as checkpoint_file:
+                checkpoint_file.write(key + '\n')
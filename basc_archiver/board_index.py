@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# BASC Imageboard Archiver Board Index
+from __future__ import absolute_import
+from __future__ import print_function
+import html
+import json
+import os
+import threading
+import time
+
+from .storage import files, lock_file, mkdirs
+
+METADATA_FILENAME = 'metadata.json'
+INDEX_LOG_FILENAME = 'list-{shard}.jsonl'
+INDEX_JSON_FILENAME = 'list-{shard}.json'
+INDEX_HTML_FILENAME = 'index.html'
+INDEX_SHARD_HTML_FILENAME = 'index-{shard}.html'
+INDEX_LOCK_FILENAME = 'list.lock'
+
+INDEX_SHARD_SIZE = 1000000  # thread ids per shard
+COMPACT_MIN_SIZE = 1024 * 1024  # bytes of log before compacting a shard is worth it
+COMPACT_RATIO = 2  # and it has to be this many times the size of its last compacted list
+
+INDEX_HTML_HEADER = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{site} / {board}{title}</title>
+<style>
+body {{ font-family: sans-serif; }}
+td, th {{ padding: 2px 8px; text-align: left; }}
+</style>
+</head>
+<body>
+<h1>{site} / {board}{title}</h1>
+"""
+INDEX_HTML_SHARD_LINK = '<p><a href="{filename}">Threads {first} to {last}</a></p>\n'
+INDEX_HTML_SHARD_TITLE = ' / {first} to {last}'
+INDEX_HTML_TABLE = ('<table>\n'
+                    '<tr><th>Thread</th><th>Subject</th><th>Replies</th><th>Files</th><th>State</th><th>Created</th></tr>\n')
+INDEX_HTML_ROW = ('<tr><td><a href="{thread_id}/{thread_id}.html">{thread_id}</a>{zip_link}</td>'
+                  '<td>{subject}</td><td>{replies}</td><td>{files}</td><td>{state}</td><td>{created}</td></tr>\n')
+INDEX_HTML_ZIP_LINK = ' (<a href="{thread_id}.chan.zip">zip</a>)'
+
+
+class BoardIndex(object):
+    """Lists the threads archived from a board, kept current as they change.
+
+    The index is split into shards of INDEX_SHARD_SIZE thread ids, so no
+    one file grows with the whole board. Each time a thread changes state,
+    its entry is appended to its shard's list-<shard>.jsonl as a line of
+    JSON, so updating the index costs the same however many threads the
+    board has. A thread's newest line is its current entry. Completed
+    threads also get a row appended to their shard's index-<shard>.html,
+    which is never closed off so more rows can go on the end, browsers
+    don't mind. The board's index.html links to each shard's page.
+
+    compact() folds the logs that have grown enough since they were last
+    compacted down to one line per thread, and writes each out as
+    list-<shard>.json, with its index-<shard>.html rewritten to match.
+    Appending and compacting both hold a lock file, so archivers in other
+    processes don't lose lines to a compaction.
+    """
+
+    def __init__(self, board_dir):
+        self.board_dir = board_dir
+        self.html_filename = os.path.join(board_dir, INDEX_HTML_FILENAME)
+        self.lock_filename = os.path.join(board_dir, INDEX_LOCK_FILENAME)
+        self._lock = threading.Lock()
+        self._updated_shards = set()
+
+    @property
+    def updated(self):
+        """Whether any shard has been updated since it was last compacted."""
+        return bool(self._updated_shards)
+
+    def shard(self, thread_id):
+        """Return the shard the given thread's entry goes in."""
+        return int(thread_id) // INDEX_SHARD_SIZE
+
+    def log_filename(self, shard):
+        """Return the filename of the given shard's log."""
+        return os.path.join(self.board_dir, INDEX_LOG_FILENAME.format(shard=shard))
+
+    def json_filename(self, shard):
+        """Return the filename of the given shard's compacted list."""
+        return os.path.join(self.board_dir, INDEX_JSON_FILENAME.format(shard=shard))
+
+    def shard_html_filename(self, shard):
+        """Return the filename of the given shard's page."""
+        return os.path.join(self.board_dir, INDEX_SHARD_HTML_FILENAME.format(shard=shard))
+
+    def update(self, entry):
+        """Record a thread's current entry, adding it to its shard's page if it's complete."""
+        shard = self.shard(entry['thread_id'])
+        line = json.dumps(entry, sort_keys=True, separators=(',', ':')) + '\n'
+        with self._lock, self._board_lock():
+            files.append(self.log_filename(shard), line.encode('utf-8'))
+            if entry.get('complete'):
+                shard_html_filename = self.shard_html_filename(shard)
+                if not files.exists(shard_html_filename):
+                    files.append(shard_html_filename, (self._html_header(entry, shard) +
+                                                       INDEX_HTML_TABLE).encode('utf-8'))
+                    self._link_shard(entry, shard)
+                files.append(shard_html_filename, self._html_row(entry).encode('utf-8'))
+            self._updated_shards.add(shard)
+
+    def entries(self, shard):
+        """Return the current entry of every thread in the given shard, by thread id."""
+        entries = {}
+        log_filename = self.log_filename(shard)
+        if not files.exists(log_filename):
+            return entries
+        for line in files.read(log_filename).decode('utf-8').splitlines():
+            try:
+                entry = json.loads(line)
+            except ValueError:  # cut off by a crash
+                continue
+            entries[entry['thread_id']] = entry
+        return entries
+
+    def compact(self, force=False):
+        """Compact the updated shards whose logs have grown enough since they were last compacted.
+
+        With force, every updated shard is compacted.
+        """
+        with self._lock, self._board_lock():
+            for shard in sorted(self._updated_shards):
+                if force or self._needs_compacting(shard):
+                    self._compact_shard(shard)
+            self._updated_shards.clear()
+
+    def _board_lock(self):
+        """INTERNAL: Lock the board's index against other processes, until the returned file is closed."""
+        mkdirs(self.board_dir)
+        return lock_file(self.lock_filename)
+
+    def _needs_compacting(self, shard):
+        """INTERNAL: Return whether the given shard's log is worth compacting."""
+        log_size = files.size(self.log_filename(shard)) if files.exists(self.log_filename(shard)) else 0
+        json_size = files.size(self.json_filename(shard)) if files.exists(self.json_filename(shard)) else 0
+        return log_size > max(COMPACT_MIN_SIZE, COMPACT_RATIO * json_size)
+
+    def _compact_shard(self, shard):
+        """INTERNAL: Fold a shard's log down to one line per thread, and write its list and page from it."""
+        entries = [entry for thread_id, entry in sorted(self.entries(shard).items())]
+        if not entries:
+            return
+
+        log = ''.join(json.dumps(entry, sort_keys=True, separators=(',', ':')) + '\n' for entry in entries)
+        files.write(self.log_filename(shard), log.encode('utf-8'))
+        files.write(self.json_filename(shard), json.dumps({'threads': entries}, sort_keys=True).encode('utf-8'))
+
+        page = self._html_header(entries[0], shard) + INDEX_HTML_TABLE
+        page += ''.join(self._html_row(entry) for entry in entries if entry.get('complete'))
+        files.write(self.shard_html_filename(shard), page.encode('utf-8'))
+
+    def _link_shard(self, entry, shard):
+        """INTERNAL: Add a link to a new shard's page to the board's index.html."""
+        if not files.exists(self.html_filename):
+            files.append(self.html_filename, self._html_header(entry).encode('utf-8'))
+        files.append(self.html_filename, INDEX_HTML_SHARD_LINK.format(
+            filename=INDEX_SHARD_HTML_FILENAME.format(shard=shard),
+            first=shard * INDEX_SHARD_SIZE, last=(shard + 1) * INDEX_SHARD_SIZE - 1).encode('utf-8'))
+
+    def _html_header(self, entry, shard=None):
+        """INTERNAL: Return the top of index.html, or of a shard's page."""
+        title = ''
+        if shard is not None:
+            title = INDEX_HTML_SHARD_TITLE.format(first=shard * INDEX_SHARD_SIZE,
+                                                  last=(shard + 1) * INDEX_SHARD_SIZE - 1)
+        return INDEX_HTML_HEADER.format(site=html.escape(entry['site']), board=html.escape(entry['board']),
+                                        title=title)
+
+    def _html_row(self, entry):
+        """INTERNAL: Return the given thread's row in index.html."""
+        created = entry.get('created')
+        return INDEX_HTML_ROW.format(**{
+            'thread_id': entry['thread_id'],
+            'zip_link': INDEX_HTML_ZIP_LINK.format(thread_id=entry['thread_id']) if entry.get('chan_zip') else '',
+            'subject': html.escape(entry.get('subject') or ''),
+            'replies': entry.get('replies', ''),
+            'files': entry.get('files', ''),
+            'state': entry['state'],
+            'created': time.strftime('%Y-%m-%d %H:%M', time.gmtime(created)) if created else '',
+        })
+
+
+_indexes_lock = threading.Lock()
+_indexes = {}
+
+
+def open_index(board_dir):
+    """Return the index for the given board folder, shared by all sites."""
+    board_dir = os.path.abspath(board_dir)
+    with _indexes_lock:
+        if board_dir not in _indexes:
+            _indexes[board_dir] = BoardIndex(board_dir)
+        return _indexes[board_dir]
+
+
+def compact_all(force=False):
+    """Compact the board indexes that have been updated, where their logs have grown enough, see compact."""
+    with _indexes_lock:
+        indexes = list(_indexes.values())
+    for index in indexes:
+        if index.updated:
+            index.compact(force=force)
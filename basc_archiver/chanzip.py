@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# BASC Imageboard Archiver .chan.zip Packager
+from __future__ import absolute_import
+from __future__ import print_function
+import concurrent.futures
+import os
+import shutil
+import time
+import zipfile
+
+from . import utils
+from .storage import read_pack
+
+CHAN_ZIP_EXTENSION = '.chan.zip'
+
+# text compresses well, media is already compressed so it's stored as-is
+DEFLATE_EXTENSIONS = ('.html', '.htm', '.json', '.txt', '.css', '.js')
+DEFLATE_LEVEL = 6
+
+
+def chan_zip_filename(thread_dir):
+    """Return where the .chan.zip for the given thread folder goes."""
+    return os.path.normpath(thread_dir) + CHAN_ZIP_EXTENSION
+
+
+def pack_thread(thread_dir, site, board, thread_id, remove=False, packed_files=()):
+    """Pack a thread folder into a .chan.zip next to it.
+
+    Files are laid out as <site>/<board>/<thread id>/... inside the zip, as
+    the .chan.zip standard asks. Each file is streamed from disk straight
+    into the zip, media stored and text deflated. packed_files are files of
+    the thread kept in a pack store instead, as (path, segment filename,
+    offset, size), and are read straight out of the segment. If remove is
+    set, the folder is deleted once the zip is complete.
+
+    Returns the zip's filename, or None if there's nothing to pack.
+    """
+    thread_dir = os.path.normpath(thread_dir)
+    if not os.path.isdir(thread_dir) and not packed_files:
+        return None
+
+    zip_filename = chan_zip_filename(thread_dir)
+    arc_root = '/'.join((site, board, str(thread_id)))
+
+    def arc_name(filename):
+        return arc_root + '/' + os.path.relpath(filename, thread_dir).replace(os.sep, '/')
+
+    filenames = []
+    for dir_path, dir_names, dir_filenames in os.walk(thread_dir):
+        dir_names.sort()
+        for filename in sorted(dir_filenames):
+            # half-written files, from an interrupted download
+            if filename.endswith(('.part', '-temporary')):
+                continue
+            filenames.append(os.path.join(dir_path, filename))
+
+    utils.mkdirs(os.path.dirname(zip_filename))
+    temp_zip_filename = '{}-temporary'.format(zip_filename)
+    with zipfile.ZipFile(temp_zip_filename, 'w', allowZip64=True) as chan_zip:
+        for filename in filenames:
+            if filename.lower().endswith(DEFLATE_EXTENSIONS):
+                chan_zip.write(filename, arc_name(filename), zipfile.ZIP_DEFLATED, DEFLATE_LEVEL)
+            else:
+                chan_zip.write(filename, arc_name(filename), zipfile.ZIP_STORED)
+
+        for filename, segment_filename, offset, size in packed_files:
+            info = zipfile.ZipInfo(arc_name(filename), time.localtime(os.path.getmtime(segment_filename))[:6])
+            info.compress_type = zipfile.ZIP_STORED
+            with open(segment_filename, 'rb') as segment_file:
+                segment_file.seek(offset)
+                chan_zip.writestr(info, segment_file.read(size))
+    os.replace(temp_zip_filename, zip_filename)
+
+    if remove and os.path.isdir(thread_dir):
+        shutil.rmtree(thread_dir)
+    return zip_filename
+
+
+def find_threads(base_dir):
+    """Yield (thread folder, site, board, thread id) for the threads under base_dir."""
+    for site in sorted(os.listdir(base_dir)):
+        site_dir = os.path.join(base_dir, site)
+        if not os.path.isdir(site_dir):
+            continue
+        for board in sorted(os.listdir(site_dir)):
+            board_dir = os.path.join(site_dir, board)
+            if not os.path.isdir(board_dir):
+                continue
+            for thread_id in sorted(os.listdir(board_dir)):
+                thread_dir = os.path.join(board_dir, thread_id)
+                if thread_id.isdigit() and os.path.isdir(thread_dir):
+                    yield thread_dir, site, board, int(thread_id)
+
+
+def _pack(args):
+    """INTERNAL: Unpack arguments for pack_thread, for executor.map."""
+    return pack_thread(*args)
+
+
+def pack_tree(base_dir, workers=None, remove=False, repack=False):
+    """Pack every thread folder under base_dir, in parallel. Returns the zips made.
+
+    Threads that already have a .chan.zip are skipped unless repack is set.
+    Thumbnails kept in the archive's thumbnail pack are included.
+    """
+    thumb_pack = read_pack(base_dir)
+
+    jobs = []
+    for thread_dir, site, board, thread_id in find_threads(base_dir):
+        if repack or not os.path.exists(chan_zip_filename(thread_dir)):
+            packed_files = thumb_pack.locations(os.path.join(thread_dir, 'thumbs'))
+            jobs.append((thread_dir, site, board, thread_id, remove, packed_files))
+
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        return [zip_filename for zip_filename in executor.map(_pack, jobs) if zip_filename]
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# BASC Imageboard Archiver Status Events
+from __future__ import absolute_import
+from __future__ import print_function
+import collections
+import itertools
+import threading
+import traceback
+import types
+
+DEFAULT_QUEUE_SIZE = 1000
+
+# events where only the latest one for each thread matters, so a newer one
+# replaces any that haven't been delivered yet
+COALESCE_TYPES = ('thread_start_download', 'thread_dl', 'image_dl', 'thumb_dl', 'retry', 'host_paused')
+
+# events that are never dropped, a full queue makes room for them instead
+LIFECYCLE_TYPES = ('404', 'archived', 'new_thread', 'dl_failed')
+
+# info values that get copied into events, everything else is left out
+EVENT_VALUE_TYPES = (str, int, float, bool, type(None))
+
+
+def snapshot(info):
+    """Return a read-only copy of the given status info, with only plain values."""
+    # copying in one go is atomic, other threads may still be updating info
+    info = dict(info)
+    return types.MappingProxyType({key: value for key, value in info.items()
+                                   if isinstance(value, EVENT_VALUE_TYPES)})
+
+
+class EventBus(object):
+    """Delivers status events to handlers on a dedicated thread.
+
+    Publishing never blocks: events go into a bounded queue, and a newer
+    event for the same thread replaces an undelivered one of the same type.
+    When the queue is full the oldest of those progress events is dropped
+    to make room. If there are none, new events are dropped instead, apart
+    from lifecycle events, which are always queued. Dropped events are
+    counted.
+    """
+
+    def __init__(self, dispatch, max_size=DEFAULT_QUEUE_SIZE):
+        self.dispatch = dispatch
+        self.max_size = max(int(max_size), 1)
+
+        self._cond = threading.Condition()
+        self._pending = collections.OrderedDict()  # coalesce key -> (cb_type, info)
+        self._coalescable = collections.OrderedDict()  # keys of the progress events in _pending, oldest first
+        self._seq = itertools.count()
+        self._in_flight = False
+        self.is_shutdown = False
+
+        self.published = 0
+        self.delivered = 0
+        self.coalesced = 0
+        self.dropped = collections.Counter()  # by cb_type
+        self.max_depth = 0
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def publish(self, cb_type, info):
+        """Queue an event for the handlers, without waiting for them."""
+        event = (cb_type, snapshot(info))
+        coalescable = cb_type in COALESCE_TYPES
+        if coalescable:
+            key = (cb_type, info.get('site'), info.get('board'), info.get('thread_id'))
+        else:
+            key = next(self._seq)
+
+        with self._cond:
+            self.published += 1
+            if key in self._pending:
+                self._pending[key] = event
+                self.coalesced += 1
+                return
+            if len(self._pending) >= self.max_size:
+                if self._coalescable:
+                    old_key = self._coalescable.popitem(last=False)[0]
+                    self.dropped[self._pending.pop(old_key)[0]] += 1
+                elif cb_type not in LIFECYCLE_TYPES:
+                    self.dropped[cb_type] += 1
+                    return
+
+            self._pending[key] = event
+            if coalescable:
+                self._coalescable[key] = True
+            self.max_depth = max(self.max_depth, len(self._pending))
+            self._cond.notify()
+
+    def _run(self):
+        """INTERNAL: Deliver events until we're shut down and the queue is empty."""
+        while True:
+            with self._cond:
+                while not self._pending and not self.is_shutdown:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                key, (cb_type, info) = self._pending.popitem(last=False)
+                self._coalescable.pop(key, None)
+                self._in_flight = True
+
+            try:
+                self.dispatch(cb_type, info)
+            except Exception:
+                # a broken handler shouldn't stop the others getting events
+                traceback.print_exc()
+
+            with self._cond:
+                self.delivered += 1
+                self._in_flight = False
+                if not self._pending:
+                    self._cond.notify_all()
+
+    def flush(self, timeout=None):
+        """Wait until every queued event has been delivered."""
+        with self._cond:
+            return self._cond.wait_for(lambda: not (self._pending or self._in_flight), timeout)
+
+    def shutdown(self, timeout=5):
+        """Deliver what's left in the queue, then stop the dispatcher."""
+        with self._cond:
+            self.is_shutdown = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+
+    def stats(self):
+        """Return event counts and queue depth."""
+        with self._cond:
+            return {
+                'published': self.published,
+                'delivered': self.delivered,
+                'coalesced': self.coalesced,
+                'dropped': sum(self.dropped.values()),
+                'dropped_by_type': dict(self.dropped),
+                'queue_depth': len(self._pending),
+                'max_queue_depth': self.max_depth,
+            }
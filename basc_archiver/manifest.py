@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# BASC Imageboard Archiver Download Manifest
+from __future__ import absolute_import
+from __future__ import print_function
+import concurrent.futures
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+from .storage import read_pack
+
+MANIFEST_FILENAME = 'manifest.sqlite3'
+MEDIA_DIR_NAMES = ('images', 'thumbs')
+
+_manifests_lock = threading.Lock()
+_manifests = {}
+
+
+def open_manifest(base_dir):
+    """Return the manifest for the archive in base_dir, shared by all sites."""
+    base_dir = os.path.abspath(base_dir)
+    with _manifests_lock:
+        if base_dir not in _manifests:
+            _manifests[base_dir] = Manifest(base_dir)
+        return _manifests[base_dir]
+
+
+class Manifest(object):
+    """Records every completed media download in an archive.
+
+    The list of completed files is kept in memory, so deciding whether to
+    download a file doesn't need to touch the filesystem.
+    """
+
+    def __init__(self, base_dir):
+        self.base_dir = os.path.abspath(base_dir)
+        self.filename = os.path.join(self.base_dir, MANIFEST_FILENAME)
+        if not os.path.exists(self.base_dir):
+            os.makedirs(self.base_dir)
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.filename, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS files ('
+                         'path TEXT PRIMARY KEY, size INTEGER, md5 TEXT, '
+                         'url TEXT, completed REAL)')
+        self._db.commit()
+
+        self._paths = set(row[0] for row in self._db.execute('SELECT path FROM files'))
+
+    def __len__(self):
+        return len(self._paths)
+
+    def _key(self, local_filename):
+        """INTERNAL: Return the path we store for the given file."""
+        return os.path.relpath(os.path.abspath(local_filename), self.base_dir)
+
+    def has(self, local_filename):
+        """Return whether the given file has been completely downloaded."""
+        return self._key(local_filename) in self._paths
+
+    def add(self, local_filename, url=None, md5=None, size=None):
+        """Record the given file as completely downloaded."""
+        if size is None:
+            size = os.path.getsize(local_filename)
+        self.add_many([(self._key(local_filename), size, md5, url)])
+
+    def add_many(self, entries):
+        """Record many (path, size, md5, url) entries at once."""
+        completed = time.time()
+        with self._lock:
+            self._db.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)',
+                                 [entry + (completed,) for entry in entries])
+            self._db.commit()
+            self._paths.update(entry[0] for entry in entries)
+
+    def remove_many(self, paths):
+        """Forget the given paths, so they get downloaded again."""
+        with self._lock:
+            self._db.executemany('DELETE FROM files WHERE path = ?',
+                                 [(path,) for path in paths])
+            self._db.commit()
+            self._paths.difference_update(paths)
+
+    def entries(self):
+        """Return all (path, size, md5, url) entries."""
+        with self._lock:
+            return list(self._db.execute('SELECT path, size, md5, url FROM files'))
+
+    # scanning existing archives
+    def media_files(self):
+        """Yield (path, location) for all media files in the archive, see stored_file_info.
+
+        Thumbnails kept in the archive's thumbnail pack are included.
+        """
+        for dir_path, dir_names, filenames in os.walk(self.base_dir):
+            if os.path.basename(dir_path) not in MEDIA_DIR_NAMES:
+                continue
+            for filename in filenames:
+                if filename.endswith('.part') or filename.endswith('-temporary'):
+                    continue
+                full_path = os.path.join(dir_path, filename)
+                yield os.path.relpath(full_path, self.base_dir), full_path
+
+        for full_path, segment_filename, offset, size in read_pack(self.base_dir).all_locations():
+            # a copy on disk is the one that gets used
+            if not os.path.exists(full_path):
+                yield os.path.relpath(full_path, self.base_dir), (segment_filename, offset, size)
+
+    def _location(self, path, thumb_pack):
+        """INTERNAL: Return where the given recorded file is stored, see stored_file_info."""
+        full_path = os.path.join(self.base_dir, path)
+        if os.path.exists(full_path):
+            return full_path
+        return thumb_pack.location(full_path) or full_path
+
+    def rebuild(self, workers=None):
+        """Scan the archive, recording every media file found. Returns the count."""
+        media_files = list(self.media_files())
+        paths = [path for path, location in media_files]
+        locations = [location for path, location in media_files]
+        with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+            infos = list(executor.map(stored_file_info, locations, chunksize=64))
+
+        self.add_many([(path, size, md5, None) for path, (size, md5) in zip(paths, infos)])
+        return len(paths)
+
+    def verify(self, workers=None):
+        """Check recorded files against the archive, forgetting bad ones. Returns the bad paths."""
+        entries = self.entries()
+        thumb_pack = read_pack(self.base_dir)
+        locations = [self._location(entry[0], thumb_pack) for entry in entries]
+        with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+            infos = list(executor.map(stored_file_info, locations, chunksize=64))
+
+        bad_paths = []
+        for (path, size, md5, url), (real_size, real_md5) in zip(entries, infos):
+            if real_size != size or (md5 and real_md5 != md5):
+                bad_paths.append(path)
+
+        self.remove_many(bad_paths)
+        return bad_paths
+
+
+def stored_file_info(location):
+    """Return (size, md5 hex digest) for a file on disk or in a pack, or (None, None) if it's missing.
+
+    location is the file's filename, or (segment filename, offset, size) for
+    a file in a pack.
+    """
+    if isinstance(location, str):
+        return file_info(location)
+    segment_filename, offset, size = location
+    try:
+        with open(segment_filename, 'rb') as segment_file:
+            segment_file.seek(offset)
+            data = segment_file.read(size)
+    except (IOError, OSError):
+        return None, None
+    if len(data) != size:
+        return None, None
+    return size, hashlib.md5(data).hexdigest()
+
+
+def file_info(local_filename):
+    """Return (size, md5 hex digest) for the given file, or (None, None) if it's missing."""
+    try:
+        md5 = hashlib.md5()
+        with open(local_filename, 'rb') as local_file:
+            for chunk in iter(lambda: local_file.read(1024*1024), b''):
+                md5.update(chunk)
+        return os.path.getsize(local_filename), md5.hexdigest()
+    except (IOError, OSError):
+        return None, None
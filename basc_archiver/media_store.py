@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# BASC Imageboard Archiver Media Store
+from __future__ import absolute_import
+from __future__ import print_function
+import os
+import shutil
+import threading
+
+from . import utils
+
+LOCK_STRIPES = 64  # keys share this many locks, so we don't keep one per key
+
+
+class MediaStore(object):
+    """Content-addressed store for media files, shared between threads.
+
+    Files are keyed by the MD5 the imageboard API gives us for each post, so
+    the same file posted in many threads is only downloaded and stored once.
+    Copies in thread folders are hard-linked to the stored file where the
+    filesystem allows it, and copied otherwise.
+    """
+
+    def __init__(self, base_dir):
+        self.base_dir = base_dir
+        self._locks = [threading.Lock() for i in range(LOCK_STRIPES)]
+
+    def path(self, key):
+        """Return where the file for the given key is stored."""
+        return os.path.join(self.base_dir, key[:2], key[2:4], key)
+
+    def has(self, key):
+        """Return whether we've already stored the file for the given key."""
+        return os.path.exists(self.path(key))
+
+    def get(self, key, local_filename, download):
+        """Put the stored file for key at local_filename.
+
+        If we don't have the file yet, download(path) is called to fetch it
+        into the store first, and should return True on success. Returns
+        whether local_filename now exists.
+        """
+        stored_filename = self.path(key)
+
+        # only one download per key at a time
+        with self._key_lock(key):
+            if not os.path.exists(stored_filename):
+                utils.mkdirs(os.path.dirname(stored_filename))
+                if not download(stored_filename):
+                    return False
+
+        self._link(stored_filename, local_filename)
+        return True
+
+    def _key_lock(self, key):
+        """INTERNAL: Return the lock for the given key."""
+        return self._locks[hash(key) % LOCK_STRIPES]
+
+    def _link(self, stored_filename, local_filename):
+        """INTERNAL: Hard-link the stored file into place, copying if we can't.
+
+        Whatever is already at local_filename, say a truncated download from
+        before we used the store, gets replaced.
+        """
+        utils.mkdirs(os.path.dirname(local_filename))
+        temp_filename = local_filename + '.link'
+        try:
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
+            try:
+                os.link(stored_filename, temp_filename)
+            except OSError:
+                # different filesystem, or no hard-link support
+                shutil.copyfile(stored_filename, temp_filename)
+            os.replace(temp_filename, local_filename)
+        finally:
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# BASC Imageboard Archiver Metrics
+from __future__ import absolute_import
+from __future__ import print_function
+import bisect
+import collections
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from . import utils
+
+# seconds a single download item takes
+ITEM_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+# seconds between a file being posted and us having it
+POST_AGE_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 900, 1800, 3600, 21600, 86400)
+
+DEFAULT_STATS_INTERVAL = 15
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Histogram(object):
+    """Counts observations into fixed buckets, Prometheus-style."""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """Return (upper bound, count) pairs, including the +Inf bucket."""
+        total = 0
+        bounds = [repr(float(bound)) for bound in self.buckets] + ['+Inf']
+        pairs = []
+        for bound, count in zip(bounds, self.counts):
+            total += count
+            pairs.append((bound, total))
+        return pairs
+
+
+class SiteMetrics(object):
+    """Download counters and timings for a single site."""
+
+    def __init__(self, site):
+        self.site = site
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self.bytes_downloaded = 0
+        self.files_downloaded = collections.Counter()  # by dl type
+        self.errors = collections.Counter()  # by status code, or exception name
+        self.item_seconds = {}  # dl type -> Histogram
+        self.post_age = Histogram(POST_AGE_BUCKETS)
+
+    def item_finished(self, dl_type, seconds):
+        """Record how long downloading an item took."""
+        with self._lock:
+            if dl_type not in self.item_seconds:
+                self.item_seconds[dl_type] = Histogram(ITEM_BUCKETS)
+            self.item_seconds[dl_type].observe(seconds)
+
+    def file_downloaded(self, dl_type, size, posted=None):
+        """Record a downloaded media file, posted is when it was posted."""
+        with self._lock:
+            self.files_downloaded[dl_type] += 1
+            self.bytes_downloaded += size or 0
+            if posted:
+                self.post_age.observe(max(time.time() - posted, 0))
+
+    def error(self, code):
+        """Record a failed download item."""
+        with self._lock:
+            self.errors[str(code)] += 1
+
+
+def _labels(**labels):
+    """INTERNAL: Format Prometheus labels."""
+    return ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                    for name, value in sorted(labels.items()))
+
+
+def render(archiver):
+    """Return the archiver's metrics in the Prometheus text format."""
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append('# HELP {} {}'.format(name, help_text))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        for suffix, labels, value in samples:
+            lines.append('{}{}{{{}}} {}'.format(name, suffix, labels, value))
+
+    def histogram_samples(histogram, **labels):
+        samples = []
+        for bound, count in histogram.cumulative():
+            samples.append(('_bucket', _labels(le=bound, **labels), count))
+        samples.append(('_sum', _labels(**labels), histogram.sum))
+        samples.append(('_count', _labels(**labels), histogram.count))
+        return samples
+
+    queued, downloading, uptime = [], [], []
+    files, bytes_downloaded, errors = [], [], []
+    item_seconds, post_age = [], []
+    for site in archiver.archivers:
+        site_metrics = site.metrics
+        labels = _labels(site=site.name)
+        queued.append(('', labels, len(site.to_dl)))
+        downloading.append(('', labels, len(site.downloading)))
+        uptime.append(('', labels, time.time() - site_metrics.started))
+
+        with site_metrics._lock:
+            bytes_downloaded.append(('', labels, site_metrics.bytes_downloaded))
+            for dl_type, count in sorted(site_metrics.files_downloaded.items()):
+                files.append(('', _labels(site=site.name, type=dl_type), count))
+            for code, count in sorted(site_metrics.errors.items()):
+                errors.append(('', _labels(site=site.name, code=code), count))
+            for dl_type, histogram in sorted(site_metrics.item_seconds.items()):
+                item_seconds.extend(histogram_samples(histogram, site=site.name, type=dl_type))
+            post_age.extend(histogram_samples(site_metrics.post_age, site=site.name))
+
+    metric('basc_queued_items', 'gauge', 'Items waiting in the download queue.', queued)
+    metric('basc_downloading_items', 'gauge', 'Items being downloaded right now.', downloading)
+    metric('basc_uptime_seconds', 'gauge', 'Seconds since the site archiver started.', uptime)
+    metric('basc_downloaded_files_total', 'counter', 'Media files downloaded.', files)
+    metric('basc_downloaded_bytes_total', 'counter', 'Bytes of media downloaded.', bytes_downloaded)
+    metric('basc_item_errors_total', 'counter', 'Download items that failed, by status code or error.', errors)
+    metric('basc_item_seconds', 'histogram', 'Time taken to download an item, by item type.', item_seconds)
+    metric('basc_post_to_download_seconds', 'histogram', 'Time from a file being posted to it being downloaded.',
+           post_age)
+
+    responses, requests_made, connections = [], [], []
+    for host, stats in sorted(utils.sessions.stats().items()):
+        labels = _labels(host=host)
+        requests_made.append(('', labels, stats['requests']))
+        connections.append(('', labels, stats['connections']))
+        for code, count in sorted(stats['responses'].items()):
+            responses.append(('', _labels(host=host, code=code), count))
+
+    metric('basc_http_requests_total', 'counter', 'HTTP requests made.', requests_made)
+    metric('basc_http_connections_total', 'counter', 'HTTP connections opened.', connections)
+    metric('basc_http_responses_total', 'counter', 'HTTP responses, by status code.', responses)
+
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsServer(threading.Thread):
+    """Serves the archiver's metrics over HTTP for Prometheus to scrape."""
+
+    def __init__(self, archiver, port, host='127.0.0.1'):
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                if handler.path.split('?')[0] not in ('/', '/metrics'):
+                    handler.send_error(404)
+                    return
+                body = render(archiver).encode('utf-8')
+                handler.send_response(200)
+                handler.send_header('Content-Type', PROMETHEUS_CONTENT_TYPE)
+                handler.send_header('Content-Length', str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.start()
+
+    def run(self):
+        self.server.serve_forever()
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class StatsFileWriter(threading.Thread):
+    """Rewrites a file with the archiver's metrics every few seconds.
+
+    The file uses the Prometheus text format, so it can be picked up by the
+    node_exporter textfile collector as well as read directly.
+    """
+
+    def __init__(self, archiver, filename, interval=DEFAULT_STATS_INTERVAL):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.archiver = archiver
+        self.filename = filename
+        self.interval = float(interval)
+        self._stop_event = threading.Event()
+        self.start()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.write()
+
+    def write(self):
+        """Write out the current metrics."""
+        temp_filename = '{}-temporary'.format(self.filename)
+        with open(temp_filename, 'w', encoding='utf-8') as stats_file:
+            stats_file.write(render(self.archiver))
+        os.replace(temp_filename, self.filename)
+
+    def shutdown(self):
+        self._stop_event.set()
+        self.write()
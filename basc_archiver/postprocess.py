@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# BASC Imageboard Archiver Post-Processing
+from __future__ import absolute_import
+from __future__ import print_function
+import collections
+import concurrent.futures
+import json
+import multiprocessing
+import threading
+import traceback
+
+from . import storage, utils
+
+DEFAULT_WORKERS = 0
+DEFAULT_QUEUE_SIZE = 100
+
+
+class PostProcessor(object):
+    """Runs CPU-heavy jobs, like parsing and rewriting pages, in worker processes.
+
+    Jobs are plain module-level functions and their arguments, so they can be
+    pickled over to a worker. At most max_size jobs are waiting or running at
+    once, submitting more blocks until one finishes. Each job's callback gets
+    the job's result back in this process, on the post-processor's own
+    thread, so callbacks are free to update status, queue more downloads or
+    submit more jobs.
+
+    Jobs submitted with the same key run one after another, in order. With no
+    workers, jobs and their callbacks simply run on the submitting thread.
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS, max_size=DEFAULT_QUEUE_SIZE):
+        self.workers = 0
+        self.max_size = DEFAULT_QUEUE_SIZE
+        self._pool = None
+        self._slots = None
+        self._lock = threading.RLock()
+        self._idle = threading.Condition(self._lock)
+        self._pending = 0
+        self._chains = {}  # key -> deque of jobs waiting on an earlier one
+        self._results = None
+        self._thread = None
+
+        self.submitted = 0
+        self.completed = 0
+        self.failed = collections.Counter()  # by job name
+        self.configure(workers, max_size)
+
+    def configure(self, workers=None, max_size=None):
+        """Set how many worker processes to use, and how many jobs may be queued."""
+        self.shutdown()
+        if workers is not None:
+            self.workers = max(int(workers), 0)
+        if max_size is not None:
+            self.max_size = max(int(max_size), 1)
+        self._slots = threading.BoundedSemaphore(self.max_size)
+
+    @property
+    def pending(self):
+        """Return how many jobs are waiting, running or having their results handled."""
+        with self._lock:
+            return self._pending
+
+    def submit(self, job, args=(), callback=None, finished=None, key=None):
+        """Run job(*args), then callback(result) in this process.
+
+        finished() is called once the job is done with, whether it worked or not.
+        """
+        if not self.workers:
+            self._run_inline(job, args, callback, finished)
+            return
+
+        # wait for room in the queue, so we can't get too far ahead of the
+        # workers. callbacks don't wait, they're what frees up room
+        slotted = threading.current_thread() is not self._thread
+        if slotted:
+            self._slots.acquire()
+        with self._lock:
+            try:
+                self._start()
+            except Exception:
+                if slotted:
+                    self._slots.release()
+                raise
+            self._pending += 1
+            self.submitted += 1
+            if key is not None:
+                if key in self._chains:
+                    self._chains[key].append((job, args, callback, finished, slotted))
+                    return
+                self._chains[key] = collections.deque()
+            self._submit(job, args, callback, finished, slotted, key)
+
+    def _run_inline(self, job, args, callback, finished):
+        """INTERNAL: Run a job and its callback right here."""
+        with self._lock:
+            self.submitted += 1
+        try:
+            result = job(*args)
+            if callback is not None:
+                callback(result)
+        except Exception:
+            self._job_failed(job)
+        finally:
+            with self._lock:
+                self.completed += 1
+            if finished is not None:
+                finished()
+
+    def _start(self):
+        """INTERNAL: Start the workers and result thread if they aren't running, lock must be held."""
+        if self._pool is not None:
+            return
+        # workers are started fresh rather than forked from us, as we have
+        # download threads running that could be holding locks
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+        self._pool = concurrent.futures.ProcessPoolExecutor(self.workers, mp_context=context)
+        self._results = collections.deque()
+        self._thread = threading.Thread(target=self._run, args=(self._results,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _submit(self, job, args, callback, finished, slotted, key):
+        """INTERNAL: Hand a job to the worker processes, lock must be held."""
+        try:
+            future = self._pool.submit(job, *args)
+        except Exception as e:
+            # a broken pool, say. fail the job the usual way so it's still counted off
+            future = concurrent.futures.Future()
+            future.set_exception(e)
+        results = self._results
+
+        def done(future):
+            with self._lock:
+                results.append((job, future, callback, finished, slotted, key))
+                self._idle.notify_all()
+        future.add_done_callback(done)
+
+    def _run(self, results):
+        """INTERNAL: Hand finished jobs' results to their callbacks, in this process."""
+        while True:
+            with self._lock:
+                while not results and self._pool is not None:
+                    self._idle.wait()
+                if not results:
+                    return
+                job, future, callback, finished, slotted, key = results.popleft()
+
+            try:
+                result = future.result()
+                if callback is not None:
+                    callback(result)
+            except Exception:
+                self._job_failed(job)
+            if finished is not None:
+                try:
+                    finished()
+                except Exception:
+                    traceback.print_exc()
+
+            with self._lock:
+                if key is not None:
+                    if self._chains[key]:
+                        self._submit(*self._chains[key].popleft() + (key,))
+                    else:
+                        del self._chains[key]
+                self._pending -= 1
+                self.completed += 1
+                self._idle.notify_all()
+            if slotted:
+                self._slots.release()
+
+    def _job_failed(self, job):
+        """INTERNAL: Note a job that raised an exception."""
+        with self._lock:
+            self.failed[job.__name__] += 1
+        print('Post-processing job {} failed:'.format(job.__name__))
+        traceback.print_exc()
+
+    def join(self, timeout=None):
+        """Wait until every submitted job has finished and had its result handled."""
+        with self._lock:
+            return self._idle.wait_for(lambda: not self._pending, timeout)
+
+    def shutdown(self):
+        """Finish the jobs we have, then stop the worker processes."""
+        self.join()
+        with self._lock:
+            pool, thread = self._pool, self._thread
+            self._pool = self._thread = None
+            self._idle.notify_all()
+        if pool is not None:
+            pool.shutdown(wait=True)
+            thread.join()
+
+    def stats(self):
+        """Return job counts and how many are outstanding."""
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'failed': sum(self.failed.values()),
+                'pending': self._pending,
+            }
+
+
+jobs = PostProcessor()
+
+
+# jobs, these run in the worker processes
+def write_json(local_filename, data, pretty=True, indent=2):
+    """Write the given data out as JSON."""
+    utils.write_json(local_filename, data, pretty=pretty, indent=indent)
+
+
+def write_json_body(local_filename, body, pretty=True, indent=2):
+    """Write out JSON we were sent, pretty-printed if asked, or just as it came."""
+    if pretty:
+        utils.write_json(local_filename, json.loads(body.decode('utf-8')), pretty=True, indent=indent)
+    else:
+        storage.files.write(local_filename, body)
@@ -3,8 +3,51 @@
 # Site-Specific Archiver Classes
 from __future__ import print_function
 from __future__ import absolute_import
+import importlib
+import re
+from urllib.parse import urlparse
 
-from . import fourchan
-from . import fuuka
+# thread urls each site handles, here so matching them doesn't import the sites
+FOURCHAN_THREAD_REGEX = re.compile(r"""https?://(?:boards\.)?4chan(?:nel)?\.org/([0-9a-zA-Z]+)/(?:res|thread)/([0-9]+)""")
 
-default_archivers = [fourchan.FourChanSiteArchiver, fuuka.FuukaSiteArchiver]
+
+def fuuka_url_valid(url):
+    """Return true if the given URL looks like a FoolFuuka thread, /board/thread/id on any non-4chan host."""
+    if not url or '4chan' in url:
+        return False
+    if 'http' not in url:
+        url = 'http://' + url
+    path = [part for part in urlparse(url.rstrip('/')).path.split('/') if part not in ('', 'thread')]
+    return len(path) == 2 and path[1].isdigit()
+
+
+class SitePlugin(object):
+    """A site archiver, only imported once a URL needs it.
+
+    url_valid only uses what's in this module, so checking URLs doesn't
+    import the site's module or the libraries it depends on.
+    """
+
+    def __init__(self, name, module_name, class_name, url_valid):
+        self.name = name
+        self.module_name = module_name
+        self.class_name = class_name
+        self.url_valid = url_valid
+
+    def load(self):
+        """Import the site's module, and return its archiver class."""
+        module = importlib.import_module('.' + self.module_name, __name__)
+        return getattr(module, self.class_name)
+
+
+default_plugins = [
+    SitePlugin('4chan', 'fourchan', 'FourChanSiteArchiver', FOURCHAN_THREAD_REGEX.match),
+    SitePlugin('fuuka', 'fuuka', 'FuukaSiteArchiver', fuuka_url_valid),
+]
+
+
+def __getattr__(name):
+    # default_archivers used to be a list of every site's class, which meant importing them all
+    if name == 'default_archivers':
+        return [plugin.load() for plugin in default_plugins]
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
@@ -6,17 +6,41 @@ from __future__ import absolute_import
 
 import os
 import time
+import heapq
+import random
+import asyncio
+import itertools
 import threading
+import collections
+import concurrent.futures
+
+from .. import board_index, chanzip, postprocess, storage, utils
+from ..throttle import HostUnavailable
+from ..media_store import MediaStore
+from ..manifest import file_info, open_manifest
+from ..metrics import SiteMetrics
 
-DEFAULT_NOITEM_WAIT = 1
 DEFAULT_OK_WAIT = 0.1
 
+# retrying failed downloads
+RETRY_MAX = 5  # attempts before we give up on an item
+RETRY_BASE_DELAY = 5  # seconds, doubles with each attempt
+RETRY_MAX_DELAY = 300
+# items we never give up on, they get requeued as normal once they work again
+RETRY_FOREVER_TYPES = ('thread', 'board')
+
+RETRY_MESSAGE = '{timestamp} {site}: {dl_type} download failed ({error}), retry {retries} in {delay:.0f}s'
+GIVE_UP_MESSAGE = '{timestamp} {site}: {dl_type} download failed ({error}), giving up'
+DEFAULT_POOL_CONCURRENCY = 100
+DEFAULT_POOL_PER_HOST = 50
+
 
 class DownloadItem(object):
     def __init__(self, dl_type, info):
         self.dl_type = dl_type
         self.info = info
         self.next_dl_timestamp = 0
+        self.retries = 0
 
     def can_dl(self):
         """True if you can download this item."""
@@ -27,51 +51,302 @@ class DownloadItem(object):
         self.next_dl_timestamp = time.time() + delay_in_seconds
 
 
+class ThreadRecord(object):
+    """A thread being archived.
+
+    Works like the dict that used to hold thread info, but only has room for
+    the fields below. The site library's thread object, with all its posts,
+    is kept in ``thread`` and dropped once the thread dies.
+    """
+
+    FIELDS = ('site', 'board', 'dir', 'thread_id', 'total_files', 'images_downloaded', 'thumbs_downloaded',
+              'alive', 'ended', 'last_modified', 'last_scanned_post', 'next_dl', 'filename', 'summary', 'indexed',
+              'thread')
+    __slots__ = ('_registry', '_alive', 'site', 'board', 'dir', 'thread_id', 'total_files', 'images_downloaded',
+                 'thumbs_downloaded', 'ended', 'last_modified', 'last_scanned_post', 'next_dl', 'filename', 'summary',
+                 'indexed', 'thread')
+
+    def __init__(self, registry, board, thread_id, thread_dir):
+        self._registry = registry
+        self._alive = True
+        self.site = None
+        self.board = board
+        self.dir = thread_dir
+        self.thread_id = thread_id
+        self.total_files = 0
+        self.images_downloaded = 0
+        self.thumbs_downloaded = 0
+        self.ended = None  # '404' or 'archived', once the thread has gone
+        self.last_modified = None
+        self.last_scanned_post = None
+        self.next_dl = None
+        self.filename = None
+        self.summary = None  # subject, reply count and so on, see thread_summary
+        self.indexed = None  # state last written to the board index
+        self.thread = None
+
+    @property
+    def alive(self):
+        return self._alive
+
+    @alive.setter
+    def alive(self, alive):
+        alive = bool(alive)
+        if alive != self._alive:
+            self._alive = alive
+            self._registry._alive_changed(alive)
+
+    # dict-style access, which the site archivers and status callbacks use
+    def __getitem__(self, key):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.FIELDS and getattr(self, key) is not None
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def get(self, key, default=None):
+        value = getattr(self, key) if key in self.FIELDS else None
+        return default if value is None else value
+
+    def keys(self):
+        return [key for key in self.FIELDS if getattr(self, key) is not None]
+
+
+class ThreadRegistry(object):
+    """The threads a site is archiving.
+
+    Live and dead threads are counted as they change, and a dead thread is
+    compacted down to just its id once everything for it has been
+    downloaded, so long-running watchers don't keep growing.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._records = {}
+        self._dead_ids = set()
+        self.live = 0
+
+    def __contains__(self, thread_id):
+        return thread_id in self._records or thread_id in self._dead_ids
+
+    def __getitem__(self, thread_id):
+        return self._records[thread_id]
+
+    def __len__(self):
+        return len(self._records) + len(self._dead_ids)
+
+    @property
+    def dead(self):
+        """Return how many threads have died."""
+        return len(self) - self.live
+
+    def get(self, thread_id, default=None):
+        return self._records.get(thread_id, default)
+
+    def values(self):
+        return list(self._records.values())
+
+    def add(self, board, thread_id, thread_dir):
+        """Add a new live thread, and return its record."""
+        record = ThreadRecord(self, board, thread_id, thread_dir)
+        with self._lock:
+            self._records[thread_id] = record
+            self.live += 1
+        return record
+
+    def compact(self, thread_id):
+        """Forget everything about a dead thread except that we've seen it."""
+        with self._lock:
+            record = self._records.get(thread_id)
+            if record is None or record.alive:
+                return
+            del self._records[thread_id]
+            self._dead_ids.add(thread_id)
+
+    def _alive_changed(self, alive):
+        """INTERNAL: Keep our counts up to date when a thread dies or comes back."""
+        with self._lock:
+            self.live += 1 if alive else -1
+
+
+class DownloadQueue(object):
+    """Time-ordered download queue.
+
+    Items that are not yet due sit in a min-heap keyed on their
+    ``next_dl_timestamp``, due items move to a FIFO ready queue. Workers
+    block on a condition variable that gets signalled when items are added,
+    or when the earliest deadline in the heap passes.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.item_added = threading.Condition(self.lock)
+        self._waiting = []  # heap of (next_dl_timestamp, seq, item)
+        self._ready = collections.deque()
+        self._seq = itertools.count()
+        self.is_shutdown = False
+
+    def __len__(self):
+        return len(self._waiting) + len(self._ready)
+
+    def put(self, item):
+        """Add an item to the queue, waking up a worker if needed."""
+        with self.lock:
+            if item.can_dl():
+                self._ready.append(item)
+            else:
+                heapq.heappush(self._waiting, (item.next_dl_timestamp, next(self._seq), item))
+                # only wake workers up if the earliest deadline changed
+                if self._waiting[0][2] is not item:
+                    return
+            self.item_added.notify()
+
+    def get(self, on_get=None):
+        """Block until an item is due, and return it.
+
+        Returns None if the queue has been shut down. ``on_get`` is called
+        with the item while the queue lock is still held.
+        """
+        with self.lock:
+            while not self.is_shutdown:
+                now = time.time()
+                while self._waiting and self._waiting[0][0] <= now:
+                    self._ready.append(heapq.heappop(self._waiting)[2])
+
+                if self._ready:
+                    item = self._ready.popleft()
+                    if on_get is not None:
+                        on_get(item)
+                    # more work might be ready, let another worker pick it up
+                    if self._ready or self._waiting:
+                        self.item_added.notify()
+                    return item
+
+                if self._waiting:
+                    self.item_added.wait(self._waiting[0][0] - now)
+                else:
+                    self.item_added.wait()
+        return None
+
+    def shutdown(self):
+        """Stop handing out items, wake up all waiting workers."""
+        with self.lock:
+            self.is_shutdown = True
+            self.item_added.notify_all()
+
+
 class DownloadThread(threading.Thread):
     def __init__(self, site,
-                 noitem_wait_seconds=DEFAULT_NOITEM_WAIT,
                  nextitem_wait_seconds=DEFAULT_OK_WAIT):
         threading.Thread.__init__(self)
         self.site = site
-        self.noitem_wait_seconds = noitem_wait_seconds
         self.nextitem_wait_seconds = nextitem_wait_seconds
         self.daemon = True
         self.start()
 
     def run(self):
         while True:
-            # check if shutdown
-            if self.site.is_shutdown:
+            # block until the next item is due, or we shut down
+            next_item = self.site.to_dl.get(on_get=self.site._start_download)
+            if next_item is None:
                 break
 
-            # get next item to dl
-            next_item = None
-            with self.site.downloading_lock:
-                with self.site.to_dl_lock:
-                    # make sure dl timestamp on selected item has passed
-                    for i in range(len(self.site.to_dl)):
-                        next_item = self.site.to_dl[i]
-
-                        if next_item.can_dl():
-                            self.site.to_dl.pop(i)
-                            self.site.downloading.append(next_item)
-                            break
-                        else:
-                            next_item = None
-
             # download
-            if next_item is not None:
-                try:
-                    self.site.download_item(next_item)
-                finally:
-                    with self.site.downloading_lock:
-                        self.site.downloading.remove(next_item)
+            try:
+                self.site.process_item(next_item)
+            finally:
+                with self.site.downloading_lock:
+                    self.site.downloading.remove(next_item)
 
             # wait
-            if next_item is None:
-                time.sleep(self.noitem_wait_seconds)
-            else:
-                time.sleep(self.nextitem_wait_seconds)
+            time.sleep(self.nextitem_wait_seconds)
+
+
+class PooledDownloadEngine(threading.Thread):
+    """Runs a site's download queue on a pool of threads, bounded per host.
+
+    This is not non-blocking I/O. Our HTTP client and the site libraries
+    are blocking, so each ``download_item`` call still takes up a thread
+    of the pool, sized to the concurrency limit, until its transfer is
+    done. An asyncio event loop in front of the pool only does the
+    dispatching: it holds items back while their host is at the per-host
+    limit, without taking up a thread to wait.
+
+    What this buys over the thread engine is one shared pool per site with
+    a limit for each host, not cheaper transfers. At high concurrency it
+    costs a thread and its stack per transfer in flight, like the thread
+    engine does.
+    """
+
+    def __init__(self, site,
+                 concurrency=DEFAULT_POOL_CONCURRENCY,
+                 per_host=DEFAULT_POOL_PER_HOST):
+        threading.Thread.__init__(self)
+        self.site = site
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.daemon = True
+        self.start()
+
+    def run(self):
+        asyncio.run(self._dispatch())
+
+    def _feed(self, loop, ready, slots):
+        """Hand due items from the site queue over to the event loop."""
+        while True:
+            slots.acquire()
+            item = self.site.to_dl.get(on_get=self.site._start_download)
+            loop.call_soon_threadsafe(ready.put_nowait, item)
+            if item is None:
+                break
+
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Queue()
+        slots = threading.Semaphore(self.concurrency)
+        host_slots = {}
+        tasks = set()
+
+        # the queue blocks, so a daemon thread waits on it for us
+        feeder = threading.Thread(target=self._feed, args=(loop, ready, slots))
+        feeder.daemon = True
+        feeder.start()
+
+        workers = concurrent.futures.ThreadPoolExecutor(self.concurrency)
+        try:
+            while True:
+                item = await ready.get()
+                if item is None:
+                    break
+
+                host = self.site.item_host(item)
+                if host not in host_slots:
+                    host_slots[host] = asyncio.Semaphore(self.per_host)
+
+                task = loop.create_task(self._download(loop, workers, item,
+                                                       host_slots[host], slots))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        finally:
+            workers.shutdown(wait=False)
+
+    async def _download(self, loop, workers, item, host_slot, slots):
+        try:
+            async with host_slot:
+                await loop.run_in_executor(workers, self.site.process_item, item)
+        finally:
+            with self.site.downloading_lock:
+                self.site.downloading.remove(item)
+            slots.release()
 
 
 class BaseSiteArchiver(object):
@@ -87,29 +362,66 @@ class BaseSiteArchiver(object):
         self.base_thumbs_dir = os.path.join(self.base_thread_dir, 'thumbs')
 
         self.threads_lock = threading.Lock()
-        self.threads = {}
+        self.threads = ThreadRegistry()
+
+        # held while polling a thread, so different threads poll in parallel
+        self.thread_locks_lock = threading.Lock()
+        self.thread_locks = {}
 
         # setup thread info
         self.is_shutdown = False
-        self.to_dl_lock = threading.Lock()
-        self.to_dl = []
+        self.to_dl = DownloadQueue()
         self.downloading_lock = threading.Lock()
         self.downloading = []
 
+        # items still to finish for each thread, so we know when one is complete
+        self.outstanding_lock = threading.Lock()
+        self.outstanding = collections.Counter()
+        self.failed = collections.Counter()  # items we gave up on, for threads with items outstanding
+        self.checkpoint = None  # BackfillCheckpoint, while backfilling
+
         self._handler_callback = handler_callback
+        self.metrics = SiteMetrics(self.name)
+
+        # completed downloads, so we can skip them without hitting the disk
+        if options.use_manifest:
+            self.manifest = open_manifest(options.base_dir)
+        else:
+            self.manifest = None
+
+        # where thumbnails are kept, they can be packed together rather than one file each
+        if options.thumb_store == 'pack':
+            self.thumb_storage = storage.open_pack(options.base_dir)
+        elif options.thumb_store == 'files':
+            self.thumb_storage = storage.files
+        else:
+            raise Exception('Unknown thumbnail store: {}'.format(options.thumb_store))
+
+        # files shared between threads only get downloaded once
+        if options.media_store:
+            self.media_store = MediaStore(options.media_store)
+        else:
+            self.media_store = None
 
         # start download threads
-        for i in range(getattr(self, 'dl_threads', options.dl_threads_per_site)):
-            DownloadThread(self, **{
-                'noitem_wait_seconds': getattr(self, 'noitem_wait_seconds',
-                                               DEFAULT_NOITEM_WAIT),
-                'nextitem_wait_seconds': getattr(self, 'nextitem_wait_seconds',
-                                                 options.dl_thread_wait),
+        if options.engine == 'pool':
+            PooledDownloadEngine(self, **{
+                'concurrency': options.pool_concurrency,
+                'per_host': options.pool_per_host,
             })
+        elif options.engine == 'thread':
+            for i in range(getattr(self, 'dl_threads', options.dl_threads_per_site)):
+                DownloadThread(self, **{
+                    'nextitem_wait_seconds': getattr(self, 'nextitem_wait_seconds',
+                                                     options.dl_thread_wait),
+                })
+        else:
+            raise Exception('Unknown download engine: {}'.format(options.engine))
 
     def shutdown(self):
         """Shutdown this archiver."""
         self.is_shutdown = True
+        self.to_dl.shutdown()
 
     def update_status(self, cb_type, info):
         """Update thread status, call callbacks where appropriate."""
@@ -124,9 +436,254 @@ class BaseSiteArchiver(object):
             new_item = item
         else:
             new_item = DownloadItem(dl_type, kwargs)
+            if 'thread_id' in kwargs:
+                with self.outstanding_lock:
+                    self.outstanding[kwargs['thread_id']] += 1
+
+        self.to_dl.put(new_item)
+
+    def _have_file(self, local_filename, thumb=False):
+        """INTERNAL: Return whether the given media file has already been downloaded."""
+        if self.manifest is not None:
+            return self.manifest.has(local_filename)
+        return self._media_storage(thumb).exists(local_filename)
+
+    def _media_storage(self, thumb=False):
+        """INTERNAL: Return the storage backend for images, or thumbnails."""
+        return self.thumb_storage if thumb else storage.files
+
+    def _download_media(self, local_filename, url, md5=None, thumb=False, size=None, posted=None,
+                        thumb_size=None):
+        """INTERNAL: Download an image or thumbnail, through the media store if we can.
+
+        The same file gets a different size of thumbnail as an OP than as a
+        reply, so thumbnails are only shared when we know their (width, height).
+        """
+        # files that aren't in the manifest are incomplete, overwrite them
+        clobber = self.manifest is not None
+        media_storage = self._media_storage(thumb)
+
+        key = md5
+        if thumb:
+            key = None if md5 is None or thumb_size is None else '{}-thumb-{}x{}'.format(md5, *thumb_size)
+
+        if self.media_store is None or key is None or media_storage is not storage.files:
+            downloaded = utils.download_file(local_filename, url, clobber=clobber, conditional=False,
+                                             expected_size=size, storage=media_storage, resume=True)
+        else:
+            downloaded = self.media_store.get(key, local_filename,
+                                              lambda stored_filename: self._download_to_store(
+                                                  stored_filename, url, size, None if thumb else md5))
+
+        if downloaded:
+            # what's really on disk, which is what the manifest gets checked against
+            size = media_storage.size(local_filename)
+            self.metrics.file_downloaded('thumb' if thumb else 'image', size, posted)
+            if self.manifest is not None:
+                self.manifest.add(local_filename, url, None if thumb else md5, size)
+        return downloaded
 
-        with self.to_dl_lock:
-            self.to_dl.append(new_item)
+    def _download_to_store(self, stored_filename, url, size=None, md5=None):
+        """INTERNAL: Download a file into the media store, checking it against its MD5 if we have one.
+
+        Everything that links to the stored file trusts it, so a file that
+        doesn't match is removed again rather than kept.
+        """
+        if not utils.download_file(stored_filename, url, expected_size=size, resume=True):
+            return False
+        if md5 is not None:
+            real_md5 = file_info(stored_filename)[1]
+            if real_md5 != md5:
+                os.remove(stored_filename)
+                raise utils.ChecksumError(url, md5, real_md5)
+        return True
+
+    def process_item(self, item):
+        """Download the given item, retrying it later if it fails."""
+        started = time.time()
+        finished = True
+        failed = False
+        try:
+            self.download_item(item)
+        except Exception as e:
+            self.metrics.error(getattr(e, 'status_code', type(e).__name__))
+            if not self.is_shutdown:
+                finished = not self._retry_item(item, e)
+            failed = finished
+        else:
+            item.retries = 0
+        finally:
+            self.metrics.item_finished(item.dl_type, time.time() - started)
+
+        # thread items keep coming back until the thread dies
+        if item.dl_type == 'thread':
+            record = self.threads.get(item.info['thread_id'])
+            if record is not None:
+                if record.thread is not None:
+                    record.summary = self.thread_summary(record.thread)
+                if record.indexed != (record.ended or 'alive'):
+                    self._index_thread(record)
+            if record is not None and record.alive:
+                finished = False
+            elif record is not None and finished:
+                # the rest of the thread's downloads only need the counters
+                self._drop_thread(record)
+        if finished and 'thread_id' in item.info:
+            self._item_finished(item, failed=failed)
+
+    def _postprocess(self, item, job, args=(), callback=None, key=None):
+        """INTERNAL: Run a CPU-heavy job for the given item, off the download threads.
+
+        The job counts as outstanding for the item's thread until it's done.
+        """
+        with self.outstanding_lock:
+            self.outstanding[item.info['thread_id']] += 1
+        postprocess.jobs.submit(job, args, callback=callback, finished=lambda: self._item_finished(item), key=key)
+
+    def _item_finished(self, item, failed=False):
+        """INTERNAL: Note that an item is done with, and whether its thread is now complete.
+
+        failed is whether we gave up on the item, a thread with any of those
+        isn't checkpointed, so a later backfill gets another go at it.
+        """
+        thread_id = item.info['thread_id']
+        with self.outstanding_lock:
+            if failed:
+                self.failed[thread_id] += 1
+            self.outstanding[thread_id] -= 1
+            if self.outstanding[thread_id] > 0:
+                return
+            del self.outstanding[thread_id]
+            failures = self.failed.pop(thread_id, 0)
+
+        if self.checkpoint is not None and not failures:
+            self.checkpoint.add(item.info['board'], thread_id)
+
+        record = self.threads.get(thread_id)
+        packing = self.options.chan_zip and record is not None and record.ended
+        if record is not None:
+            self._index_thread(record, complete=True, chan_zip=packing)
+
+        # pack threads that have gone for good, now we've got everything from them
+        if packing:
+            thumbs_dir = self.base_thumbs_dir.format(board=record.board, thread=thread_id)
+            if self.thumb_storage is storage.files:
+                packed_files = []
+            else:
+                packed_files = self.thumb_storage.locations(thumbs_dir)
+            postprocess.jobs.submit(chanzip.pack_thread,
+                                    (record.dir, self.name, record.board, thread_id, self.options.chan_zip_remove,
+                                     packed_files),
+                                    key=record.dir)
+
+        if record is not None and not record.alive:
+            self._drop_thread(record)
+        self.threads.compact(thread_id)
+        with self.thread_locks_lock:
+            self.thread_locks.pop(thread_id, None)
+
+    def _drop_thread(self, record):
+        """INTERNAL: Let go of a dead thread's posts.
+
+        Sites whose library caches thread objects should drop them from there too.
+        """
+        record.thread = None
+
+    def thread_summary(self, thread):
+        """Return the details of the given thread object that go in its metadata and board index."""
+        return {}
+
+    def _index_thread(self, record, complete=False, chan_zip=False):
+        """INTERNAL: Add a thread's current state to its board's index.
+
+        Once the thread is complete, its metadata.json is written too.
+        """
+        if not self.options.board_index:
+            return
+        metadata = {
+            'site': self.name,
+            'board': record.board,
+            'thread_id': record.thread_id,
+            'state': record.ended or 'alive',
+            'complete': complete,
+            'files': record.total_files,
+            'images_downloaded': record.images_downloaded,
+            'thumbs_downloaded': record.thumbs_downloaded,
+            'updated': int(time.time()),
+        }
+        if chan_zip:
+            metadata['chan_zip'] = True
+        if record.summary:
+            metadata.update(record.summary)
+
+        # threads that were gone before we got anything don't get a folder
+        if complete and os.path.isdir(record.dir):
+            utils.write_json(os.path.join(record.dir, board_index.METADATA_FILENAME), metadata)
+        board_index.open_index(os.path.dirname(os.path.normpath(record.dir))).update(metadata)
+        record.indexed = metadata['state']
+
+    def _retry_item(self, item, error):
+        """INTERNAL: Requeue a failed item with jittered exponential backoff.
+
+        Returns False if we've given up on the item.
+        """
+        status_info = dict(item.info)
+        status_info.update({
+            'dl_type': item.dl_type,
+            'host': self.item_host(item),
+            'error': str(error),
+        })
+
+        if isinstance(error, HostUnavailable):
+            # the host is paused, doesn't count as an attempt
+            item.next_dl_timestamp = error.retry_at
+            status_info['next_dl'] = item.next_dl_timestamp
+            self.update_status('host_paused', info=status_info)
+            self.add_to_dl(item=item)
+            return True
+
+        item.retries += 1
+        status_info['retries'] = item.retries
+        message_info = {
+            'timestamp': utils.timestamp(),
+            'site': self.name,
+            'dl_type': item.dl_type,
+            'error': error,
+            'retries': item.retries,
+        }
+
+        if item.retries > RETRY_MAX and item.dl_type not in RETRY_FOREVER_TYPES:
+            self.update_status('dl_failed', info=status_info)
+            if not self.options.silent:
+                print(GIVE_UP_MESSAGE.format(**message_info))
+            return False
+
+        delay = min(RETRY_BASE_DELAY * 2 ** (item.retries - 1), RETRY_MAX_DELAY)
+        delay *= random.uniform(0.5, 1.5)
+        item.delay_dl_timestamp(delay)
+        status_info['next_dl'] = item.next_dl_timestamp
+        self.update_status('retry', info=status_info)
+        if self.options.verbose:
+            message_info['delay'] = delay
+            print(RETRY_MESSAGE.format(**message_info))
+        self.add_to_dl(item=item)
+        return True
+
+    def _start_download(self, item):
+        """INTERNAL: Mark the given item as being downloaded."""
+        with self.downloading_lock:
+            self.downloading.append(item)
+
+    def _thread_lock(self, thread_id):
+        """INTERNAL: Return the lock for polling the given thread."""
+        with self.thread_locks_lock:
+            if thread_id not in self.thread_locks:
+                self.thread_locks[thread_id] = threading.Lock()
+            return self.thread_locks[thread_id]
+
+    def item_host(self, item):
+        """Return the host the given item is downloaded from."""
+        return self.name
 
     # adding threads
     def url_valid(self, url):
@@ -137,15 +694,26 @@ class BaseSiteArchiver(object):
         """Try to add the given thread to our internal list."""
         raise Exception('you must override this method')
 
+    def add_threads(self, urls, check_exists=False, checkpoint=None):
+        """Add many threads at once, returns how many were added.
+
+        Sites that can't do better just add them one at a time.
+        """
+        added = 0
+        for url in urls:
+            if self.add_thread(url):
+                added += 1
+        return added
+
     @property
     def existing_threads(self):
         """Return how many threads we have and are downloading."""
-        return len([thread for thread in self.threads.values() if thread['alive']])
+        return self.threads.live
 
     @property
     def files_to_download(self):
         """Return whether we still have files to download."""
-        return len(self.to_dl) + len(self.downloading) > 0
+        return len(self.to_dl) + len(self.downloading) + postprocess.jobs.pending > 0
 
     # downloading specific items
     def download_item(self, item):
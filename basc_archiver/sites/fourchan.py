@@ -4,15 +4,17 @@
 from __future__ import print_function
 from __future__ import absolute_import
 
-from .base import BaseSiteArchiver
-from .. import utils
+from . import FOURCHAN_THREAD_REGEX
+from .base import BaseSiteArchiver, DownloadItem
+from .. import postprocess, storage, utils
+from ..backfill import BackfillCheckpoint
 
 import basc_py4chan
 
 import os
 import re
-import codecs
 import threading
+import collections
 
 THREAD_NONEXISTENT = 'Thread {site} / {board} / {thread_id} does not exist.'
 THREAD_NONEXISTENT_REASON = ("Either the thread already 404'ed, your URL is incorrect, "
@@ -25,7 +27,7 @@ THREAD_NEW_REPLIES = '{timestamp} Thread {site} / {board} / {thread_id}  -  {rep
 THREAD_CHILD_FOUND = '{timestamp} Child thread {site} / {board} / {thread_id} found and now being downloaded'
 
 # finding board name/thread id
-THREAD_REGEX = re.compile(r"""https?://(?:boards\.)?4chan(?:nel)?\.org/([0-9a-zA-Z]+)/(?:res|thread)/([0-9]+)""")
+THREAD_REGEX = FOURCHAN_THREAD_REGEX
 
 # top level domains
 FOURCHAN_BOARDS = 'boards.4chan.org'
@@ -51,12 +53,16 @@ FOURCHAN_BOARDS_FOOTER = '/%s/thread/%s'
 FOURCHAN_API_FOOTER = FOURCHAN_BOARDS_FOOTER + '.json'
 FOURCHAN_IMAGES_FOOTER = '/%s/%s'
 FOURCHAN_THUMBS_FOOTER = '/%s/%s'
+FOURCHAN_THREADS_LIST_FOOTER = '/%s/threads.json'
+FOURCHAN_ARCHIVE_FOOTER = '/%s/archive.json'
 
 # download urls
 FOURCHAN_BOARDS_URL = FOURCHAN_BOARDS + FOURCHAN_BOARDS_FOOTER
 FOURCHAN_API_URL = FOURCHAN_API + FOURCHAN_API_FOOTER
 FOURCHAN_IMAGES_URL = FOURCHAN_IMAGES + FOURCHAN_IMAGES_FOOTER
 FOURCHAN_THUMBS_URL = FOURCHAN_THUMBS + FOURCHAN_THUMBS_FOOTER
+FOURCHAN_THREADS_LIST_URL = FOURCHAN_API + FOURCHAN_THREADS_LIST_FOOTER
+FOURCHAN_ARCHIVE_URL = FOURCHAN_API + FOURCHAN_ARCHIVE_FOOTER
 
 # html parsing regex
 HTTP_HEADER_UNIV = r"https?://"  # works for both http and https links
@@ -72,6 +78,15 @@ FOURCHAN_THUMBS_URL_REGEX = re.compile(HTTP_HEADER_UNIV + FOURCHAN_THUMBS + FOUR
 FOURCHAN_CSS_URL_REGEX = re.compile(HTTP_HEADER_UNIV + FOURCHAN_STATIC + '/css/')
 FOURCHAN_JS_URL_REGEX = re.compile(HTTP_HEADER_UNIV + FOURCHAN_STATIC + '/js/')
 
+# all of the above in one pass, protocol-relative links are caught as well
+FOURCHAN_LINKS_REGEX = re.compile(r'("//|' + HTTP_HEADER_UNIV + ')(?:' +
+                                  '(?P<image>' + FOURCHAN_IMAGES + FOURCHAN_IMAGES_REGEX + ')|' +
+                                  '(?P<thumb>' + FOURCHAN_THUMBS + FOURCHAN_THUMBS_REGEX + ')|' +
+                                  '(?P<css>' + FOURCHAN_STATIC + '/css/)|' +
+                                  '(?P<js>' + FOURCHAN_STATIC + '/js/))?')
+FOURCHAN_CSS_FILES_REGEX = re.compile(FOURCHAN_CSS_REGEX)
+FOURCHAN_JS_FILES_REGEX = re.compile(FOURCHAN_JS_REGEX)
+
 # default folder and file names
 _DEFAULT_FOLDER = '4chan'
 _IMAGE_DIR_NAME = 'images'
@@ -80,9 +95,99 @@ _CSS_DIR_NAME = 'css'
 _JS_DIR_NAME = 'js'
 EXT_LINKS_FILENAME = 'external_links.txt'
 
-# The Ultimate URL Regex
-# http://stackoverflow.com/questions/520031/whats-the-cleanest-way-to-extract-urls-from-a-string-using-python
-URLREGEX = re.compile(r"""((?:[a-z][\w-]+:(?:/{1,3}|[a-z0-9%])|www\d{0,3}[.]|[a-z0-9.\-]+[.‌​][a-z]{2,4}/)(?:[^\s()<>]+|(([^\s()<>]+|(([^\s()<>]+)))*))+(?:(([^\s()<>]+|(‌​([^\s()<>]+)))*)|[^\s`!()[]{};:'".,<>?«»“”‘’]))""", re.DOTALL)
+
+class ThreadPageRewriter(object):
+    """Converts links in a thread's HTML to local links, one line at a time.
+
+    CSS and JS files referenced in the page are collected as we go.
+    """
+
+    def __init__(self, http_header):
+        self.http_header = http_header
+        self.css_files = []
+        self.js_files = []
+
+    def __call__(self, line):
+        for css_filename in FOURCHAN_CSS_FILES_REGEX.findall(line):
+            if css_filename not in self.css_files:
+                self.css_files.append(css_filename)
+        for js_filename in FOURCHAN_JS_FILES_REGEX.findall(line):
+            if js_filename not in self.js_files:
+                self.js_files.append(js_filename)
+
+        return FOURCHAN_LINKS_REGEX.sub(self._replace, line)
+
+    def _replace(self, match):
+        # keep the quote from a protocol-relative link
+        quote = '"' if match.group(1) == '"//' else ''
+
+        if match.group('image'):
+            return quote + _IMAGE_DIR_NAME + '/' + match.group(3)
+        elif match.group('thumb'):
+            return quote + _THUMB_DIR_NAME + '/' + match.group(5)
+        elif match.group('css'):
+            return quote + _CSS_DIR_NAME + '/'
+        elif match.group('js'):
+            return quote + _JS_DIR_NAME + '/'
+        elif quote:
+            return quote + self.http_header
+        return match.group(0)
+
+
+def scan_posts(external_urls_filename, comments, append=False, find_children=False):
+    """Record the external urls in the given post comments.
+
+    Returns the (board, thread id) of the threads the comments link to, if
+    find_children is set. Runs as a post-processing job.
+    """
+    children = []
+    urls = []
+    for comment in comments:
+        # 4chan puts <wbr> in middle of urls for word break, remove them
+        cleaned_comment = comment.replace('<wbr>', '')
+
+        if find_children:
+            for child_board, child_id in CHILDREGEX.findall(cleaned_comment):
+                children.append((child_board, int(child_id)))
+
+        for url in utils.find_urls(cleaned_comment):
+            urls.append('{}\n'.format(url))
+
+    output = ''.join(urls).encode('utf-8')
+    if append:
+        storage.files.append(external_urls_filename, output)
+    else:
+        storage.files.write(external_urls_filename, output)
+    return children
+
+
+class ResponseRecorder(object):
+    """Keeps the body of the last successful response for each URL we're watching.
+
+    It's a response hook for our shared sessions, so we can save exactly
+    what basc_py4chan fetched for a thread rather than what it kept of it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._bodies = {}  # url -> body, None until it's been fetched
+
+    def watch(self, url):
+        """Start keeping the body of responses for the given URL."""
+        with self._lock:
+            self._bodies[url] = None
+
+    def take(self, url):
+        """Stop watching the given URL, returning the body we got for it, or None if we got nothing new."""
+        with self._lock:
+            return self._bodies.pop(url, None)
+
+    def __call__(self, response, *args, **kwargs):
+        if response.status_code != 200:
+            return
+        with self._lock:
+            if response.url in self._bodies:
+                self._bodies[response.url] = response.content
 
 
 class FourChanSiteArchiver(BaseSiteArchiver):
@@ -93,11 +198,27 @@ class FourChanSiteArchiver(BaseSiteArchiver):
 
         self.boards_lock = threading.Lock()
         self.boards = {}
+        self.thread_responses = ResponseRecorder()
+
+        # threads are only polled when their board's threads.json says they changed
+        self.watch_lock = threading.Lock()
+        self.watched_boards = {}  # board name -> board check item
+        self.parked_threads = {}  # board name -> {thread id: thread item}
 
     def url_valid(self, url):
         """Return true if the given URL is for my site."""
         return THREAD_REGEX.match(url)
 
+    def item_host(self, item):
+        """Return the host the given item is downloaded from."""
+        if item.dl_type == 'image':
+            return FOURCHAN_IMAGES
+        elif item.dl_type == 'thumb':
+            return FOURCHAN_THUMBS
+        elif item.dl_type == 'page':
+            return FOURCHAN_BOARDS
+        return FOURCHAN_API
+
     def _url_info(self, url):
         """INTERNAL: Takes a url, returns board name, thread info."""
         if self.url_valid(url):
@@ -120,43 +241,287 @@ class FourChanSiteArchiver(BaseSiteArchiver):
 
         # running board object
         with self.boards_lock:
-            if board_name not in self.boards:
-                self.boards[board_name] = basc_py4chan.Board(board_name,
-                                                             https=self.options.use_ssl)
-            running_board = self.boards[board_name]
-
-            if not running_board.thread_exists(thread_id):
-                print(THREAD_NONEXISTENT.format(**{
-                    'site': self.name,
-                    'board': board_name,
-                    'thread_id': thread_id,
-                }))
-                print(THREAD_NONEXISTENT_REASON)
-                return False
+            running_board = self._board(board_name)
 
-        # add thread to download list
-        with self.threads_lock:
-            self.threads[thread_id] = {
+        if not running_board.thread_exists(thread_id):
+            print(THREAD_NONEXISTENT.format(**{
+                'site': self.name,
                 'board': board_name,
-                'dir': self.base_thread_dir.format(board=board_name, thread=thread_id),
                 'thread_id': thread_id,
-                'total_files': 0,
-                'images_downloaded': 0,
-                'thumbs_downloaded': 0,
-                'alive': True,
-            }
-            status_info = self.threads[thread_id]
+            }))
+            print(THREAD_NONEXISTENT_REASON)
+            return False
+
+        return self._queue_thread(board_name, thread_id)
+
+    def add_threads(self, urls, check_exists=False, checkpoint=None):
+        """Add many threads at once, for backfilling whole boards.
+
+        Threads aren't checked one at a time like with add_thread, they're
+        queued straight away. With check_exists, each board's thread list
+        and archive are fetched once, and threads on neither are skipped.
+        Threads already in the checkpoint file are skipped, and threads get
+        added to it once they and their files are fully downloaded.
+
+        Returns how many threads were added.
+        """
+        if checkpoint is not None:
+            self.checkpoint = BackfillCheckpoint(checkpoint)
+
+        thread_ids = collections.OrderedDict()  # board name -> thread ids
+        for url in urls:
+            board_name, thread_id = self._url_info(url)
+            if board_name is not None:
+                thread_ids.setdefault(board_name, []).append(int(thread_id))
+
+        added = 0
+        for board_name, board_thread_ids in thread_ids.items():
+            with self.boards_lock:
+                self._board(board_name)
+            listed = self._listed_threads(board_name) if check_exists else None
+
+            for thread_id in board_thread_ids:
+                if self.checkpoint is not None and self.checkpoint.has(board_name, thread_id):
+                    continue
+                if listed is not None and thread_id not in listed:
+                    print(THREAD_NONEXISTENT.format(**{
+                        'site': self.name,
+                        'board': board_name,
+                        'thread_id': thread_id,
+                    }))
+                    continue
+                if self._queue_thread(board_name, thread_id):
+                    added += 1
+        return added
+
+    def _drop_thread(self, record):
+        """INTERNAL: Let go of a dead thread's posts, including the board's cached copy."""
+        with self.boards_lock:
+            running_board = self.boards.get(record.board)
+        if running_board is not None:
+            # the library keeps every thread it's fetched, and only forgets ones that 404
+            running_board._thread_cache.pop(record.thread_id, None)
+        BaseSiteArchiver._drop_thread(self, record)
+
+    def thread_summary(self, thread):
+        """Return the details of the given thread object that go in its metadata and board index."""
+        topic = thread.topic
+        last_post = thread.replies[-1] if thread.replies else topic
+        return {
+            'subject': topic.subject,
+            'name': topic.name,
+            'created': topic.timestamp,
+            'last_post': last_post.timestamp,
+            'replies': len(thread.replies),
+        }
+
+    def _follow_children(self, item, children):
+        """INTERNAL: Queue up the child threads found in a thread.
+
+        This is a post-processing callback, so checking the children exist
+        is left to the download threads.
+        """
+        board_name = item.info['board']
+        for child_board, child_id in sorted(set(children)):
+            if child_id in self.threads:
+                continue
+            if self.options.follow_to_other_boards or child_board == board_name:
+                self.add_to_dl(dl_type='child', board=board_name, thread_id=item.info['thread_id'],
+                               child_board=child_board, child_id=child_id)
+
+    def _add_child(self, item):
+        """INTERNAL: Add a child thread, if it exists."""
+        child_board = item.info['child_board']
+        child_id = item.info['child_id']
+        if self._add_thread_from_info(child_board, child_id):
+            print(THREAD_CHILD_FOUND.format(**{
+                'site': self.name,
+                'board': child_board,
+                'thread_id': child_id,
+                'timestamp': utils.timestamp(),
+            }))
+
+    def _board(self, board_name):
+        """INTERNAL: Return the running board object, boards_lock must be held."""
+        if board_name not in self.boards:
+            session = utils.sessions.session(FOURCHAN_API)
+            if self.thread_responses not in session.hooks['response']:
+                session.hooks['response'].append(self.thread_responses)
+            self.boards[board_name] = basc_py4chan.Board(board_name,
+                                                         https=self.options.use_ssl,
+                                                         session=session)
+        return self.boards[board_name]
+
+    def _listed_threads(self, board_name):
+        """INTERNAL: Return the ids of threads on the board or in its archive, None if we can't tell."""
+        http_header = ('https://' if self.options.use_ssl else 'http://')
+        try:
+            status_code, pages = utils.fetch_json(http_header + FOURCHAN_THREADS_LIST_URL % board_name)
+            if status_code != 200:
+                return None
+            listed = set(listed_thread['no'] for page in pages for listed_thread in page['threads'])
+
+            status_code, archived = utils.fetch_json(http_header + FOURCHAN_ARCHIVE_URL % board_name)
+            if status_code != 200:
+                return None
+            listed.update(archived)
+        except Exception:
+            return None
+        return listed
+
+    def _queue_thread(self, board_name, thread_id):
+        """INTERNAL: Add a thread we know exists to our internal list and the download queue."""
+        with self.threads_lock:
+            if thread_id in self.threads:
+                return False
+            status_info = self.threads.add(board_name, thread_id,
+                                           self.base_thread_dir.format(board=board_name, thread=thread_id))
         self.update_status('new_thread', info=status_info)
 
         self.add_to_dl('thread', board=board_name, thread_id=thread_id)
         return True
 
+    def _save_thread_json(self, item, thread_dir, json_url):
+        """INTERNAL: Save the thread JSON we just polled, exactly as the API sent it.
+
+        basc_py4chan only adds new posts to a thread it's already fetched, so
+        its posts miss deletions and edits. We save the response body it got
+        instead, if it got one, otherwise the saved file is still current.
+        """
+        body = self.thread_responses.take(json_url)
+        if body is None:
+            return
+        local_filename = os.path.join(thread_dir, '{}.json'.format(item.info['thread_id']))
+        utils.mkdirs(thread_dir)
+        self._postprocess(item, postprocess.write_json_body, (local_filename, body, self.options.pretty_json),
+                          key=local_filename)
+
+    def _park_thread(self, item):
+        """INTERNAL: Wait for the board watcher to see a change before polling this thread again."""
+        board_name = item.info['board']
+        new_board_item = None
+
+        with self.watch_lock:
+            if board_name not in self.parked_threads:
+                self.parked_threads[board_name] = {}
+            self.parked_threads[board_name][item.info['thread_id']] = item
+
+            board_item = self.watched_boards.get(board_name)
+            if board_item is None:
+                board_item = DownloadItem('board', {'board': board_name})
+                board_item.delay_dl_timestamp(self.options.thread_check_delay)
+                self.watched_boards[board_name] = board_item
+                new_board_item = board_item
+            item.next_dl_timestamp = board_item.next_dl_timestamp
+
+        if new_board_item is not None:
+            self.add_to_dl(item=new_board_item)
+
+    def _check_board(self, item, http_header):
+        """INTERNAL: Fetch the board's thread list, and wake up threads that changed."""
+        board_name = item.info['board']
+        url = http_header + FOURCHAN_THREADS_LIST_URL % board_name
+
+        try:
+            status_code, pages = utils.fetch_json(url, conditional=True)
+        except Exception:
+            status_code, pages = None, None
+
+        if status_code == 200:
+            listing = {}
+            for page in pages:
+                for listed_thread in page['threads']:
+                    listing[listed_thread['no']] = listed_thread['last_modified']
+
+        to_wake = []
+        with self.watch_lock:
+            parked = self.parked_threads.get(board_name, {})
+            for thread_id in list(parked.keys()):
+                if status_code == 304:
+                    # nothing on the board changed
+                    break
+                elif status_code != 200:
+                    # can't tell what changed, poll everything
+                    to_wake.append(parked.pop(thread_id))
+                elif thread_id not in listing:
+                    # 404'd or archived, the thread poll will tell us which
+                    to_wake.append(parked.pop(thread_id))
+                else:
+                    with self.threads_lock:
+                        thread_info = self.threads[thread_id]
+                        if thread_info.get('last_modified') != listing[thread_id]:
+                            thread_info['last_modified'] = listing[thread_id]
+                            to_wake.append(parked.pop(thread_id))
+
+            if parked:
+                item.delay_dl_timestamp(self.options.thread_check_delay)
+                for thread_item in parked.values():
+                    thread_item.next_dl_timestamp = item.next_dl_timestamp
+            else:
+                # nothing left to watch, _park_thread starts a new watcher if needed
+                self.parked_threads.pop(board_name, None)
+                del self.watched_boards[board_name]
+
+        for thread_item in to_wake:
+            thread_item.delay_dl_timestamp(0)
+            self.add_to_dl(item=thread_item)
+
+        if parked:
+            self.add_to_dl(item=item)
+
+    def _download_page(self, item, http_header):
+        """INTERNAL: Save the thread's HTML page, and the CSS and JS it uses."""
+        board_name = item.info['board']
+        thread_id = item.info['thread_id']
+        thread_dir = self.base_thread_dir.format(board=board_name, thread=thread_id)
+        local_filename = os.path.join(thread_dir, '{}.html'.format(thread_id))
+        url = http_header + FOURCHAN_BOARDS_URL % (board_name, thread_id)
+
+        # two polls can queue a page each, don't let them write it at the same time
+        with self._thread_lock(thread_id):
+            # links are converted to local links as the page streams in
+            rewriter = ThreadPageRewriter(http_header)
+            if not utils.download_file(local_filename, url, clobber=True, line_filter=rewriter):
+                return
+
+        # get css files
+        if not self.options.skip_css:
+            css_dir = os.path.join(thread_dir, _CSS_DIR_NAME)
+            utils.mkdirs(css_dir)
+
+            for css_filename in rewriter.css_files:
+                local_css_filename = os.path.join(css_dir, css_filename)
+                url = http_header + FOURCHAN_STATIC + '/css/' + css_filename
+                utils.download_file(local_css_filename, url)
+
+        # get js files
+        if not self.options.skip_js:
+            js_dir = os.path.join(thread_dir, _JS_DIR_NAME)
+            utils.mkdirs(js_dir)
+
+            for js_filename in rewriter.js_files:
+                local_js_filename = os.path.join(js_dir, js_filename)
+                url = http_header + FOURCHAN_STATIC + '/js/' + js_filename
+                utils.download_file(local_js_filename, url)
+
     def download_item(self, item):
         """Download the given item."""
         http_header = ('https://' if self.options.use_ssl else 'http://')
 
+        # board thread list
+        if item.dl_type == 'board':
+            self._check_board(item, http_header)
+
+        # thread html page
+        elif item.dl_type == 'page':
+            self._download_page(item, http_header)
+
+        # threads linked from a thread
+        elif item.dl_type == 'child':
+            self._add_child(item)
+
         # images
-        if item.dl_type == 'image':
+        elif item.dl_type == 'image':
             if self.options.thumbs_only:
                 return True
 
@@ -168,9 +533,10 @@ class FourChanSiteArchiver(BaseSiteArchiver):
             file_url = http_header + FOURCHAN_IMAGES_URL % (board_name, filename)
             file_path = os.path.join(images_dir, filename)
 
-            if not os.path.exists(file_path):
+            if not self._have_file(file_path):
                 utils.mkdirs(images_dir)
-                if utils.download_file(file_path, file_url):
+                if self._download_media(file_path, file_url, item.info.get('md5'), size=item.info.get('fsize'),
+                                        posted=item.info.get('posted')):
                     with self.threads_lock:
                         self.threads[thread_id]['images_downloaded'] += 1
                         status_info = self.threads[thread_id]
@@ -198,9 +564,9 @@ class FourChanSiteArchiver(BaseSiteArchiver):
             file_url = http_header + FOURCHAN_THUMBS_URL % (board_name, filename)
             file_path = os.path.join(thumbs_dir, filename)
 
-            if not os.path.exists(file_path):
-                utils.mkdirs(thumbs_dir)
-                if utils.download_file(file_path, file_url):
+            if not self._have_file(file_path, thumb=True):
+                if self._download_media(file_path, file_url, item.info.get('md5'), thumb=True,
+                                        posted=item.info.get('posted'), thumb_size=item.info.get('thumb_size')):
                     with self.threads_lock:
                         self.threads[thread_id]['thumbs_downloaded'] += 1
                         status_info = self.threads[thread_id]
@@ -226,7 +592,10 @@ class FourChanSiteArchiver(BaseSiteArchiver):
             self.update_status('thread_start_download', info=status_info)
 
             thread = self.threads[thread_id]
-            with self.boards_lock:
+            with self._thread_lock(thread_id):
+                json_url = http_header + FOURCHAN_API + FOURCHAN_API_FOOTER % (board_name, thread_id)
+                self.thread_responses.watch(json_url)
+
                 # skip if no new posts
                 if 'thread' in thread:
                     new_replies = thread['thread'].update()
@@ -241,20 +610,11 @@ class FourChanSiteArchiver(BaseSiteArchiver):
                             status_info = self.threads[thread_id]
                         self.update_status('archived', info=status_info)
                         self.threads[thread_id]['alive'] = False
-                        return True
-                    elif new_replies < 1:
-                        # skip if no new posts
-                        item.delay_dl_timestamp()
-
-                        with self.threads_lock:
-                            status_info = self.threads[thread_id]
-                        status_info['next_dl'] = item.next_dl_timestamp
-                        self.update_status('thread_dl', info=status_info)
-
-                        self.add_to_dl(item=item)
+                        self.threads[thread_id]['ended'] = 'archived'
+                        self._save_thread_json(item, thread_dir, json_url)
                         return True
                     elif thread['thread'].is_404:
-                        # thread 404'd
+                        # thread 404'd, update() returns 0 for these too so check first
                         print(THREAD_404.format(**{
                             'site': self.name,
                             'board': board_name,
@@ -265,6 +625,20 @@ class FourChanSiteArchiver(BaseSiteArchiver):
                             status_info = self.threads[thread_id]
                         self.update_status('404', info=status_info)
                         self.threads[thread_id]['alive'] = False
+                        self.threads[thread_id]['ended'] = '404'
+                        self.thread_responses.take(json_url)
+                        return True
+                    elif new_replies < 1:
+                        # posts can still have been deleted or changed
+                        self._save_thread_json(item, thread_dir, json_url)
+
+                        # skip if no new posts
+                        self._park_thread(item)
+
+                        with self.threads_lock:
+                            status_info = self.threads[thread_id]
+                        status_info['next_dl'] = item.next_dl_timestamp
+                        self.update_status('thread_dl', info=status_info)
                         return True
                     else:
                         with self.threads_lock:
@@ -273,6 +647,21 @@ class FourChanSiteArchiver(BaseSiteArchiver):
                 else:
                     running_board = self.boards[board_name]
                     running_thread = running_board.get_thread(thread_id)
+                    if running_thread is None:
+                        # backfilled threads aren't checked before we get here
+                        print(THREAD_404.format(**{
+                            'site': self.name,
+                            'board': board_name,
+                            'thread_id': thread_id,
+                            'timestamp': utils.timestamp(),
+                        }))
+                        with self.threads_lock:
+                            self.threads[thread_id]['alive'] = False
+                            self.threads[thread_id]['ended'] = '404'
+                            status_info = self.threads[thread_id]
+                        self.update_status('404', info=status_info)
+                        self.thread_responses.take(json_url)
+                        return True
                     self.threads[thread_id]['thread'] = running_thread
                     thread['thread'] = running_thread
                     new_replies = len(running_thread.all_posts)
@@ -291,6 +680,7 @@ class FourChanSiteArchiver(BaseSiteArchiver):
                             status_info = self.threads[thread_id]
                         self.update_status('archived', info=status_info)
                         self.threads[thread_id]['alive'] = False
+                        self.threads[thread_id]['ended'] = 'archived'
 
             # thread
             if not self.options.silent:
@@ -304,96 +694,55 @@ class FourChanSiteArchiver(BaseSiteArchiver):
 
             utils.mkdirs(thread_dir)
 
-            # record external urls and follow child threads
-            external_urls_filename = os.path.join(thread_dir, EXT_LINKS_FILENAME)
-            with codecs.open(external_urls_filename, 'w', encoding='utf-8') as external_urls_file:
-                # all posts, including topic
-                all_posts = [thread['thread'].topic] + thread['thread'].posts
-                for reply in all_posts:
-                    if reply.comment is None:
-                        continue
-
-                    # 4chan puts <wbr> in middle of urls for word break, remove them
-                    cleaned_comment = re.sub(r'\<wbr\>', '', reply.comment)
-
-                    # child threads
-                    if self.options.follow_child_threads:
-                        for child_board, child_id in CHILDREGEX.findall(cleaned_comment):
-                            is_same_board = child_board == board_name
-                            child_id = int(child_id)
-
-                            if child_id not in self.threads:
-                                if self.options.follow_to_other_boards or is_same_board:
-                                    if self._add_thread_from_info(child_board, child_id):
-                                        print(THREAD_CHILD_FOUND.format(**{
-                                            'site': self.name,
-                                            'board': child_board,
-                                            'thread_id': child_id,
-                                            'timestamp': utils.timestamp(),
-                                        }))
-
-                    # external urls
-                    if not URLREGEX.findall(reply.comment):
-                        continue
-
-                    for found in URLREGEX.findall(cleaned_comment):
-                        for url in found:
-                            if url:
-                                external_urls_file.write('{}\n'.format(url))
-
-            # dump 4chan json file, pretty printed
-            local_filename = os.path.join(thread_dir, '{}.json'.format(thread_id))
-            url = http_header + FOURCHAN_API_URL % (board_name, thread_id)
-            utils.download_json(local_filename, url, clobber=True)
-
-            # and output thread html file
-            local_filename = os.path.join(thread_dir, '{}.html'.format(thread_id))
-            url = http_header + FOURCHAN_BOARDS_URL % (board_name, thread_id)
-
-            if utils.download_file(local_filename, url, clobber=True):
-                # get css files
-                if not self.options.skip_css:
-                    css_dir = os.path.join(thread_dir, _CSS_DIR_NAME)
-                    utils.mkdirs(css_dir)
-
-                    css_regex = re.compile(FOURCHAN_CSS_REGEX)
-                    found_css_files = css_regex.findall(codecs.open(local_filename, encoding='utf-8').read())
-                    for css_filename in found_css_files:
-                        local_css_filename = os.path.join(css_dir, css_filename)
-                        url = http_header + FOURCHAN_STATIC + '/css/' + css_filename
-                        utils.download_file(local_css_filename, url)
-
-                # get js files
-                if not self.options.skip_js:
-                    js_dir = os.path.join(thread_dir, _JS_DIR_NAME)
-                    utils.mkdirs(js_dir)
-
-                    js_regex = re.compile(FOURCHAN_JS_REGEX)
-                    found_js_files = js_regex.findall(codecs.open(local_filename, encoding='utf-8').read())
-                    for js_filename in found_js_files:
-                        local_js_filename = os.path.join(js_dir, js_filename)
-                        url = http_header + FOURCHAN_STATIC + '/js/' + js_filename
-                        utils.download_file(local_js_filename, url)
-
-                # convert links to local links
-                utils.file_replace(local_filename, '"//', '"' + http_header)
-                utils.file_replace(local_filename, FOURCHAN_IMAGES_URL_REGEX, _IMAGE_DIR_NAME + r'/\1')
-                utils.file_replace(local_filename, FOURCHAN_THUMBS_URL_REGEX, _THUMB_DIR_NAME + r'/\1')
-                utils.file_replace(local_filename, FOURCHAN_CSS_URL_REGEX, _CSS_DIR_NAME + '/')
-                utils.file_replace(local_filename, FOURCHAN_JS_URL_REGEX, _JS_DIR_NAME + '/')
+            # record external urls and follow child threads, only looking at new posts
+            last_scanned = thread.get('last_scanned_post', 0)
+            new_posts = []
+            for post in reversed(thread['thread'].posts):
+                if post.post_id <= last_scanned:
+                    break
+                new_posts.append(post)
+            new_posts.reverse()
+
+            if new_posts or not last_scanned:
+                with self.threads_lock:
+                    if new_posts:
+                        thread['last_scanned_post'] = new_posts[-1].post_id
+                external_urls_filename = os.path.join(thread_dir, EXT_LINKS_FILENAME)
+                comments = [post.comment for post in new_posts if post.comment is not None]
+                self._postprocess(item, scan_posts,
+                                  (external_urls_filename, comments, bool(last_scanned),
+                                   self.options.follow_child_threads),
+                                  callback=lambda children: self._follow_children(item, children),
+                                  key=external_urls_filename)
+
+            # dump 4chan json file
+            self._save_thread_json(item, thread_dir, json_url)
 
             # add images to dl queue
-            for filename in thread['thread'].filenames():
-                self.add_to_dl(dl_type='image', board=board_name, thread_id=thread_id, filename=filename)
+            images_dir = self.base_images_dir.format(board=board_name, thread=thread_id)
+            for post in thread['thread'].posts:
+                if not post.has_file or self._have_file(os.path.join(images_dir, post.file.filename)):
+                    continue
+                self.add_to_dl(dl_type='image', board=board_name, thread_id=thread_id, filename=post.file.filename,
+                               md5=post.file.file_md5_hex, fsize=post.file.file_size, posted=post.timestamp)
 
             # add thumbs to dl queue
-            for filename in thread['thread'].thumbnames():
-                self.add_to_dl(dl_type='thumb', board=board_name, thread_id=thread_id, filename=filename)
-
-            # queue for next dl if thread is still alive
+            thumbs_dir = self.base_thumbs_dir.format(board=board_name, thread=thread_id)
+            for post in thread['thread'].posts:
+                if not post.has_file:
+                    continue
+                if self._have_file(os.path.join(thumbs_dir, post.file.thumbnail_fname), thumb=True):
+                    continue
+                self.add_to_dl(dl_type='thumb', board=board_name, thread_id=thread_id,
+                               filename=post.file.thumbnail_fname, md5=post.file.file_md5_hex, posted=post.timestamp,
+                               thumb_size=(post.file.thumbnail_width, post.file.thumbnail_height))
+
+            # the page is its own item, so if it fails it's retried without holding up the media
+            self.add_to_dl(dl_type='page', board=board_name, thread_id=thread_id)
+
+            # wait for changes if thread is still alive
             if thread['alive'] and not self.options.run_once:
-                item.delay_dl_timestamp(self.options.thread_check_delay)
-                self.add_to_dl(item=item)
+                self._park_thread(item)
 
             with self.threads_lock:
                 if self.options.run_once:
@@ -5,18 +5,17 @@ from __future__ import print_function
 from __future__ import absolute_import
 
 from .base import BaseSiteArchiver
-from .. import utils
+from .. import postprocess, storage, utils
 
 #from . import pyfuuka
 import pyfuuka
 from bs4 import BeautifulSoup
+from bs4.builder import builder_registry
 
 import sys
 import os
 import re
-import codecs
 import threading
-import json as Json
 from urllib.parse import urlparse
 
 THREAD_NONEXISTENT = 'Thread {site} / {board} / {thread_id} does not exist.'
@@ -85,20 +84,133 @@ _CSS_DIR_NAME = 'css'
 _JS_DIR_NAME = 'js'
 EXT_LINKS_FILENAME = 'external_links.txt'
 
-# The Ultimate URL Regex
-# http://stackoverflow.com/questions/520031/whats-the-cleanest-way-to-extract-urls-from-a-string-using-python
-URLREGEX = re.compile(r"""((?:[a-z][\w-]+:(?:/{1,3}|[a-z0-9%])|www\d{0,3}[.]|[a-z0-9.\-]+[.‌​][a-z]{2,4}/)(?:[^\s()<>]+|(([^\s()<>]+|(([^\s()<>]+)))*))+(?:(([^\s()<>]+|(‌​([^\s()<>]+)))*)|[^\s`!()[]{};:'".,<>?«»“”‘’]))""", re.DOTALL)
-
 HTTP_HEADER = "https://"
 API_HEADER = "/_/api/chan/"
 API_TYPE = "post/"
 API_QUERY = "?board=%s&num=%s"
-BACKLINK_REGEX = r"""(<a *.*class="backlink"*.>*).*?(<\/a>)"""
+BACKLINK_REGEX = re.compile(r"""(<a *.*class="backlink"*.>*).*?(<\/a>)""")
+MEDIA_EXTENSIONS = ('gif', 'png', 'jpg', 'jpeg', 'webm')
+
+
+class FuukaPageLocaliser(object):
+    """Converts links in a FoolFuuka thread page to local links.
+
+    Anchors, images, stylesheets and scripts are all rewritten in a single
+    pass over the page's tags. The CSS and JS files the page uses are
+    collected as (url, filename) pairs, for the caller to download.
+    """
+
+    def __init__(self, http_header, domain, skip_css=False, skip_js=False, html_parser='html.parser'):
+        self.http_header = http_header
+        self.domain = domain
+        self.skip_css = skip_css
+        self.skip_js = skip_js
+        self.html_parser = html_parser
+        self.css_files = []
+        self.js_files = []
+
+    def localise(self, contents):
+        """Return the given page HTML with its links made local."""
+        soup = BeautifulSoup(contents, features=self.html_parser)
+
+        for tag in soup.find_all(('a', 'img', 'link', 'script')):
+            if tag.name == 'a':
+                self._localise_anchor(tag)
+            elif tag.name == 'img':
+                url = tag.get('src')
+                if url and 'http' in url:
+                    tag['src'] = os.path.join(_THUMB_DIR_NAME, os.path.basename(url))
+            elif tag.name == 'link':
+                if not self.skip_css and tag.get('href') and 'stylesheet' in tag.get('rel', ()):
+                    self._localise_css(tag)
+            elif not self.skip_js and tag.get('src'):
+                self._localise_js(tag)
+
+        return str(soup)
+
+    def _localise_anchor(self, tag):
+        url = tag.get('href')
+        if not url:
+            return
+        if any(extension in url for extension in MEDIA_EXTENSIONS):
+            if 'thumb' in url:
+                url = os.path.join(_THUMB_DIR_NAME, os.path.basename(url))
+            else:
+                url = os.path.join(_IMAGE_DIR_NAME, os.path.basename(url))
+        if url != '#' and '#' in url:
+            url = os.path.basename(url)
+        tag['href'] = url
+
+    def _localise_css(self, tag):
+        url = tag['href']
+        css_filename = os.path.basename(url)
+        self.css_files.append((url, css_filename))
+        tag['href'] = os.path.join(_CSS_DIR_NAME, css_filename)
+
+    def _localise_js(self, tag):
+        url = tag['src']
+        if self.domain not in url and 'ajax' not in url:
+            return
+        url = url.lstrip('/')
+        if 'http' not in url:
+            if 'ajax' not in url:
+                url = self.http_header + self.domain + '/' + url
+            else:
+                url = self.http_header + url
+        js_filename = os.path.basename(url)
+        self.js_files.append((url, js_filename))
+        tag['src'] = os.path.join(_JS_DIR_NAME, js_filename)
+
+
+def localise_page(local_filename, http_header, domain, skip_css=False, skip_js=False, html_parser='html.parser'):
+    """Convert the links in a downloaded thread page to local links.
+
+    Returns the (url, filename) of the CSS and JS files the page uses. Runs
+    as a post-processing job.
+    """
+    contents = storage.files.read(local_filename).decode('utf-8')
+
+    localiser = FuukaPageLocaliser(http_header, domain, skip_css=skip_css, skip_js=skip_js, html_parser=html_parser)
+    contents = localiser.localise(contents)
+
+    storage.files.write(local_filename, contents.encode('utf-8'))
+    return localiser.css_files, localiser.js_files
+
+
+def scan_posts(external_urls_filename, comments, append=False, find_children=False):
+    """Record the external urls in the given post comments.
+
+    Returns the (board, thread id) of the threads the comments link to, if
+    find_children is set. Runs as a post-processing job.
+    """
+    children = []
+    urls = []
+    for comment in comments:
+        # 4chan puts <wbr> in middle of urls for word break, remove them
+        cleaned_comment = comment.replace('<wbr>', '')
+        cleaned_comment = BACKLINK_REGEX.sub('', cleaned_comment)
+
+        if find_children:
+            for child_board, child_id in CHILDREGEX.findall(cleaned_comment):
+                children.append((child_board, int(child_id)))
+
+        for url in utils.find_urls(cleaned_comment):
+            urls.append('{}\n'.format(url))
+
+    output = ''.join(urls).encode('utf-8')
+    if append:
+        storage.files.append(external_urls_filename, output)
+    else:
+        storage.files.write(external_urls_filename, output)
+    return children
+
 
 class FuukaSiteArchiver(BaseSiteArchiver):
     name = 'fuuka'
 
     def __init__(self, callback_handler, options):
+        if builder_registry.lookup(options.html_parser) is None:
+            raise Exception('HTML parser {} is not installed'.format(options.html_parser))
         BaseSiteArchiver.__init__(self, callback_handler, options)
 
         self.boards_lock = threading.Lock()
@@ -112,6 +224,12 @@ class FuukaSiteArchiver(BaseSiteArchiver):
         self.url_info = self._url_parse(url)
         return len(self.url_info) == 3 and self.url_info[2].isdigit()
 
+    def item_host(self, item):
+        """Return the host the given item is downloaded from."""
+        if 'fileurl' in item.info:
+            return urlparse(item.info['fileurl']).netloc
+        return self.name
+
     def _url_info(self, url):
         """INTERNAL: Takes a url, returns board name, thread info."""
         if self.url_valid(url):
@@ -137,6 +255,24 @@ class FuukaSiteArchiver(BaseSiteArchiver):
         thread_id = int(thread_id)
         return self._add_thread_from_info(board_name, domain_name, thread_id)
 
+    def _board(self, board_name, domain_name):
+        """INTERNAL: Return the running board object, boards_lock must be held.
+
+        Its requests go through our shared session for the domain, so they
+        get its connection pool, DNS cache and rate limiting.
+        """
+        if board_name not in self.boards:
+            session = utils.sessions.session(domain_name)
+            try:
+                board = pyfuuka.Board(board_name, domain_name, https=self.options.use_ssl, session=session)
+            except TypeError:
+                # versions of pyfuuka that don't take a session, swap theirs out
+                board = pyfuuka.Board(board_name, domain_name, https=self.options.use_ssl)
+                if hasattr(board, '_requests_session'):
+                    board._requests_session = session
+            self.boards[board_name] = board
+        return self.boards[board_name]
+
     def _add_thread_from_info(self, board_name, domain_name, thread_id):
         """Add a thread to our internal list from direct board name/thread id."""
         # already exists
@@ -146,44 +282,124 @@ class FuukaSiteArchiver(BaseSiteArchiver):
 
         # running board object
         with self.boards_lock:
-            if board_name not in self.boards:
-                self.boards[board_name] = pyfuuka.Board(board_name, domain_name,
-                                                             https=self.options.use_ssl)
-            running_board = self.boards[board_name]
+            running_board = self._board(board_name, domain_name)
 
-            if not running_board.thread_exists(thread_id):
-                print(THREAD_NONEXISTENT.format(**{
-                    'site': self.name,
-                    'board': board_name,
-                    'thread_id': thread_id,
-                }))
-                print(THREAD_NONEXISTENT_REASON)
-                return False
+        if not running_board.thread_exists(thread_id):
+            print(THREAD_NONEXISTENT.format(**{
+                'site': self.name,
+                'board': board_name,
+                'thread_id': thread_id,
+            }))
+            print(THREAD_NONEXISTENT_REASON)
+            return False
 
         # add thread to download list
         with self.threads_lock:
-            self.threads[thread_id] = {
-                'board': board_name,
-                'dir': self.base_thread_dir.format(board=board_name, thread=thread_id),
-                'thread_id': thread_id,
-                'total_files': 0,
-                'images_downloaded': 0,
-                'thumbs_downloaded': 0,
-                'alive': True,
-            }
-            status_info = self.threads[thread_id]
+            status_info = self.threads.add(board_name, thread_id,
+                                           self.base_thread_dir.format(board=board_name, thread=thread_id))
         self.update_status('new_thread', info=status_info)
 
         self.add_to_dl('thread', board=board_name, thread_id=thread_id)
         return True
 
+    def _drop_thread(self, record):
+        """INTERNAL: Let go of a dead thread's posts, including the board's cached copy."""
+        with self.boards_lock:
+            running_board = self.boards.get(record.board)
+        if running_board is not None:
+            # the library keeps every thread it's fetched, and only forgets ones that 404
+            running_board._thread_cache.pop(record.thread_id, None)
+        BaseSiteArchiver._drop_thread(self, record)
+
+    def thread_summary(self, thread):
+        """Return the details of the given thread object that go in its metadata and board index."""
+        # topic isn't in posts here, unlike with 4chan
+        topic = thread.topic
+        last_post = thread.posts[-1] if thread.posts else topic
+        return {
+            'subject': getattr(topic, 'subject', None),
+            'name': getattr(topic, 'name', None),
+            'created': getattr(topic, 'timestamp', None),
+            'last_post': getattr(last_post, 'timestamp', None),
+            'replies': len(thread.posts),
+        }
+
+    def _follow_children(self, item, domain, children):
+        """INTERNAL: Queue up the child threads found in a thread.
+
+        This is a post-processing callback, so checking the children exist
+        is left to the download threads.
+        """
+        board_name = item.info['board']
+        for child_board, child_id in sorted(set(children)):
+            if child_id in self.threads:
+                continue
+            if self.options.follow_to_other_boards or child_board == board_name:
+                self.add_to_dl(dl_type='child', board=board_name, thread_id=item.info['thread_id'], domain=domain,
+                               child_board=child_board, child_id=child_id)
+
+    def _add_child(self, item):
+        """INTERNAL: Add a child thread, if it exists."""
+        child_board = item.info['child_board']
+        child_id = item.info['child_id']
+        if self._add_thread_from_info(child_board, item.info['domain'], child_id):
+            print(THREAD_CHILD_FOUND.format(**{
+                'site': self.name,
+                'board': child_board,
+                'thread_id': child_id,
+                'timestamp': utils.timestamp(),
+            }))
+
+    def _queue_page_files(self, item, css_files, js_files):
+        """INTERNAL: Queue up the CSS and JS files used by a thread page.
+
+        This is a post-processing callback, so the downloads are left to the
+        download threads.
+        """
+        thread_dir = self.base_thread_dir.format(board=item.info['board'], thread=item.info['thread_id'])
+        for files_dir, page_files in ((_CSS_DIR_NAME, css_files), (_JS_DIR_NAME, js_files)):
+            for url, filename in page_files:
+                self.add_to_dl(dl_type='page_file', board=item.info['board'], thread_id=item.info['thread_id'],
+                               fileurl=url, filename=os.path.join(thread_dir, files_dir, filename))
+
+    def _download_page(self, item, http_header):
+        """INTERNAL: Save the thread's HTML page, its links are made local afterwards."""
+        board_name = item.info['board']
+        thread_id = item.info['thread_id']
+        thread_dir = self.base_thread_dir.format(board=board_name, thread=thread_id)
+        local_filename = os.path.join(thread_dir, '{}.html'.format(thread_id))
+
+        # two polls can queue a page each, don't let them write it at the same time
+        with self._thread_lock(thread_id):
+            if not utils.download_file(local_filename, item.info['fileurl'], clobber=True):
+                # a page we already have is just unchanged (304), and has been localised already
+                if not storage.files.exists(local_filename):
+                    print("index.html could not be opened!")
+                return
+        self._postprocess(item, localise_page, (local_filename, http_header, item.info['domain'],
+                                                self.options.skip_css, self.options.skip_js,
+                                                self.options.html_parser),
+                          callback=lambda files: self._queue_page_files(item, *files),
+                          key=local_filename)
+
     def download_item(self, item):
         """Download the given item."""
         http_header = ('https://' if self.options.use_ssl else 'http://')
-        imgs = ['gif','png','jpg','jpeg','webm']
-        
+
+        # thread html page
+        if item.dl_type == 'page':
+            self._download_page(item, http_header)
+
+        # css and js used by the page
+        elif item.dl_type == 'page_file':
+            utils.download_file(item.info['filename'], item.info['fileurl'])
+
+        # threads linked from a thread
+        elif item.dl_type == 'child':
+            self._add_child(item)
+
         # images
-        if item.dl_type == 'image':
+        elif item.dl_type == 'image':
             if self.options.thumbs_only:
                 return True
             
@@ -200,9 +416,9 @@ class FuukaSiteArchiver(BaseSiteArchiver):
             file_url = item.info['fileurl'] # http_header + FOURCHAN_IMAGES_URL % (board_name, filename)
             file_path = os.path.join(images_dir, filename)
 
-            if not os.path.exists(file_path):
+            if not self._have_file(file_path):
                 utils.mkdirs(images_dir)
-                if utils.download_file(file_path, file_url):
+                if self._download_media(file_path, file_url, item.info.get('md5'), size=item.info.get('fsize')):
                     with self.threads_lock:
                         self.threads[thread_id]['images_downloaded'] += 1
                         status_info = self.threads[thread_id]
@@ -230,9 +446,8 @@ class FuukaSiteArchiver(BaseSiteArchiver):
             file_url = item.info['fileurl'] # http_header + FOURCHAN_THUMBS_URL % (board_name, filename)
             file_path = os.path.join(thumbs_dir, filename)
 
-            if not os.path.exists(file_path):
-                utils.mkdirs(thumbs_dir)
-                if utils.download_file(file_path, file_url):
+            if not self._have_file(file_path, thumb=True):
+                if self._download_media(file_path, file_url, item.info.get('md5'), thumb=True):
                     with self.threads_lock:
                         self.threads[thread_id]['thumbs_downloaded'] += 1
                         status_info = self.threads[thread_id]
@@ -258,7 +473,7 @@ class FuukaSiteArchiver(BaseSiteArchiver):
             self.update_status('thread_start_download', info=status_info)
 
             thread = self.threads[thread_id]
-            with self.boards_lock:
+            with self._thread_lock(thread_id):
                 # skip if no new posts
                 if 'thread' in thread:
                     new_replies = thread['thread'].update()
@@ -273,20 +488,10 @@ class FuukaSiteArchiver(BaseSiteArchiver):
                             status_info = self.threads[thread_id]
                         self.update_status('archived', info=status_info)
                         self.threads[thread_id]['alive'] = False
-                        return True
-                    elif new_replies < 1:
-                        # skip if no new posts
-                        item.delay_dl_timestamp()
-
-                        with self.threads_lock:
-                            status_info = self.threads[thread_id]
-                        status_info['next_dl'] = item.next_dl_timestamp
-                        self.update_status('thread_dl', info=status_info)
-
-                        self.add_to_dl(item=item)
+                        self.threads[thread_id]['ended'] = 'archived'
                         return True
                     elif thread['thread'].is_404:
-                        # thread 404'd
+                        # thread 404'd, update() returns 0 for these too so check first
                         print(THREAD_404.format(**{
                             'site': self.name,
                             'board': board_name,
@@ -297,6 +502,18 @@ class FuukaSiteArchiver(BaseSiteArchiver):
                             status_info = self.threads[thread_id]
                         self.update_status('404', info=status_info)
                         self.threads[thread_id]['alive'] = False
+                        self.threads[thread_id]['ended'] = '404'
+                        return True
+                    elif new_replies < 1:
+                        # skip if no new posts
+                        item.delay_dl_timestamp()
+
+                        with self.threads_lock:
+                            status_info = self.threads[thread_id]
+                        status_info['next_dl'] = item.next_dl_timestamp
+                        self.update_status('thread_dl', info=status_info)
+
+                        self.add_to_dl(item=item)
                         return True
                     else:
                         with self.threads_lock:
@@ -323,6 +540,7 @@ class FuukaSiteArchiver(BaseSiteArchiver):
                             status_info = self.threads[thread_id]
                         self.update_status('archived', info=status_info)
                         self.threads[thread_id]['alive'] = False
+                        self.threads[thread_id]['ended'] = 'archived'
 
             # thread
             if not self.options.silent:
@@ -336,158 +554,60 @@ class FuukaSiteArchiver(BaseSiteArchiver):
 
             utils.mkdirs(thread_dir)
 
-            # record external urls and follow child threads
-            external_urls_filename = os.path.join(thread_dir, EXT_LINKS_FILENAME)
-            with codecs.open(external_urls_filename, 'w', encoding='utf-8') as external_urls_file:
-                # all posts, including topic
-                all_posts = [thread['thread'].topic] + thread['thread'].posts
-                for reply in all_posts:
-                    rep = reply.html_comment
-                    if rep is None:
-                        continue
-
-                    #a = REG.findall(rep)
-                    #regx = ''.join(str(v) for v in a)
-                    # 4chan puts <wbr> in middle of urls for word break, remove them
-                    cleaned_comment = re.sub(r'\<wbr\>', '', rep)
-                    cleaned_comment = re.sub(BACKLINK_REGEX, '', cleaned_comment)
-
-                    # child threads
-                    if self.options.follow_child_threads:
-                        for child_board, child_id in CHILDREGEX.findall(cleaned_comment):
-                            is_same_board = child_board == board_name
-                            child_id = int(child_id)
-
-                            if child_id not in self.threads:
-                                if self.options.follow_to_other_boards or is_same_board:
-                                    if self._add_thread_from_info(child_board, thread['thread'].domain, child_id):
-                                        print(THREAD_CHILD_FOUND.format(**{
-                                            'site': self.name,
-                                            'board': child_board,
-                                            'thread_id': child_id,
-                                            'timestamp': utils.timestamp(),
-                                        }))
-
-                    # external urls
-                    #if not URLREGEX.findall(reply.comment):
-                    #    continue
-
-                    for found in URLREGEX.findall(cleaned_comment):
-                        for url in found:
-                            if url:
-                                external_urls_file.write('{}\n'.format(url))
-
-            # dump fuuka json file, pretty printed
-            local_filename = os.path.join(thread_dir, '{}.json'.format(thread_id))
-            with open(local_filename, 'w', encoding="utf-8") as json_file:
-                Json.dump(thread['thread'].json, json_file, sort_keys=True, indent=4) # Reuse json gotten from beginning
-            #url = http_header + FOURCHAN_API_URL % (board_name, thread_id)
-            #utils.download_json(local_filename, url, clobber=True)
-
-            # and output thread html file
+            # record external urls and follow child threads, only looking at new posts
             domain = thread['thread'].domain
-            local_filename = os.path.join(thread_dir, '{}.html'.format(thread_id))
-            url = http_header + domain +  FOURCHAN_BOARDS_FOOTER % (board_name, thread_id)
-            #fuuka_css = """.*link.*href=["|\']?(.*[\\\|\/]?.*)\.css["|\']?.*"""
-            #fuuka_remove_comment = """(<!--[\s\S]*?-->)"""
-            downloaded_html = False
-            
-            if utils.download_file(local_filename, url, clobber=True):
-                
-                contents = codecs.open(local_filename, encoding='utf-8').read()
-                soup = BeautifulSoup(contents, features="html.parser")
-                downloaded_html = True
-                
-                # get css files
-                if not self.options.skip_css:
-                    css_dir = os.path.join(thread_dir, _CSS_DIR_NAME)
-                    utils.mkdirs(css_dir)
-                    
-                    for tag in soup.find_all('link', rel="stylesheet", href=True):
-                        url = tag['href']
-                        css_filename = os.path.basename(url)
-                        local_css_filename = os.path.join(_CSS_DIR_NAME, css_filename)
-                        utils.download_file(os.path.join(css_dir,css_filename), url)
-                        tag['href'] = local_css_filename # Applies CSS changes to html
-                        #print(local_css_filename)
-                        
-                    #css_regex = re.compile(FOURCHAN_CSS_REGEX)
-                    #found_css_files = css_regex.findall(codecs.open(local_filename, encoding='utf-8').read())
-                    #for css_filename in found_css_files:
-                    #    local_css_filename = os.path.join(css_dir, css_filename)
-                    #    url = http_header + FOURCHAN_STATIC + '/css/' + css_filename
-                    #    utils.download_file(local_css_filename, url)
-
-                # get js files
-                if not self.options.skip_js:
-                    js_dir = os.path.join(thread_dir, _JS_DIR_NAME)
-                    utils.mkdirs(js_dir)
-                    
-                    for tag in soup.find_all('script'):
-                        url = tag.get('src')
-                        if url and (domain in url or "ajax" in url):
-                            while '/' in url[0]:
-                                url = tag.get('src').lstrip('/')
-                            if "http" not in url :
-                                if "ajax" not in url:
-                                    url = http_header + domain + "/" + url
-                                else:
-                                    url = http_header +  url
-                            js_filename = os.path.basename(url)
-                            local_js_filename = os.path.join(_JS_DIR_NAME, js_filename)
-                            utils.download_file(os.path.join(js_dir,js_filename), url) # js_filename[:js_filename.index('.js')+len('.js')] Remove JS api queries attached to filename
-                            tag['src'] = local_js_filename # Applies JS changes to html
-                            #print(local_js_filename)
-
-                    #js_regex = re.compile(FOURCHAN_JS_REGEX)
-                    #found_js_files = js_regex.findall(codecs.open(local_filename, encoding='utf-8').read())
-                    #for js_filename in found_js_files:
-                    #    local_js_filename = os.path.join(js_dir, js_filename)
-                    #    url = http_header + FOURCHAN_STATIC + '/js/' + js_filename
-                    #    utils.download_file(local_js_filename, url)
-
-                # convert links to local links
-                #utils.file_replace(local_filename, '"//', '"' + http_header)
-                #utils.file_replace(local_filename, FOURCHAN_IMAGES_URL_REGEX, _IMAGE_DIR_NAME + r'/\1')
-                #utils.file_replace(local_filename, FOURCHAN_THUMBS_URL_REGEX, _THUMB_DIR_NAME + r'/\1')
-                #utils.file_replace(local_filename, FOURCHAN_CSS_URL_REGEX, _CSS_DIR_NAME + '/')
-                #utils.file_replace(local_filename, FOURCHAN_JS_URL_REGEX, _JS_DIR_NAME + '/')
+            # all posts, including topic
+            all_posts = [thread['thread'].topic] + thread['thread'].posts
+            last_scanned = thread.get('last_scanned_post', 0)
+            new_posts = []
+            for post in reversed(all_posts):
+                # FoolFuuka gives post numbers as strings
+                if int(post.post_id) <= last_scanned:
+                    break
+                new_posts.append(post)
+            new_posts.reverse()
+
+            if new_posts or not last_scanned:
+                with self.threads_lock:
+                    if new_posts:
+                        thread['last_scanned_post'] = int(new_posts[-1].post_id)
+                external_urls_filename = os.path.join(thread_dir, EXT_LINKS_FILENAME)
+                comments = [reply.html_comment for reply in new_posts if reply.html_comment is not None]
+                self._postprocess(item, scan_posts,
+                                  (external_urls_filename, comments, bool(last_scanned),
+                                   self.options.follow_child_threads),
+                                  callback=lambda children: self._follow_children(item, domain, children),
+                                  key=external_urls_filename)
+
+            # dump fuuka json file
+            local_filename = os.path.join(thread_dir, '{}.json'.format(thread_id))
+            # reuse json gotten from beginning
+            self._postprocess(item, postprocess.write_json,
+                              (local_filename, thread['thread'].json, self.options.pretty_json, 4),
+                              key=local_filename)
 
             # add images to dl queue
+            images_dir = self.base_images_dir.format(board=board_name, thread=thread_id)
             for file in thread['thread'].file_objects():
-                self.add_to_dl(dl_type='image', board=board_name, thread_id=thread_id, filename=os.path.basename(file.file_url), fileurl = file.file_url)
-                for tag in soup.find_all('a',  href=True):
-                    url = tag['href']
-                    if any(img in url for img in imgs):
-                        if "thumb" in url:
-                            tag['href'] = os.path.join(_THUMB_DIR_NAME, os.path.basename(url))
-                        else:
-                            tag['href'] = os.path.join(_IMAGE_DIR_NAME, os.path.basename(url))
-        
+                if not self._have_file(os.path.join(images_dir, os.path.basename(file.file_url))):
+                    self.add_to_dl(dl_type='image', board=board_name, thread_id=thread_id, filename=os.path.basename(file.file_url), fileurl = file.file_url,
+                                   md5=getattr(file, 'file_md5_hex', None), fsize=getattr(file, 'file_size', None))
+
             # add thumbs to dl queue
+            thumbs_dir = self.base_thumbs_dir.format(board=board_name, thread=thread_id)
             for file in thread['thread'].file_objects():
-                self.add_to_dl(dl_type='thumb', board=board_name, thread_id=thread_id, filename=os.path.basename(file.thumbnail_url), fileurl = file.thumbnail_url)
-                for tag in soup.findAll('img'):
-                    url = tag.get('src')
-                    if "http" in url:
-                        tag['src'] = os.path.join(_THUMB_DIR_NAME, os.path.basename(url))
-        
+                if not self._have_file(os.path.join(thumbs_dir, os.path.basename(file.thumbnail_url)), thumb=True):
+                    self.add_to_dl(dl_type='thumb', board=board_name, thread_id=thread_id, filename=os.path.basename(file.thumbnail_url), fileurl = file.thumbnail_url,
+                                   md5=getattr(file, 'file_md5_hex', None))
+
+            # the page is its own item, so if it fails it's retried without holding up the media
+            url = http_header + domain + FOURCHAN_BOARDS_FOOTER % (board_name, thread_id)
+            self.add_to_dl(dl_type='page', board=board_name, thread_id=thread_id, domain=domain, fileurl=url)
+
             # queue for next dl if thread is still alive
             if thread['alive'] and not self.options.run_once:
                 item.delay_dl_timestamp(self.options.thread_check_delay)
                 self.add_to_dl(item=item)
-            
-            # convert links to local links
-            if downloaded_html and soup:
-                print("Found index.html. Converting links to local links...")
-                for link in soup.find_all('a',  href=True):
-                    url = link['href']
-                    if url and url != "#" and "#" in url:
-                        link['href'] = os.path.basename(url)
-                with open(local_filename, "w", encoding='utf-8') as file:
-                    file.write(str(soup))
-            else:
-                print("index.html could not be opened!")
 
             with self.threads_lock:
                 if self.options.run_once:
@@ -0,0 +1,402 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# BASC Imageboard Archiver Storage Backends
+from __future__ import absolute_import
+from __future__ import print_function
+import io
+import os
+import struct
+import threading
+
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+
+DEFAULT_SEGMENT_SIZE = 256 * 1024 * 1024
+PACK_INDEX_FILENAME = 'index'
+PACK_SEGMENT_FILENAME = 'segment-{:05d}.pack'
+PACK_LOCK_FILENAME = 'lock'
+THUMB_PACK_DIRNAME = 'thumbs.pack'
+
+
+_known_dirs = set()
+
+
+def mkdirs(path):
+    """Make directory, if it doesn't exist."""
+    # skip the stat for folders we've already made
+    if path in _known_dirs:
+        return
+    try:
+        if not os.path.exists(path):
+            os.makedirs(path)
+    except OSError:  # folder exists, due to multithreading
+        pass
+    _known_dirs.add(path)
+
+
+def lock_file(filename, wait=True):
+    """Take an exclusive lock on filename, creating it if needed, and return the open lock file.
+
+    The lock is held until the returned file is closed. If wait is False
+    and another process holds the lock, returns None instead. Where we
+    can't lock files (windows), we don't.
+    """
+    lock = open(filename, 'a')
+    if fcntl is not None:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            lock.close()
+            if wait:
+                raise
+            return None
+    return lock
+
+
+class DirectoryStorage(object):
+    """Stores every file as itself, at its path on the local filesystem.
+
+    This is the usual archive layout. Storage backends all take the same
+    local paths, so the site archivers don't care which one they're using.
+    """
+
+    def exists(self, path):
+        """Return whether the given file is stored."""
+        return os.path.exists(path)
+
+    def size(self, path):
+        """Return the size of the given stored file."""
+        return os.path.getsize(path)
+
+    def read(self, path):
+        """Return the contents of the given stored file."""
+        with open(path, 'rb') as stored_file:
+            return stored_file.read()
+
+    def writer(self, path, resume=False):
+        """Return a writer for the given file, see FileWriter."""
+        return FileWriter(path, resume)
+
+    def write(self, path, data):
+        """Store the given bytes as the given file, replacing it in one go."""
+        with self.writer(path) as output:
+            output.write(data)
+            output.commit()
+
+    def append(self, path, data):
+        """Add the given bytes onto the end of the given file."""
+        mkdirs(os.path.dirname(path))
+        with open(path, 'ab') as stored_file:
+            stored_file.write(data)
+
+    def paths(self, folder):
+        """Return the paths of the files stored in the given folder."""
+        if not os.path.isdir(folder):
+            return []
+        return sorted(os.path.join(folder, filename) for filename in os.listdir(folder))
+
+
+class FileWriter(object):
+    """Writes a file into a .part file, which is moved into place on commit.
+
+    With resume, an existing .part file is added to rather than replaced,
+    offset says how much of it there already is. A writer that's closed
+    without being committed keeps its .part file if resuming, so the next
+    attempt can carry on from it.
+    """
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.part_path = '{}.part'.format(path)
+        self.resume = resume
+        mkdirs(os.path.dirname(path))
+
+        self.offset = 0
+        if resume and os.path.exists(self.part_path):
+            self.offset = os.path.getsize(self.part_path)
+        self._file = open(self.part_path, 'ab' if self.offset else 'wb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def size(self):
+        """Return how many bytes the file has so far, including the offset."""
+        return self._file.tell()
+
+    def write(self, data):
+        self._file.write(data)
+
+    def commit(self):
+        """Move the finished file into place."""
+        self._file.close()
+        os.replace(self.part_path, self.path)
+
+    def restart(self):
+        """Throw away what we've written, and start the file again."""
+        self._file.seek(0)
+        self._file.truncate()
+        self.offset = 0
+
+    def discard(self):
+        """Throw away what we've written."""
+        self._file.close()
+        if os.path.exists(self.part_path):
+            os.remove(self.part_path)
+
+    def close(self):
+        if self._file.closed:
+            return
+        if self.resume and self.size:
+            self._file.close()
+        else:
+            self.discard()
+
+
+class PackStorage(object):
+    """Stores files back to back in large, append-only segment files.
+
+    Meant for huge numbers of small files like thumbnails, which would
+    otherwise take an inode and a directory entry each. Files are keyed on
+    their path relative to root. Each stored file's segment, offset and size
+    goes in an index file, appended after the file's data is written, so a
+    crash can only ever lose the file being stored. Storing a path again
+    adds a new copy, and the index points at the newest one.
+
+    Only one process can write to a pack at a time, the writer holds a lock
+    on the pack until it's closed. Others can open it read_only to look at
+    what was in it when they opened it.
+    """
+
+    INDEX_ENTRY = struct.Struct('<IQIH')  # segment, offset, size, key length
+
+    def __init__(self, pack_dir, root, segment_size=DEFAULT_SEGMENT_SIZE, read_only=False):
+        self.pack_dir = pack_dir
+        self.root = root
+        self._root_prefix = os.path.join(os.path.abspath(root), '')
+        self.segment_size = int(segment_size)
+        self.read_only = read_only
+        self._lock = threading.Lock()
+        self._folders = {}  # folder key -> {filename: (segment, offset, size)}
+        self._count = 0
+        self._readers = {}  # segment -> open file
+        self._segment = 0
+        self._segment_file = None
+        self._index_file = None
+        self._lock_file = None
+
+        index_filename = os.path.join(pack_dir, PACK_INDEX_FILENAME)
+        if read_only:
+            if os.path.exists(index_filename):
+                with open(index_filename, 'rb') as index_file:
+                    self._load_index(index_file.read())
+            return
+
+        mkdirs(pack_dir)
+        self._lock_file = lock_file(os.path.join(pack_dir, PACK_LOCK_FILENAME), wait=False)
+        if self._lock_file is None:
+            raise Exception('Pack {} is in use by another archiver'.format(pack_dir))
+        self._index_file = open(index_filename, 'a+b')
+        self._index_file.seek(0)
+        length = self._load_index(self._index_file.read())
+        # drop an entry that was only partly written
+        self._index_file.truncate(length)
+
+        # carry on with the newest segment
+        self._segment_file = open(self.segment_path(self._segment), 'ab')
+
+    def segment_path(self, segment):
+        """Return the filename of the given segment."""
+        return os.path.join(self.pack_dir, PACK_SEGMENT_FILENAME.format(segment))
+
+    def _load_index(self, data):
+        """INTERNAL: Load index entries from data, returning how much of it was whole entries."""
+        position = 0
+        while position + self.INDEX_ENTRY.size <= len(data):
+            segment, offset, size, key_length = self.INDEX_ENTRY.unpack_from(data, position)
+            key_start = position + self.INDEX_ENTRY.size
+            if key_start + key_length > len(data):
+                break
+            self._add(data[key_start:key_start + key_length].decode('utf-8'), (segment, offset, size))
+            self._segment = max(self._segment, segment)
+            position = key_start + key_length
+        return position
+
+    def _add(self, key, entry):
+        """INTERNAL: Record where a file is stored."""
+        folder, filename = key.rpartition('/')[::2]
+        if folder not in self._folders:
+            self._folders[folder] = {}
+        if filename not in self._folders[folder]:
+            self._count += 1
+        self._folders[folder][filename] = entry
+
+    def _key(self, path):
+        """INTERNAL: Return the index key for the given path."""
+        path = os.path.abspath(path)
+        if path.startswith(self._root_prefix):
+            path = path[len(self._root_prefix):]
+        else:
+            path = os.path.relpath(path, self.root)
+        return path.replace(os.sep, '/')
+
+    def _entry(self, path):
+        """INTERNAL: Return (segment, offset, size) for the given path, or None."""
+        folder, filename = self._key(path).rpartition('/')[::2]
+        return self._folders.get(folder, {}).get(filename)
+
+    def __len__(self):
+        return self._count
+
+    def exists(self, path):
+        """Return whether the given file is stored."""
+        return self._entry(path) is not None
+
+    def size(self, path):
+        """Return the size of the given stored file."""
+        return self._entry(path)[2]
+
+    def read(self, path):
+        """Return the contents of the given stored file."""
+        with self._lock:
+            segment, offset, size = self._entry(path)
+            if segment not in self._readers:
+                self._readers[segment] = open(self.segment_path(segment), 'rb')
+            reader = self._readers[segment]
+            reader.seek(offset)
+            return reader.read(size)
+
+    def writer(self, path, resume=False):
+        """Return a writer for the given file, see PackWriter."""
+        return PackWriter(self, path)
+
+    def write(self, path, data):
+        """Store the given bytes as the given file."""
+        if self.read_only:
+            raise Exception('This pack was opened read-only')
+        key = self._key(path)
+        encoded_key = key.encode('utf-8')
+        with self._lock:
+            offset = self._segment_file.tell()
+            if offset and offset + len(data) > self.segment_size:
+                self._segment_file.close()
+                self._segment += 1
+                self._segment_file = open(self.segment_path(self._segment), 'ab')
+                offset = 0
+
+            self._segment_file.write(data)
+            self._segment_file.flush()
+            self._index_file.write(self.INDEX_ENTRY.pack(self._segment, offset, len(data), len(encoded_key)) +
+                                   encoded_key)
+            self._index_file.flush()
+            self._add(key, (self._segment, offset, len(data)))
+
+    def append(self, path, data):
+        raise Exception('Files in a pack can only be stored whole, not appended to')
+
+    def paths(self, folder):
+        """Return the paths of the files stored in the given folder."""
+        return [path for path, segment_path, offset, size in self.locations(folder)]
+
+    def locations(self, folder):
+        """Return (path, segment filename, offset, size) for the files stored in the given folder.
+
+        Other processes can read the files straight out of the segments with these.
+        """
+        folder_key = self._key(folder).rstrip('/')
+        with self._lock:
+            entries = sorted(self._folders.get(folder_key, {}).items())
+        return [(os.path.join(folder, filename), self.segment_path(segment), offset, size)
+                for filename, (segment, offset, size) in entries]
+
+    def location(self, path):
+        """Return (segment filename, offset, size) for the given stored file, or None."""
+        with self._lock:
+            entry = self._entry(path)
+        if entry is None:
+            return None
+        segment, offset, size = entry
+        return self.segment_path(segment), offset, size
+
+    def all_locations(self):
+        """Return (path, segment filename, offset, size) for every file stored, see locations."""
+        with self._lock:
+            entries = [(folder, filename, entry) for folder, folder_entries in self._folders.items()
+                       for filename, entry in folder_entries.items()]
+        return sorted((os.path.join(self.root, *(folder.split('/') + [filename])), self.segment_path(segment),
+                       offset, size) for folder, filename, (segment, offset, size) in entries)
+
+    def close(self):
+        with self._lock:
+            # the lock goes last, once everything is written
+            for open_file in [self._segment_file, self._index_file] + list(self._readers.values()) + [self._lock_file]:
+                if open_file is not None:
+                    open_file.close()
+
+
+_packs_lock = threading.Lock()
+_packs = {}
+
+
+def open_pack(base_dir):
+    """Return the thumbnail pack for the archive in base_dir, shared by all sites."""
+    base_dir = os.path.abspath(base_dir)
+    with _packs_lock:
+        if base_dir not in _packs:
+            _packs[base_dir] = PackStorage(os.path.join(base_dir, THUMB_PACK_DIRNAME), base_dir)
+        return _packs[base_dir]
+
+
+def read_pack(base_dir):
+    """Return the thumbnail pack for the archive in base_dir as it is now, read-only.
+
+    For tools looking at an archive, which might have an archiver writing to it.
+    """
+    return PackStorage(os.path.join(base_dir, THUMB_PACK_DIRNAME), os.path.abspath(base_dir), read_only=True)
+
+
+class PackWriter(object):
+    """Collects a file in memory, storing it in the pack on commit.
+
+    Files in a pack are small, so there's nothing to resume.
+    """
+
+    def __init__(self, pack, path):
+        self.pack = pack
+        self.path = path
+        self.offset = 0
+        self._buffer = io.BytesIO()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def size(self):
+        return self._buffer.tell()
+
+    def write(self, data):
+        self._buffer.write(data)
+
+    def restart(self):
+        self._buffer = io.BytesIO()
+
+    def commit(self):
+        self.pack.write(self.path, self._buffer.getvalue())
+        self.close()
+
+    def discard(self):
+        self.close()
+
+    def close(self):
+        self._buffer = io.BytesIO()
+
+
+files = DirectoryStorage()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# BASC Imageboard Archiver Rate Limiting
+from __future__ import absolute_import
+from __future__ import print_function
+import collections
+import email.utils
+import threading
+import time
+
+# statuses that mean the server wants us to back off
+BACKOFF_STATUSES = (429, 500, 502, 503, 504)
+
+# circuit breaker
+BREAKER_THRESHOLD = 5  # failures in a row before we stop talking to a host
+BREAKER_COOLDOWN = 30  # seconds, doubles each time it trips again
+BREAKER_MAX_COOLDOWN = 600
+
+
+class HostUnavailable(Exception):
+    """The host's circuit breaker is open, try again at retry_at."""
+
+    def __init__(self, host, retry_at):
+        Exception.__init__(self, 'Host {} unavailable until {}'.format(host, time.ctime(retry_at)))
+        self.host = host
+        self.retry_at = retry_at
+
+
+def parse_retry_after(value):
+    """Return how many seconds a Retry-After header value asks us to wait."""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+class CircuitBreaker(object):
+    """Stops requests to a host that keeps failing.
+
+    After BREAKER_THRESHOLD failures in a row the breaker opens, and requests
+    are refused until the cooldown passes. Then a single trial request is let
+    through: if it works the breaker closes, otherwise it opens again with a
+    longer cooldown.
+    """
+
+    def __init__(self, host):
+        self.host = host
+        self._lock = threading.Lock()
+        self.failures = 0
+        self.cooldown = BREAKER_COOLDOWN
+        self.open_until = 0
+        self.trial_running = False
+
+    @property
+    def state(self):
+        """Return 'closed', 'open' or 'half-open'."""
+        if self.failures < BREAKER_THRESHOLD:
+            return 'closed'
+        elif time.time() < self.open_until or self.trial_running:
+            return 'open'
+        return 'half-open'
+
+    def check(self):
+        """Raise HostUnavailable if we shouldn't make a request right now."""
+        with self._lock:
+            if self.failures < BREAKER_THRESHOLD:
+                return
+            if time.time() < self.open_until or self.trial_running:
+                raise HostUnavailable(self.host, max(self.open_until, time.time() + 1))
+            self.trial_running = True
+
+    def record(self, success):
+        """Record how a request went."""
+        with self._lock:
+            self.trial_running = False
+            if success:
+                self.failures = 0
+                self.cooldown = BREAKER_COOLDOWN
+                return
+
+            self.failures += 1
+            if self.failures >= BREAKER_THRESHOLD:
+                if self.failures > BREAKER_THRESHOLD:
+                    # the trial request failed too
+                    self.cooldown = min(self.cooldown * 2, BREAKER_MAX_COOLDOWN)
+                self.open_until = time.time() + self.cooldown
+
+
+class HostLimiter(object):
+    """Limits requests to a single host.
+
+    Requests are spaced out with a token bucket (rate per second, plus a
+    burst allowance), and the number of requests in flight is adjusted with
+    AIMD: one more for each round of successful requests, halved whenever
+    the host tells us to back off. Retry-After pauses the host entirely.
+    """
+
+    def __init__(self, rate=0, burst=1, max_concurrency=10, host=None):
+        self.breaker = CircuitBreaker(host)
+        self.rate = float(rate)  # requests per second, 0 is unlimited
+        self.burst = max(float(burst), 1)
+        self.max_concurrency = max(int(max_concurrency), 1)
+
+        self._cond = threading.Condition()
+        self._tokens = self.burst
+        self._updated = time.time()
+        self.concurrency = float(self.max_concurrency)
+        self.active = 0
+        self.paused_until = 0
+        self.responses = collections.Counter()  # by status code, 'error' if there was no response
+
+    def configure(self, rate, burst, max_concurrency):
+        """Change this host's limits, waiting requests pick them up straight away."""
+        with self._cond:
+            at_max = self.concurrency >= self.max_concurrency
+            self.rate = float(rate)
+            self.burst = max(float(burst), 1)
+            self.max_concurrency = max(int(max_concurrency), 1)
+            self._tokens = min(self._tokens, self.burst)
+            if at_max or self.concurrency > self.max_concurrency:
+                self.concurrency = float(self.max_concurrency)
+            self._cond.notify_all()
+
+    def acquire(self):
+        """Block until we're allowed to make a request to this host.
+
+        Raises HostUnavailable if the host's circuit breaker is open.
+        """
+        self.breaker.check()
+        with self._cond:
+            while True:
+                now = time.time()
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.active >= int(self.concurrency):
+                    wait = None  # until a request finishes
+                elif self.rate <= 0:
+                    break
+                else:
+                    self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        break
+                    wait = (1 - self._tokens) / self.rate
+                self._cond.wait(wait)
+
+            self.active += 1
+
+    def release(self, status_code=None, retry_after=None):
+        """Finish a request, adjusting our limits based on how it went.
+
+        status_code is None if the request failed without a response.
+        """
+        failed = status_code is None or status_code in BACKOFF_STATUSES
+        self.breaker.record(not failed)
+
+        with self._cond:
+            self.active -= 1
+            self.responses['error' if status_code is None else str(status_code)] += 1
+
+            if failed:
+                self.concurrency = max(self.concurrency / 2, 1)
+                retry_after = parse_retry_after(retry_after)
+                if retry_after:
+                    self.paused_until = max(self.paused_until, time.time() + retry_after)
+            else:
+                self.concurrency = min(self.concurrency + 1 / self.concurrency,
+                                       self.max_concurrency)
+
+            self._cond.notify_all()
@@ -3,70 +3,553 @@
 # BASC Imageboard Archiver Utilities
 from __future__ import absolute_import
 from __future__ import print_function
-import codecs
+import collections
+import contextlib
+import functools
 import json
 import os
 import re
 import time
+import socket
+import threading
+from urllib.parse import urlparse
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from .storage import files, mkdirs
+from .throttle import HostLimiter, BACKOFF_STATUSES
 
 user_agent = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/76.0.3809.87 Safari/537.36"
 headers = {'User-Agent': user_agent}
 
-def mkdirs(path):
-    """Make directory, if it doesn't exist."""
-    try:
-        if not os.path.exists(path):
-            os.makedirs(path)
-    except OSError:  # folder exists, due to multithreading
-        pass
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 60
+DEFAULT_DNS_TTL = 300
+MAX_VALIDATORS = 10000  # URLs we remember ETag/Last-Modified for, least recently used go first
+
+# finding urls in post text. the lookbehind means a match can only start at
+# the beginning of a run of word characters, so every character is looked at
+# a fixed number of times, however nasty the text is
+URL_REGEX = re.compile(r"""(?<![\w+.-])(?:[a-z][\w+.-]*://(?=[^\s<>"])|www\d{0,3}[.]|[a-z0-9][a-z0-9.-]*[.][a-z]{2,4}/)[^\s<>"]*""",
+                       re.IGNORECASE)
+URL_TRAILING_CHARS = '`!()[]{};:\'".,<>?«»“”‘’'
+
+
+class DownloadError(Exception):
+    """The server failed in a way that's worth trying again later."""
+
+    def __init__(self, url, status_code, retry_after=None):
+        Exception.__init__(self, 'Failed to download {} - status {}'.format(url, status_code))
+        self.url = url
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class IncompleteDownloadError(DownloadError):
+    """The server stopped sending a file part of the way through."""
+
+    def __init__(self, url, status_code, size, length):
+        Exception.__init__(self, 'Incomplete download of {} - {} of {} bytes'.format(url, size, length))
+        self.url = url
+        self.status_code = status_code
+        self.retry_after = None
+        self.size = size
+        self.length = length
+
+
+class ChecksumError(DownloadError):
+    """The file we downloaded doesn't match the MD5 the imageboard gave us."""
+
+    def __init__(self, url, md5, real_md5):
+        Exception.__init__(self, 'Checksum mismatch for {} - expected {}, got {}'.format(url, md5, real_md5))
+        self.url = url
+        self.status_code = 'md5'
+        self.retry_after = None
+        self.md5 = md5
+        self.real_md5 = real_md5
+
+
+class DnsCache(object):
+    """Caches the addresses our connections are made to for a limited time.
+
+    Only connections made through a SessionPool's sessions use it, see
+    CachedDnsHTTPConnection. Nothing else in the process is affected.
+    """
+
+    def __init__(self, ttl=DEFAULT_DNS_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._cache = {}
+
+    def resolve(self, host, port):
+        """Return the address to connect to for the given host and port."""
+        key = (host, port)
+        now = time.time()
+        with self._lock:
+            cached = self._cache.get(key)
+        if cached is not None and cached[0] > now:
+            return cached[1]
+
+        address = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0][4][0]
+        with self._lock:
+            self._cache[key] = (now + self.ttl, address)
+        return address
+
+    def forget(self, host, port):
+        """Look the given host up again next time, say if connecting to it failed."""
+        with self._lock:
+            self._cache.pop((host, port), None)
+
+    def connect(self, connection, new_conn):
+        """Open the socket for a urllib3 connection, connecting to its host's cached address."""
+        host = connection._dns_host
+        try:
+            connection._dns_host = self.resolve(host, connection.port)
+        except socket.gaierror:
+            pass  # urllib3 reports it as usual
+        try:
+            return new_conn(connection)
+        except Exception:
+            self.forget(host, connection.port)
+            raise
+        finally:
+            connection._dns_host = host
+
+
+class CachedDnsHTTPConnection(HTTPConnection):
+    """An HTTP connection that looks its host up through a DnsCache."""
+
+    def __init__(self, *args, **kwargs):
+        self.dns_cache = kwargs.pop('dns_cache')
+        HTTPConnection.__init__(self, *args, **kwargs)
+
+    def _new_conn(self):
+        return self.dns_cache.connect(self, HTTPConnection._new_conn)
+
+
+class CachedDnsHTTPSConnection(HTTPSConnection):
+    """An HTTPS connection that looks its host up through a DnsCache."""
+
+    def __init__(self, *args, **kwargs):
+        self.dns_cache = kwargs.pop('dns_cache')
+        HTTPSConnection.__init__(self, *args, **kwargs)
+
+    def _new_conn(self):
+        return self.dns_cache.connect(self, HTTPSConnection._new_conn)
+
+
+class CachedDnsHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = CachedDnsHTTPConnection
+
+    def __init__(self, host, port=None, dns_cache=None, **kwargs):
+        HTTPConnectionPool.__init__(self, host, port, **kwargs)
+        self.conn_kw['dns_cache'] = dns_cache
+
+
+class CachedDnsHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = CachedDnsHTTPSConnection
+
+    def __init__(self, host, port=None, dns_cache=None, **kwargs):
+        HTTPSConnectionPool.__init__(self, host, port, **kwargs)
+        self.conn_kw['dns_cache'] = dns_cache
+
+
+class LimitedAdapter(HTTPAdapter):
+    """Sends every request through the rate limiter for its host.
+
+    Being the session's transport, this covers requests made by the site
+    libraries with our sessions as well as our own. A request counts against
+    its host's limits until its body has been read or it's closed, so
+    streamed downloads are limited for as long as they run.
+
+    Its connections, proxied ones included, look hosts up through the
+    pool's DnsCache.
+    """
+
+    def __init__(self, session_pool, **kwargs):
+        self.session_pool = session_pool
+        HTTPAdapter.__init__(self, **kwargs)
+
+    def _use_dns_cache(self, manager):
+        """INTERNAL: Make the given urllib3 pool manager's connections use our DnsCache."""
+        dns_cache = self.session_pool.dns_cache
+        manager.pool_classes_by_scheme = {
+            'http': functools.partial(CachedDnsHTTPConnectionPool, dns_cache=dns_cache),
+            'https': functools.partial(CachedDnsHTTPSConnectionPool, dns_cache=dns_cache),
+        }
+        return manager
+
+    def init_poolmanager(self, *args, **kwargs):
+        HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+        self._use_dns_cache(self.poolmanager)
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        if proxy not in self.proxy_manager:
+            manager = HTTPAdapter.proxy_manager_for(self, proxy, **proxy_kwargs)
+            # SOCKS proxies make their own connections
+            if not proxy.lower().startswith('socks'):
+                self._use_dns_cache(manager)
+        return self.proxy_manager[proxy]
+
+    def send(self, request, **kwargs):
+        limiter = self.session_pool.limiter(request.url)
+        limiter.acquire()
+        try:
+            response = HTTPAdapter.send(self, request, **kwargs)
+        except Exception:
+            limiter.release()
+            raise
+
+        released = []
+        release_conn = response.raw.release_conn
+
+        def release():
+            try:
+                release_conn()
+            finally:
+                if not released:
+                    released.append(True)
+                    limiter.release(response.status_code, response.headers.get('Retry-After'))
+        response.raw.release_conn = release
+        return response
+
 
+class SessionPool(object):
+    """Shared keep-alive HTTP sessions, one per host.
 
-def download_file(local_filename, url, clobber=False):
-    """Download the given file. Clobber overwrites file if exists."""
-    dir_name = os.path.dirname(local_filename)
-    mkdirs(dir_name)
+    Each host gets its own requests session, with a connection pool big
+    enough for every download thread of a site to hold a connection open,
+    and its own rate limiter shared by every download thread.
+    """
 
-    if clobber or not os.path.exists(local_filename):
-        i = requests.get(url, headers=headers)
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT,
+                 dns_ttl=DEFAULT_DNS_TTL,
+                 rate=0, burst=1):
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.dns_cache = DnsCache(dns_ttl)
+        self.rate = rate
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._limiters = {}
+        self._validators = collections.OrderedDict()
 
-        # if not exists
-        if i.status_code == 404:
-            print('Failed to download file:', local_filename, url)
-            return False
+    def configure(self, pool_size=None, connect_timeout=None, read_timeout=None, dns_ttl=None,
+                  rate=None, burst=None):
+        """Change pool options, for the sessions we already have as well as new ones."""
+        with self._lock:
+            if pool_size is not None and int(pool_size) != self.pool_size:
+                self.pool_size = int(pool_size)
+                # connections in use finish on the old adapter, then it's dropped
+                for session in self._sessions.values():
+                    self._mount(session)
+            if rate is not None:
+                self.rate = float(rate)
+            if burst is not None:
+                self.burst = float(burst)
+            if connect_timeout is not None:
+                self.timeout = (float(connect_timeout), self.timeout[1])
+            if read_timeout is not None:
+                self.timeout = (self.timeout[0], float(read_timeout))
+            if dns_ttl is not None:
+                self.dns_cache.ttl = float(dns_ttl)
+            for limiter in self._limiters.values():
+                limiter.configure(self.rate, self.burst, self.pool_size)
 
-        # write out in 1MB chunks
-        chunk_size_in_bytes = 1024*1024  # 1MB
-        with open(local_filename, 'wb') as local_file:
-            for chunk in i.iter_content(chunk_size=chunk_size_in_bytes):
-                local_file.write(chunk)
+    def _mount(self, session):
+        """INTERNAL: Give the session a new transport adapter, lock must be held."""
+        adapter = LimitedAdapter(self, pool_connections=1,
+                                 pool_maxsize=self.pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+    def session(self, url):
+        """Return the shared session for the host of the given URL (or hostname)."""
+        host = urlparse(url).netloc if '//' in url else url
+        with self._lock:
+            if host not in self._sessions:
+                session = requests.Session()
+                self._mount(session)
+                self._sessions[host] = session
+                if host not in self._limiters:
+                    self._limiters[host] = HostLimiter(self.rate, self.burst, self.pool_size, host)
+            return self._sessions[host]
+
+    def limiter(self, url):
+        """Return the rate limiter for the host of the given URL (or hostname)."""
+        host = urlparse(url).netloc if '//' in url else url
+        with self._lock:
+            if host not in self._limiters:
+                self._limiters[host] = HostLimiter(self.rate, self.burst, self.pool_size, host)
+            return self._limiters[host]
+
+    def get(self, url, **kwargs):
+        """GET the given URL using the pooled session for its host, once its rate limiter lets us."""
+        kwargs.setdefault('headers', headers)
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session(url).get(url, **kwargs)
+
+    @contextlib.contextmanager
+    def request(self, url, **kwargs):
+        """GET the given URL once its host's rate limiter lets us, as a context manager.
+
+        The request counts against the host's limits until the block exits,
+        so streamed bodies should be read inside it.
+        """
+        with self.get(url, **kwargs) as response:
+            yield response
+
+    def validators(self, url):
+        """Return conditional request headers for a URL we've fetched before."""
+        with self._lock:
+            etag, last_modified = self._validators.get(url, (None, None))
+            if url in self._validators:
+                self._validators.move_to_end(url)
+
+        conditional_headers = {}
+        if etag:
+            conditional_headers['If-None-Match'] = etag
+        if last_modified:
+            conditional_headers['If-Modified-Since'] = last_modified
+        return conditional_headers
+
+    def store_validators(self, url, response):
+        """Remember the ETag/Last-Modified validators from the given response."""
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        with self._lock:
+            if etag or last_modified:
+                self._validators[url] = (etag, last_modified)
+                self._validators.move_to_end(url)
+                while len(self._validators) > MAX_VALIDATORS:
+                    self._validators.popitem(last=False)
+            else:
+                self._validators.pop(url, None)
+
+    def stats(self):
+        """Return request, connection and response counts for each host."""
+        with self._lock:
+            sessions = list(self._sessions.items())
+            limiters = dict(self._limiters)
+
+        stats = {}
+        for host, session in sessions:
+            requests_made = 0
+            connections = 0
+            for adapter in set(session.adapters.values()):
+                pools = adapter.poolmanager.pools
+                for key in pools.keys():
+                    pool = pools[key]
+                    requests_made += pool.num_requests
+                    connections += pool.num_connections
+            stats[host] = {
+                'requests': requests_made,
+                'connections': connections,
+                'reused': max(requests_made - connections, 0),
+                'concurrency_limit': int(limiters[host].concurrency),
+                'circuit': limiters[host].breaker.state,
+                'responses': dict(limiters[host].responses),
+            }
+        return stats
+
+
+sessions = SessionPool()
+
+
+def _iter_lines(chunks):
+    """INTERNAL: Split a stream of byte chunks into lines, keeping line endings."""
+    pending = b''
+    for chunk in chunks:
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line + b'\n'
+    if pending:
+        yield pending
+
+
+def download_file(local_filename, url, clobber=False, conditional=True, line_filter=None,
+                  expected_size=None, storage=files, resume=False):
+    """Download the given file. Clobber overwrites file if exists.
+
+    Files are downloaded into a .part file first, which is renamed into place
+    once it's complete. With resume, if a download gets cut off the next
+    attempt carries on from where it stopped. That's only safe for files
+    that never change, like imageboard media, and only happens if the
+    server gave us an ETag or Last-Modified for the part we have: it's sent
+    as If-Range, so a file that has changed is downloaded again from the
+    start. expected_size is checked if given, the file size from the
+    imageboard API for instance.
+
+    When clobbering a file we've downloaded before, a conditional request is
+    made and False is returned if the server says it hasn't changed.
+
+    If given, line_filter is called with each line of the utf-8 text as it
+    streams in, and the lines it returns are written out instead.
+
+    The file is written through the given storage backend, see storage.py.
+
+    Raises DownloadError on 429/5xx responses and incomplete downloads, and
+    the usual requests exceptions on timeouts and connection failures.
+    """
+    file_exists = storage.exists(local_filename)
+    if clobber or not file_exists:
+        request_headers = dict(headers)
+        if conditional and file_exists:
+            request_headers.update(sessions.validators(url))
+
+        # continue a download that got cut off, if it's still the same file
+        resume = resume and line_filter is None
+        with storage.writer(local_filename, resume=resume) as local_file:
+            offset = local_file.offset
+            part_validator = None
+            if offset:
+                part_validators = sessions.validators(url)
+                part_validator = part_validators.get('If-None-Match') or part_validators.get('If-Modified-Since')
+                if part_validator:
+                    request_headers['Range'] = 'bytes={}-'.format(offset)
+                    request_headers['If-Range'] = part_validator
+                else:
+                    # we can't tell whether it has changed since
+                    local_file.restart()
+                    offset = 0
+
+            with sessions.request(url, headers=request_headers, stream=True) as i:
+                # not modified since we last downloaded it
+                if i.status_code == 304:
+                    return False
+
+                # if not exists
+                if i.status_code == 404:
+                    print('Failed to download file:', local_filename, url)
+                    return False
+
+                # our .part file is no good, start again next time
+                if i.status_code == 416:
+                    local_file.discard()
+
+                # server trouble or rate limiting, try again later
+                if i.status_code in BACKOFF_STATUSES:
+                    raise DownloadError(url, i.status_code, i.headers.get('Retry-After'))
+
+                # other error pages
+                if i.status_code not in (200, 206):
+                    print('Failed to download file:', local_filename, url, '- status', i.status_code)
+                    return False
+
+                # the server might not support ranges, or not where we asked, or the file has changed
+                if i.status_code != 206 or not i.headers.get('Content-Range', '').startswith('bytes {}-'.format(offset)):
+                    if offset:
+                        local_file.restart()
+                    offset = 0
+                elif part_validator not in (i.headers.get('ETag'), i.headers.get('Last-Modified')):
+                    local_file.discard()
+                    raise DownloadError(url, i.status_code)
+
+                # how big the file should be, if the server tells us
+                length = None
+                if i.headers.get('Content-Encoding', 'identity') == 'identity' and 'Content-Length' in i.headers:
+                    length = offset + int(i.headers['Content-Length'])
+                    # we check the length ourselves, so a cut off download keeps what did arrive
+                    i.raw.enforce_content_length = False
+
+                # write out in 1MB chunks
+                chunk_size_in_bytes = 1024*1024  # 1MB
+                if line_filter is None:
+                    for chunk in i.iter_content(chunk_size=chunk_size_in_bytes):
+                        local_file.write(chunk)
+                else:
+                    for line in _iter_lines(i.iter_content(chunk_size=chunk_size_in_bytes)):
+                        line = line_filter(line.decode('utf-8', 'replace'))
+                        local_file.write(line.encode('utf-8'))
+                    length = None
+
+                # incomplete, keep the .part file around and try again later
+                size = local_file.size
+                if length is not None and size < length:
+                    if resume:
+                        # so we can tell whether it's the same file when we carry on
+                        sessions.store_validators(url, i)
+                    raise IncompleteDownloadError(url, i.status_code, size, length)
+
+                # wrong file entirely, don't try to continue it
+                if (length is not None and size != length) or (expected_size is not None and size != expected_size):
+                    print('Failed to download file:', local_filename, url, '- wrong size', size)
+                    local_file.discard()
+                    return False
+
+                local_file.commit()
+
+                if conditional:
+                    sessions.store_validators(url, i)
 
     return True
 
 
-def download_json(local_filename, url, clobber=False):
-    """Download the given JSON file, and pretty-print before we output it."""
-    if download_file(local_filename, url, clobber):
-        # read original json
-        original_data = json.loads(open(local_filename).read())
+def fetch_json(url, conditional=False):
+    """Fetch and parse the given JSON URL, without saving it.
+
+    Returns a (status code, data) tuple, data is None unless the status is
+    200. Conditional fetches return 304 if it hasn't changed since last time.
+    """
+    request_headers = dict(headers)
+    if conditional:
+        request_headers.update(sessions.validators(url))
+
+    with sessions.request(url, headers=request_headers) as response:
+        if response.status_code != 200:
+            return response.status_code, None
+
+        if conditional:
+            sessions.store_validators(url, response)
+        return response.status_code, response.json()
+
+
+def write_json(local_filename, data, pretty=True, indent=2, storage=files):
+    """Write the given data out as JSON, replacing the file in one go."""
+    if pretty:
+        output = json.dumps(data, sort_keys=True, indent=indent, separators=(',', ': '))
+    else:
+        # no indent means the C encoder gets used, much faster on big threads
+        output = json.dumps(data, separators=(',', ':'))
 
-        # write reformatted json
-        with open(local_filename, 'w') as json_file:
-            json_file.write(json.dumps(original_data, sort_keys=True, indent=2,
-                                       separators=(',', ': ')))
+    storage.write(local_filename, output.encode('utf-8'))
 
 
-def file_replace(local_filename, pattern, replacement):
+def download_json(local_filename, url, clobber=False, storage=files):
+    """Download the given JSON file, and pretty-print before we output it."""
+    if download_file(local_filename, url, clobber, storage=storage):
+        original_data = json.loads(storage.read(local_filename).decode('utf-8'))
+        write_json(local_filename, original_data, storage=storage)
+
+
+def file_replace(local_filename, pattern, replacement, storage=files):
     """Regex replace in the given file."""
-    # can't use fileinput lib here because utf-8
-    temp_new_filename = '{}-temporary'.format(local_filename)
-    with codecs.open(local_filename, 'r', encoding='utf-8') as fi:
-        with codecs.open(temp_new_filename, 'w', encoding='utf-8') as fo:
-            for line in fi:
-                fo.write(re.sub(pattern, replacement, line))
-    os.remove(local_filename)
-    os.rename(temp_new_filename, local_filename)
+    lines = storage.read(local_filename).decode('utf-8').splitlines(True)
+    output = ''.join(re.sub(pattern, replacement, line) for line in lines)
+    storage.write(local_filename, output.encode('utf-8'))
+
+
+def find_urls(text):
+    """Return the URLs in the given text."""
+    urls = []
+    for match in URL_REGEX.finditer(text):
+        url = match.group(0)
+        # trailing punctuation isn't part of the url, unless it closes a bracket
+        while url and url[-1] in URL_TRAILING_CHARS:
+            if url[-1] == ')' and url.count('(') >= url.count(')'):
+                break
+            url = url[:-1]
+        if url:
+            urls.append(url)
+    return urls
 
 
 def timestamp():
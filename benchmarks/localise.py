@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# BASC Imageboard Archiver FoolFuuka Page Localiser Benchmarks
+from __future__ import absolute_import
+from __future__ import print_function
+import os
+import sys
+import time
+
+from bs4 import BeautifulSoup
+from docopt import docopt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from basc_archiver.sites import fuuka
+from standin import StandinSite, FUUKA_HOST
+
+__doc__ = """BASC-Archiver FoolFuuka page localiser benchmarks.
+
+Times fuuka.FuukaPageLocaliser, which converts the links in a saved
+FoolFuuka thread page to local ones in a single pass over its tags, against
+the loops it replaced, which went over every anchor once per image and
+every <img> once per thumbnail. Both run on the stand-in archive's thread
+pages with more and more images, and their output is checked to be the
+same.
+
+Usage:
+  localise.py [options]
+  localise.py -h | --help
+
+Options:
+  --runs=<int>                   Runs of each benchmark, the best one is reported [default: 3]
+  --images=<list>                Images in each thread page to compare [default: 100,1000]
+  --html-parser=<string>         BeautifulSoup parser the localiser uses [default: html.parser]
+  --no-old                       Skip the old loops
+  -h --help                      Show help
+"""
+
+HTTP_HEADER = 'http://'
+RESULT_LINE = '{images:>6} images {size:>9} bytes {new_ms:>11.3f} ms new {old_ms:>12} old'
+
+
+def old_localise(contents, file_urls, thumbnail_urls):
+    """Localise the page the way the archiver did before FuukaPageLocaliser.
+
+    CSS and JS files are collected rather than downloaded, as the localiser does.
+    """
+    domain = FUUKA_HOST
+    imgs = ['gif', 'png', 'jpg', 'jpeg', 'webm']
+    css_files = []
+    js_files = []
+    soup = BeautifulSoup(contents, features="html.parser")
+
+    for tag in soup.find_all('link', rel="stylesheet", href=True):
+        url = tag['href']
+        css_filename = os.path.basename(url)
+        css_files.append((url, css_filename))
+        tag['href'] = os.path.join(fuuka._CSS_DIR_NAME, css_filename)
+
+    for tag in soup.find_all('script'):
+        url = tag.get('src')
+        if url and (domain in url or "ajax" in url):
+            while '/' in url[0]:
+                url = tag.get('src').lstrip('/')
+            if "http" not in url:
+                if "ajax" not in url:
+                    url = HTTP_HEADER + domain + "/" + url
+                else:
+                    url = HTTP_HEADER + url
+            js_filename = os.path.basename(url)
+            js_files.append((url, js_filename))
+            tag['src'] = os.path.join(fuuka._JS_DIR_NAME, js_filename)
+
+    for file_url in file_urls:
+        for tag in soup.find_all('a', href=True):
+            url = tag['href']
+            if any(img in url for img in imgs):
+                if "thumb" in url:
+                    tag['href'] = os.path.join(fuuka._THUMB_DIR_NAME, os.path.basename(url))
+                else:
+                    tag['href'] = os.path.join(fuuka._IMAGE_DIR_NAME, os.path.basename(url))
+
+    for thumbnail_url in thumbnail_urls:
+        for tag in soup.find_all('img'):
+            url = tag.get('src')
+            if "http" in url:
+                tag['src'] = os.path.join(fuuka._THUMB_DIR_NAME, os.path.basename(url))
+
+    for link in soup.find_all('a', href=True):
+        url = link['href']
+        if url and url != "#" and "#" in url:
+            link['href'] = os.path.basename(url)
+    return str(soup), css_files, js_files
+
+
+def new_localise(contents, html_parser):
+    """Localise the page with FuukaPageLocaliser."""
+    localiser = fuuka.FuukaPageLocaliser(HTTP_HEADER, FUUKA_HOST, html_parser=html_parser)
+    return localiser.localise(contents), localiser.css_files, localiser.js_files
+
+
+def best_time(runs, localise, *args):
+    """Return the fastest time, in ms, that localise(*args) took."""
+    times = []
+    for i in range(runs):
+        started = time.perf_counter()
+        localise(*args)
+        times.append(time.perf_counter() - started)
+    return min(times) * 1000
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    runs = int(args['--runs'])
+
+    for images in args['--images'].split(','):
+        # every post gets a file
+        site = StandinSite(threads=1, posts=int(images), file_ratio=1)
+        thread_id = sorted(site.threads)[0]
+        page = site.fuuka_thread_html(thread_id)
+        new_ms = best_time(runs, new_localise, page, args['--html-parser'])
+
+        old_ms = '-'
+        if not args['--no-old']:
+            file_urls = ['{}{}/{}/image/{}{}'.format(HTTP_HEADER, FUUKA_HOST, site.board, post['tim'], post['ext'])
+                         for post in site.threads[thread_id] if 'tim' in post]
+            thumbnail_urls = [url.replace('/image/', '/thumb/') for url in file_urls]
+            old_ms = '{:.3f} ms'.format(best_time(runs, old_localise, page, file_urls, thumbnail_urls))
+            if old_localise(page, file_urls, thumbnail_urls) != new_localise(page, args['--html-parser']):
+                print('Output differs for {} images!'.format(images))
+
+        print(RESULT_LINE.format(images=images, size=len(page.encode('utf-8')), new_ms=new_ms, old_ms=old_ms))
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# BASC Imageboard Archiver Memory Benchmarks
+from __future__ import absolute_import
+from __future__ import print_function
+import gc
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from docopt import docopt
+
+from standin import StandinSite, StandinServer
+
+__doc__ = """BASC-Archiver memory benchmarks.
+
+Archives boards of more and more threads from the stand-in server, each
+in a fresh interpreter, and reports how much memory is still held once
+they're all finished. A long-running watcher only stays flat if this
+doesn't grow with the number of threads it has seen.
+
+Usage:
+  memory.py [options]
+  memory.py -h | --help
+
+Options:
+  --threads=<list>               Thread counts to compare [default: 50,200,800]
+  --posts=<int>                  Posts in each thread [default: 50]
+  --measure=<int>                INTERNAL: archive this many threads here, print the result as JSON
+  -h --help                      Show help
+"""
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULT_LINE = ('{threads:>6} threads {retained_mb:>8.2f} MB retained {kb_per_thread:>7.2f} KB/thread   '
+               'cached threads {cached_threads:>5}   records {records:>5}   validators {validators:>5}')
+
+
+def measure(thread_count, posts):
+    """Archive thread_count threads in this process, returning what's left in memory afterwards."""
+    from basc_archiver import Options, Archiver
+    from basc_archiver.utils import sessions
+
+    site = StandinSite(threads=thread_count, posts=posts, file_ratio=0.1, media_size=100, thumb_size=10)
+    server = StandinServer(site)
+    os.environ['HTTP_PROXY'] = os.environ['http_proxy'] = server.proxy_url
+    os.environ.pop('NO_PROXY', None)
+    os.environ.pop('no_proxy', None)
+    path = tempfile.mkdtemp(prefix='basc-bench-')
+
+    try:
+        archiver = Archiver(Options(path, silent=True, run_once=True, dl_thread_wait=0))
+        gc.collect()
+        tracemalloc.start()
+        started = tracemalloc.get_traced_memory()[0]
+
+        archiver.add_threads(['http://boards.4chan.org/{}/thread/{}'.format(site.board, thread_id)
+                              for thread_id in sorted(site.threads)])
+        while archiver.files_to_download:
+            time.sleep(0.1)
+
+        gc.collect()
+        retained = tracemalloc.get_traced_memory()[0] - started
+        tracemalloc.stop()
+
+        fourchan = archiver.archivers[0]
+        result = {
+            'threads': thread_count,
+            'retained_mb': retained / 1e6,
+            'kb_per_thread': retained / 1e3 / thread_count,
+            'cached_threads': sum(len(board._thread_cache) for board in fourchan.boards.values()),
+            'records': len(fourchan.threads.values()),
+            'validators': len(sessions._validators),
+        }
+        archiver.shutdown()
+        return result
+    finally:
+        server.shutdown()
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+
+    if args['--measure']:
+        print(json.dumps(measure(int(args['--measure']), int(args['--posts']))))
+        sys.exit(0)
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [REPO_DIR, env.get('PYTHONPATH')]))
+    for thread_count in args['--threads'].split(','):
+        process = subprocess.run([sys.executable, os.path.abspath(__file__), '--measure', thread_count,
+                                  '--posts', args['--posts']], env=env, stdout=subprocess.PIPE)
+        print(RESULT_LINE.format(**json.loads(process.stdout.decode('utf-8').strip().splitlines()[-1])))
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# BASC Imageboard Archiver Thread Page Rewriter Benchmarks
+from __future__ import absolute_import
+from __future__ import print_function
+import codecs
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+from docopt import docopt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from basc_archiver.sites import fourchan
+from standin import StandinSite
+
+__doc__ = """BASC-Archiver thread page rewriter benchmarks.
+
+Times fourchan.ThreadPageRewriter, which converts the links in a saved 4chan
+thread page to local ones in a single pass, against the two reads and five
+file_replace passes it replaced, on stand-in thread pages with more and more
+posts. Both write the page out to disk, and their output is checked to be
+the same.
+
+Usage:
+  rewrite.py [options]
+  rewrite.py -h | --help
+
+Options:
+  --runs=<int>                   Runs of each benchmark, the best one is reported [default: 5]
+  --posts=<list>                 Posts in each thread page to compare [default: 100,400,1600]
+  --file-ratio=<float>           Fraction of posts with a file [default: 0.5]
+  --no-old                       Skip the old passes
+  -h --help                      Show help
+"""
+
+HTTP_HEADER = 'http://'
+RESULT_LINE = '{posts:>6} posts {size:>9} bytes {new_ms:>9.3f} ms new {old_ms:>10} old'
+
+
+def file_replace(local_filename, pattern, replacement):
+    """Regex replace in the given file, as utils.file_replace did."""
+    temp_new_filename = '{}-temporary'.format(local_filename)
+    with codecs.open(local_filename, 'r', encoding='utf-8') as fi:
+        with codecs.open(temp_new_filename, 'w', encoding='utf-8') as fo:
+            for line in fi:
+                fo.write(re.sub(pattern, replacement, line))
+    os.remove(local_filename)
+    os.rename(temp_new_filename, local_filename)
+
+
+def old_rewrite(local_filename, page):
+    """Save and rewrite the page the way the archiver did before ThreadPageRewriter."""
+    with codecs.open(local_filename, 'w', encoding='utf-8') as local_file:
+        local_file.write(page)
+
+    css_files = re.compile(fourchan.FOURCHAN_CSS_REGEX).findall(codecs.open(local_filename, encoding='utf-8').read())
+    js_files = re.compile(fourchan.FOURCHAN_JS_REGEX).findall(codecs.open(local_filename, encoding='utf-8').read())
+
+    file_replace(local_filename, '"//', '"' + HTTP_HEADER)
+    file_replace(local_filename, fourchan.FOURCHAN_IMAGES_URL_REGEX, fourchan._IMAGE_DIR_NAME + r'/\1')
+    file_replace(local_filename, fourchan.FOURCHAN_THUMBS_URL_REGEX, fourchan._THUMB_DIR_NAME + r'/\1')
+    file_replace(local_filename, fourchan.FOURCHAN_CSS_URL_REGEX, fourchan._CSS_DIR_NAME + '/')
+    file_replace(local_filename, fourchan.FOURCHAN_JS_URL_REGEX, fourchan._JS_DIR_NAME + '/')
+    return css_files, js_files
+
+
+def new_rewrite(local_filename, page):
+    """Save and rewrite the page in one pass, as download_file does with a line_filter."""
+    rewriter = fourchan.ThreadPageRewriter(HTTP_HEADER)
+    with codecs.open(local_filename, 'w', encoding='utf-8') as local_file:
+        for line in page.splitlines(True):
+            local_file.write(rewriter(line))
+    return rewriter.css_files, rewriter.js_files
+
+
+def best_time(runs, rewrite, local_filename, page):
+    """Return the fastest time, in ms, that rewrite(local_filename, page) took."""
+    times = []
+    for i in range(runs):
+        started = time.perf_counter()
+        rewrite(local_filename, page)
+        times.append(time.perf_counter() - started)
+    return min(times) * 1000
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    runs = int(args['--runs'])
+    temp_dir = tempfile.mkdtemp(prefix='basc-rewrite-')
+
+    try:
+        for posts in args['--posts'].split(','):
+            site = StandinSite(threads=1, posts=int(posts), file_ratio=float(args['--file-ratio']))
+            page = site.thread_html(sorted(site.threads)[0])
+            new_filename = os.path.join(temp_dir, 'new.html')
+            new_ms = best_time(runs, new_rewrite, new_filename, page)
+
+            old_ms = '-'
+            if not args['--no-old']:
+                old_filename = os.path.join(temp_dir, 'old.html')
+                old_ms = '{:.3f} ms'.format(best_time(runs, old_rewrite, old_filename, page))
+                if (old_rewrite(old_filename, page) != new_rewrite(new_filename, page) or
+                        open(old_filename, 'rb').read() != open(new_filename, 'rb').read()):
+                    print('Output differs for {} posts!'.format(posts))
+
+            print(RESULT_LINE.format(posts=posts, size=len(page.encode('utf-8')), new_ms=new_ms, old_ms=old_ms))
+    finally:
+        shutil.rmtree(temp_dir)
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# BASC Imageboard Archiver Benchmarks
+from __future__ import absolute_import
+from __future__ import print_function
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from docopt import docopt
+
+from standin import StandinSite, StandinServer, FUUKA_HOST
+
+__doc__ = """BASC-Archiver benchmarks.
+
+Runs thread-archiver (once per engine and concurrency) and archive-nabber
+from this tree against the stand-in server, and reports how each did.
+
+Concurrency is the number of download threads per site for the thread
+engine, and the per-site and per-host limits for the pool engine.
+
+Usage:
+  run.py [options]
+  run.py -h | --help
+
+Options:
+  --engines=<list>               Download engines to compare [default: thread,pool]
+  --concurrency=<list>           Concurrent downloads to compare [default: 5,50,500]
+  --postprocess-workers=<list>   Post-processing process counts to compare [default: 0]
+  --runs=<int>                   Runs of each benchmark, the best one is reported [default: 1]
+  --no-nabber                    Skip the archive-nabber benchmark
+  --fuuka                        Also archive the threads from the stand-in FoolFuuka archive
+  --args=<string>                Extra arguments for thread-archiver [default: ]
+  --board=<string>               Board to generate threads on [default: bench]
+  --threads=<int>                Threads on the board [default: 10]
+  --posts=<int>                  Posts in each thread [default: 100]
+  --file-ratio=<float>           Fraction of posts with a file [default: 0.5]
+  --media-size=<int>             Bytes in each image [default: 200000]
+  --thumb-size=<int>             Bytes in each thumbnail [default: 5000]
+  --latency=<float>              Seconds before each response starts [default: 0.02]
+  --bandwidth=<int>              Bytes/sec for each response, 0 for unlimited [default: 0]
+  --error-rate=<float>           Fraction of requests answered with a 503 [default: 0]
+  --seed=<int>                   Random seed for the generated threads [default: 1]
+  -h --help                      Show help
+"""
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULT_LINE = ('{name:<48} {seconds:>8.2f}s {files:>7} files {mb_per_sec:>8.2f} MB/s {files_per_sec:>8.1f} files/s '
+               '{cpu_ms_per_file:>7.2f} ms CPU/file {cores:>5.2f} cores {peak_rss_mb:>7.1f} MB peak RSS')
+
+
+def media_totals(path):
+    """Return (files, bytes) of images and thumbnails under path."""
+    files = 0
+    total_bytes = 0
+    for dir_path, dir_names, filenames in os.walk(path):
+        if os.path.basename(dir_path) not in ('images', 'thumbs'):
+            continue
+        for filename in filenames:
+            files += 1
+            total_bytes += os.path.getsize(os.path.join(dir_path, filename))
+    return files, total_bytes
+
+
+def run_script(name, command, cwd, env, output_path):
+    """Run a command to completion, returning its timings and what it downloaded."""
+    started = time.time()
+    process = subprocess.Popen(command, cwd=cwd, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    # wait4 gives us the resource usage of just this child, and the processes it waited for
+    pid, status, usage = os.wait4(process.pid, 0)
+    seconds = time.time() - started
+    stderr = process.stderr.read().decode('utf-8', 'replace')
+    process.stderr.close()
+    if status != 0:
+        print('{} exited with status {}:\n{}'.format(name, status, stderr))
+
+    files, total_bytes = media_totals(output_path)
+    cpu_seconds = usage.ru_utime + usage.ru_stime
+    return {
+        'name': name,
+        'seconds': seconds,
+        'files': files,
+        'mb_per_sec': total_bytes / 1e6 / seconds,
+        'files_per_sec': files / seconds,
+        'cpu_ms_per_file': cpu_seconds * 1000 / max(files, 1),
+        'cores': cpu_seconds / seconds,  # over 1 means we used more than one core
+        # ru_maxrss is in kilobytes on Linux, bytes on macOS
+        'peak_rss_mb': usage.ru_maxrss / (1024.0 * 1024 if sys.platform == 'darwin' else 1024.0),
+    }
+
+
+def concurrency_args(engine, concurrency):
+    """Return the thread-archiver arguments that run the given engine at the given concurrency."""
+    if engine == 'pool':
+        return ['--pool-concurrency', concurrency, '--pool-per-host', concurrency]
+    return ['--dl-threads-per-site', concurrency]
+
+
+def best_of(runs, benchmark):
+    """Run a benchmark a few times, returning the fastest result."""
+    return min((benchmark() for i in range(runs)), key=lambda result: result['seconds'])
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+
+    site = StandinSite(board=args['--board'],
+                       threads=args['--threads'],
+                       posts=args['--posts'],
+                       file_ratio=args['--file-ratio'],
+                       media_size=args['--media-size'],
+                       thumb_size=args['--thumb-size'],
+                       latency=args['--latency'],
+                       bandwidth=args['--bandwidth'],
+                       error_rate=args['--error-rate'],
+                       seed=int(args['--seed']))
+    server = StandinServer(site)
+
+    env = dict(os.environ)
+    env['HTTP_PROXY'] = env['http_proxy'] = server.proxy_url
+    env.pop('NO_PROXY', None)
+    env.pop('no_proxy', None)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [REPO_DIR, env.get('PYTHONPATH')]))
+
+    urls = ['http://boards.4chan.org/{}/thread/{}'.format(site.board, thread_id)
+            for thread_id in sorted(site.threads)]
+    print('{} threads, {} files ({} images + thumbnails), {:.1f} MB'.format(
+        len(site.threads), len(site.media) * 2, len(site.media),
+        len(site.media) * (site.media_size + site.thumb_size) / 1e6))
+
+    runs = int(args['--runs'])
+    results = []
+    for engine in args['--engines'].split(','):
+        for concurrency in args['--concurrency'].split(','):
+            for workers in args['--postprocess-workers'].split(','):
+                def benchmark():
+                    work_dir = tempfile.mkdtemp(prefix='basc-bench-')
+                    try:
+                        command = [sys.executable, os.path.join(REPO_DIR, 'thread-archiver'),
+                                   '--runonce', '--silent', '--path', work_dir, '--engine', engine,
+                                   '--postprocess-workers', workers] + concurrency_args(engine, concurrency)
+                        command += args['--args'].split() + urls
+                        name = 'thread-archiver ({}, {} at once'.format(engine, concurrency)
+                        name += ', {} procs)'.format(workers) if int(workers) else ')'
+                        return run_script(name, command, work_dir, env, work_dir)
+                    finally:
+                        shutil.rmtree(work_dir)
+                results.append(best_of(runs, benchmark))
+                print(RESULT_LINE.format(**results[-1]))
+
+    if args['--fuuka']:
+        fuuka_urls = ['http://{}/{}/thread/{}/'.format(FUUKA_HOST, site.board, thread_id)
+                      for thread_id in sorted(site.threads)]
+
+        def benchmark():
+            work_dir = tempfile.mkdtemp(prefix='basc-bench-')
+            try:
+                command = [sys.executable, os.path.join(REPO_DIR, 'thread-archiver'),
+                           '--runonce', '--silent', '--path', work_dir] + args['--args'].split() + fuuka_urls
+                return run_script('thread-archiver (fuuka)', command, work_dir, env, work_dir)
+            finally:
+                shutil.rmtree(work_dir)
+        results.append(best_of(runs, benchmark))
+        print(RESULT_LINE.format(**results[-1]))
+
+    if not args['--no-nabber']:
+        def benchmark():
+            work_dir = tempfile.mkdtemp(prefix='basc-bench-')
+            try:
+                command = [sys.executable, os.path.join(REPO_DIR, 'archive-nabber'), site.board]
+                return run_script('archive-nabber', command, work_dir, env, work_dir)
+            finally:
+                shutil.rmtree(work_dir)
+        results.append(best_of(runs, benchmark))
+        print(RESULT_LINE.format(**results[-1]))
+
+    server.shutdown()
@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# BASC Imageboard Archiver Benchmark Stand-in Server
+from __future__ import absolute_import
+from __future__ import print_function
+import base64
+import email.utils
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from docopt import docopt
+
+__doc__ = """BASC-Archiver benchmark stand-in server.
+
+Pretends to be 4chan (a.4cdn.org, i.4cdn.org, s.4cdn.org, boards.4chan.org)
+and a FoolFuuka archive, with generated threads. It works as an HTTP proxy,
+so point the archiver at it with HTTP_PROXY=http://127.0.0.1:<port>.
+
+Usage:
+  standin.py [options]
+  standin.py -h | --help
+
+Options:
+  --port=<int>                   Port to listen on [default: 8642]
+  --board=<string>               Board to generate threads on [default: bench]
+  --threads=<int>                Threads on the board [default: 10]
+  --posts=<int>                  Posts in each thread [default: 100]
+  --file-ratio=<float>           Fraction of posts with a file [default: 0.5]
+  --media-size=<int>             Bytes in each image [default: 200000]
+  --thumb-size=<int>             Bytes in each thumbnail [default: 5000]
+  --latency=<float>              Seconds before each response starts [default: 0]
+  --bandwidth=<int>              Bytes/sec for each response, 0 for unlimited [default: 0]
+  --error-rate=<float>           Fraction of requests answered with a 503 [default: 0]
+  --seed=<int>                   Random seed for the generated threads [default: 1]
+  -h --help                      Show help
+"""
+
+FOURCHAN_API = 'a.4cdn.org'
+FOURCHAN_IMAGES = 'i.4cdn.org'
+FOURCHAN_STATIC = 's.4cdn.org'
+FOURCHAN_BOARDS = ('boards.4chan.org', 'boards.4channel.org')
+FUUKA_HOST = 'fuuka.bench'
+
+FIRST_THREAD_ID = 100000
+CHUNK_SIZE = 16 * 1024
+
+COMMENTS = [
+    'Nice thread',
+    '&gt;&gt;{reply}<br>agreed, see https://example.com/wiki/Some_<wbr>Page_(thing) for more',
+    'www.example.org/path?query=1 and example.net/file.txt, both good',
+    '<a href="/{board}/thread/{thread}#p{reply}" class="quotelink">&gt;&gt;{reply}</a><br>no',
+    'a' * 400,
+]
+
+
+class StandinSite(object):
+    """Generated threads and media, and how the server should behave."""
+
+    def __init__(self, board='bench', threads=10, posts=100, file_ratio=0.5,
+                 media_size=200000, thumb_size=5000, latency=0, bandwidth=0,
+                 error_rate=0, seed=1):
+        self.board = board
+        self.media_size = int(media_size)
+        self.thumb_size = int(thumb_size)
+        self.latency = float(latency)
+        self.bandwidth = int(bandwidth)
+        self.error_rate = float(error_rate)
+        self.random = random.Random(seed)
+        self._random_lock = threading.Lock()
+        self.failures = {}  # (host, path) -> how many more requests for it get a 503
+        self.last_modified = email.utils.formatdate(time.time() - 60, usegmt=True)
+
+        self.threads = {}
+        self.media = {}  # tim -> size
+        for thread_index in range(int(threads)):
+            thread_id = FIRST_THREAD_ID + thread_index * (int(posts) + 1)
+            self.threads[thread_id] = self._make_thread(thread_id, int(posts), float(file_ratio))
+
+    def _make_thread(self, thread_id, post_count, file_ratio):
+        posts = []
+        now = int(time.time())
+        for post_index in range(post_count):
+            post_id = thread_id + post_index
+            post = {
+                'no': post_id,
+                'resto': 0 if post_index == 0 else thread_id,
+                'time': now - (post_count - post_index) * 30,
+                'now': time.strftime('%m/%d/%y(%a)%H:%M:%S', time.gmtime(now)),
+                'name': 'Anonymous',
+                'com': self.random.choice(COMMENTS).format(board=self.board, thread=thread_id,
+                                                           reply=max(post_id - 1, thread_id)),
+            }
+            if post_index == 0 or self.random.random() < file_ratio:
+                tim = post_id * 1000
+                post.update({
+                    'tim': tim,
+                    'ext': '.jpg',
+                    'filename': 'file{}'.format(post_id),
+                    'fsize': self.media_size,
+                    'md5': base64.b64encode(hashlib.md5(self.media_body(tim)).digest()).decode('ascii'),
+                    'w': 800, 'h': 600, 'tn_w': 250, 'tn_h': 187,
+                })
+                self.media[tim] = self.media_size
+            posts.append(post)
+
+        posts[0].update({
+            'sub': 'Benchmark thread {}'.format(thread_id),
+            'replies': post_count - 1,
+            'images': len([post for post in posts if 'tim' in post]) - 1,
+            'semantic_url': 'benchmark-thread',
+        })
+        return posts
+
+    def media_body(self, tim, thumb=False):
+        """Return the bytes of an image or thumbnail, unique to each file."""
+        size = self.thumb_size if thumb else self.media_size
+        header = '{}{}'.format(tim, 's' if thumb else '').encode('ascii')
+        return (header + b'\0' * size)[:size]
+
+    def should_fail(self):
+        if self.error_rate <= 0:
+            return False
+        with self._random_lock:
+            return self.random.random() < self.error_rate
+
+    def take_failure(self, host, path):
+        """Return whether this request was set to fail, with failures."""
+        with self._random_lock:
+            if self.failures.get((host, path), 0) > 0:
+                self.failures[(host, path)] -= 1
+                return True
+        return False
+
+    # pages
+    def thread_json(self, thread_id):
+        return json.dumps({'posts': self.threads[thread_id]})
+
+    def threads_list_json(self):
+        return json.dumps([{
+            'page': 1,
+            'threads': [{'no': thread_id, 'last_modified': posts[-1]['time'], 'replies': len(posts) - 1}
+                        for thread_id, posts in self.threads.items()],
+        }])
+
+    def thread_html(self, thread_id):
+        lines = [
+            '<html><head><title>/{}/ - Benchmark</title>'.format(self.board),
+            '<link rel="stylesheet" href="//s.4cdn.org/css/yotsubluemobile.123.css">',
+            '<script type="text/javascript" src="//s.4cdn.org/js/core.min.123.js"></script>',
+            '</head><body>',
+        ]
+        for post in self.threads[thread_id]:
+            lines.append('<div class="postContainer" id="pc{no}">'.format(**post))
+            if 'tim' in post:
+                lines.append('<a class="fileThumb" href="//i.4cdn.org/{board}/{tim}{ext}">'
+                             '<img src="//i.4cdn.org/{board}/{tim}s.jpg"></a>'.format(board=self.board, **post))
+            lines.append('<blockquote class="postMessage">{com}</blockquote></div>'.format(**post))
+        lines.append('</body></html>')
+        return '\n'.join(lines)
+
+    def fuuka_thread_json(self, thread_id):
+        def fuuka_post(post):
+            fuuka = {
+                'num': str(post['no']),
+                'thread_num': str(post['resto'] or post['no']),
+                'op': '0' if post['resto'] else '1',
+                'timestamp': post['time'],
+                'name': post['name'],
+                'comment': post['com'],
+                'comment_processed': post['com'],
+                'media': None,
+            }
+            if 'tim' in post:
+                fuuka['media'] = {
+                    'media_filename': post['filename'] + post['ext'],
+                    'media_orig': '{}{}'.format(post['tim'], post['ext']),
+                    'media_hash': post['md5'],
+                    'media_size': str(post['fsize']),
+                    'media_link': 'http://{}/{}/image/{}{}'.format(FUUKA_HOST, self.board, post['tim'], post['ext']),
+                    'thumb_link': 'http://{}/{}/thumb/{}s.jpg'.format(FUUKA_HOST, self.board, post['tim']),
+                }
+            return fuuka
+
+        posts = self.threads[thread_id]
+        return json.dumps({str(thread_id): {
+            'op': fuuka_post(posts[0]),
+            'posts': {str(post['no']): fuuka_post(post) for post in posts[1:]},
+        }})
+
+    def fuuka_thread_html(self, thread_id):
+        return self.thread_html(thread_id).replace('//i.4cdn.org/{}/'.format(self.board),
+                                                   '//{}/{}/image/'.format(FUUKA_HOST, self.board))
+
+    def route(self, host, path, query):
+        """Return (status, content type, body) for the given request."""
+        parts = [part for part in path.split('/') if part]
+
+        def thread_id_from(value):
+            value = value.split('.')[0]
+            return int(value) if value.isdigit() and int(value) in self.threads else None
+
+        if host == FOURCHAN_API:
+            if len(parts) == 2 and parts[1] == 'threads.json':
+                return 200, 'application/json', self.threads_list_json()
+            elif len(parts) == 2 and parts[1] == 'archive.json':
+                return 200, 'application/json', json.dumps(sorted(self.threads))
+            elif len(parts) == 3 and parts[1] == 'thread' and thread_id_from(parts[2]):
+                return 200, 'application/json', self.thread_json(thread_id_from(parts[2]))
+
+        elif host in FOURCHAN_BOARDS:
+            if len(parts) >= 3 and parts[1] == 'thread' and thread_id_from(parts[2]):
+                return 200, 'text/html', self.thread_html(thread_id_from(parts[2]))
+
+        elif host == FOURCHAN_STATIC:
+            if len(parts) == 2 and parts[0] in ('css', 'js'):
+                return 200, 'text/plain', '/* {} */\n'.format(parts[1]) * 200
+
+        elif host == FOURCHAN_IMAGES or (host == FUUKA_HOST and len(parts) == 3 and parts[1] in ('image', 'thumb')):
+            tim = parts[-1].split('.')[0]
+            thumb = tim.endswith('s')
+            tim = int(tim.rstrip('s')) if tim.rstrip('s').isdigit() else None
+            if tim in self.media:
+                return 200, 'image/jpeg', self.media_body(tim, thumb)
+
+        elif host == FUUKA_HOST:
+            if parts[:4] == ['_', 'api', 'chan', 'thread']:
+                thread_id = thread_id_from(query.get('num', [''])[0])
+                if thread_id:
+                    return 200, 'application/json', self.fuuka_thread_json(thread_id)
+            elif len(parts) >= 3 and parts[1] == 'thread' and thread_id_from(parts[2]):
+                return 200, 'text/html', self.fuuka_thread_html(thread_id_from(parts[2]))
+
+        return 404, 'text/plain', 'Not Found'
+
+
+def make_handler(site):
+    class StandinHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def _respond(self, send_body=True):
+            url = urlparse(self.path)
+            host = (url.netloc or self.headers.get('Host', '')).split(':')[0]
+
+            if site.latency:
+                time.sleep(site.latency)
+
+            if site.should_fail() or site.take_failure(host, url.path):
+                status, content_type, body = 503, 'text/plain', 'Service Unavailable'
+            else:
+                status, content_type, body = site.route(host, url.path, parse_qs(url.query))
+            if not isinstance(body, bytes):
+                body = body.encode('utf-8')
+
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('Last-Modified', site.last_modified)
+            self.end_headers()
+            if send_body:
+                self._send_body(body)
+
+        def _send_body(self, body):
+            if not site.bandwidth:
+                self.wfile.write(body)
+                return
+            for start in range(0, len(body), CHUNK_SIZE):
+                chunk = body[start:start + CHUNK_SIZE]
+                self.wfile.write(chunk)
+                time.sleep(len(chunk) / float(site.bandwidth))
+
+        def do_GET(self):
+            self._respond()
+
+        def do_HEAD(self):
+            self._respond(send_body=False)
+
+        def log_message(self, *args):
+            pass
+
+    return StandinHandler
+
+
+class StandinServer(threading.Thread):
+    """Runs the stand-in server on a background thread."""
+
+    def __init__(self, site, port=0, host='127.0.0.1'):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.site = site
+        self.server = ThreadingHTTPServer((host, port), make_handler(site))
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.proxy_url = 'http://{}:{}'.format(host, self.port)
+        self.start()
+
+    def run(self):
+        self.server.serve_forever()
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+
+    site = StandinSite(board=args['--board'],
+                       threads=args['--threads'],
+                       posts=args['--posts'],
+                       file_ratio=args['--file-ratio'],
+                       media_size=args['--media-size'],
+                       thumb_size=args['--thumb-size'],
+                       latency=args['--latency'],
+                       bandwidth=args['--bandwidth'],
+                       error_rate=args['--error-rate'],
+                       seed=int(args['--seed']))
+    server = StandinServer(site, int(args['--port']))
+    print('Serving {} threads on /{}/ as a proxy at {}'.format(len(site.threads), site.board, server.proxy_url))
+    for thread_id in sorted(site.threads):
+        print('  http://boards.4chan.org/{}/thread/{}'.format(site.board, thread_id))
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
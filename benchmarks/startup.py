@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# BASC Imageboard Archiver Startup Benchmarks
+from __future__ import absolute_import
+from __future__ import print_function
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from docopt import docopt
+
+from standin import StandinSite, StandinServer
+
+__doc__ = """BASC-Archiver startup benchmarks.
+
+Times what it costs to start the archiver from this tree, for when it's
+run over and over from cron or a job runner: importing the package,
+starting an Archiver and adding a thread to it, and a whole
+thread-archiver --runonce of one small thread from the stand-in server.
+
+Usage:
+  startup.py [options]
+  startup.py -h | --help
+
+Options:
+  --runs=<int>                   Runs of each benchmark, the best one is reported [default: 5]
+  --posts=<int>                  Posts in the thread [default: 20]
+  -h --help                      Show help
+"""
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULT_LINE = '{name:<36} {seconds:>8.3f}s {import_ms:>8.1f} ms importing {threads:>4} threads   loaded: {loaded}'
+
+# imported by the site archivers, only the sites being used should load theirs
+SITE_LIBRARIES = ('basc_py4chan', 'pyfuuka', 'bs4', 'lxml')
+
+# run in a fresh interpreter, prints its timings as JSON
+IMPORT_CODE = """
+import json, sys, threading, time
+started = time.time()
+import basc_archiver
+imported = time.time()
+print(json.dumps({'import_ms': (imported - started) * 1000, 'threads': threading.active_count(),
+                  'loaded': [name for name in %r if name in sys.modules]}))
+""" % (SITE_LIBRARIES,)
+
+ARCHIVER_CODE = """
+import json, sys, threading, time
+started = time.time()
+import basc_archiver
+imported = time.time()
+archiver = basc_archiver.Archiver(basc_archiver.Options(sys.argv[1], run_once=True, silent=True))
+archiver.add_thread(sys.argv[2])
+threads = threading.active_count()
+archiver.shutdown()
+print(json.dumps({'import_ms': (imported - started) * 1000, 'threads': threads,
+                  'loaded': [name for name in %r if name in sys.modules]}))
+""" % (SITE_LIBRARIES,)
+
+
+def run_python(name, command, env):
+    """Run a command to completion, returning how long it took and the timings it printed."""
+    work_dir = tempfile.mkdtemp(prefix='basc-bench-')
+    try:
+        started = time.time()
+        process = subprocess.run([arg.replace('{work_dir}', work_dir) for arg in command], cwd=work_dir, env=env,
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        seconds = time.time() - started
+    finally:
+        shutil.rmtree(work_dir)
+    if process.returncode != 0:
+        print('{} exited with status {}:\n{}'.format(name, process.returncode,
+                                                     process.stderr.decode('utf-8', 'replace')))
+
+    result = {'name': name, 'seconds': seconds, 'import_ms': 0, 'threads': 0, 'loaded': []}
+    lines = process.stdout.decode('utf-8', 'replace').strip().splitlines()
+    if lines and lines[-1].startswith('{'):
+        result.update(json.loads(lines[-1]))
+    result['loaded'] = ', '.join(result['loaded']) or '-'
+    return result
+
+
+def best_of(runs, benchmark):
+    """Run a benchmark a few times, returning the fastest result."""
+    return min((benchmark() for i in range(runs)), key=lambda result: result['seconds'])
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+
+    site = StandinSite(threads=1, posts=args['--posts'], file_ratio=0.2, media_size=2000, thumb_size=200, latency=0)
+    server = StandinServer(site)
+
+    env = dict(os.environ)
+    env['HTTP_PROXY'] = env['http_proxy'] = server.proxy_url
+    env.pop('NO_PROXY', None)
+    env.pop('no_proxy', None)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [REPO_DIR, env.get('PYTHONPATH')]))
+
+    url = 'http://boards.4chan.org/{}/thread/{}'.format(site.board, min(site.threads))
+    benchmarks = [
+        ('python (no archiver)', [sys.executable, '-c', 'pass']),
+        ('import basc_archiver', [sys.executable, '-c', IMPORT_CODE]),
+        ('Archiver + add_thread (4chan)', [sys.executable, '-c', ARCHIVER_CODE, '{work_dir}', url]),
+        ('thread-archiver --help', [sys.executable, os.path.join(REPO_DIR, 'thread-archiver'), '--help']),
+        ('thread-archiver --runonce, 1 thread', [sys.executable, os.path.join(REPO_DIR, 'thread-archiver'),
+                                                 '--runonce', '--silent', '--path', '{work_dir}', url]),
+    ]
+
+    runs = int(args['--runs'])
+    for name, command in benchmarks:
+        print(RESULT_LINE.format(**best_of(runs, lambda: run_python(name, command, env))))
+
+    server.shutdown()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# BASC Imageboard Archiver URL Extractor Benchmarks
+from __future__ import absolute_import
+from __future__ import print_function
+import os
+import re
+import sys
+import time
+
+from docopt import docopt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from basc_archiver.utils import find_urls
+
+__doc__ = """BASC-Archiver URL extractor benchmarks.
+
+Times utils.find_urls, which finds the external links in post comments,
+against the nested-quantifier regex it replaced, on ordinary comment text
+and on long runs of word characters. The old regex takes time quadratic in
+the length of a word, the new one should stay linear.
+
+Usage:
+  urls.py [options]
+  urls.py -h | --help
+
+Options:
+  --runs=<int>                   Runs of each benchmark, the best one is reported [default: 5]
+  --lengths=<list>               Word lengths to compare [default: 1000,2000,4000,8000]
+  --no-old                       Skip the old regex
+  -h --help                      Show help
+"""
+
+# the regex used before find_urls, kept here to compare against, escaped as some of its characters are invisible
+OLD_URL_REGEX = re.compile(r"""((?:[a-z][\w-]+:(?:/{1,3}|[a-z0-9%])|www\d{0,3}[.]|[a-z0-9.\-]+[.\u200c\u200b][a-z]{2,4}/)(?:[^\s()<>]+|(([^\s()<>]+|(([^\s()<>]+)))*))+(?:(([^\s()<>]+|(\u200c\u200b([^\s()<>]+)))*)|[^\s`!()[]{};:'".,<>?\u00ab\u00bb\u201c\u201d\u2018\u2019]))""", re.DOTALL)
+
+COMMENT = ('check out https://example.com/foo?bar=1 and www.test.org/page. &gt;&gt;12345<br>'
+           'also (see http://example.net/a_(b)), lol ')
+RESULT_LINE = '{name:<28} {chars:>7} chars {new_ms:>9.3f} ms new {old_ms:>10} old {urls:>4} urls'
+
+
+def best_time(runs, extract, text):
+    """Return the fastest time, in ms, that extract(text) took."""
+    times = []
+    for i in range(runs):
+        started = time.perf_counter()
+        extract(text)
+        times.append(time.perf_counter() - started)
+    return min(times) * 1000
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    runs = int(args['--runs'])
+
+    cases = [('comment text', COMMENT * 20)]
+    for length in args['--lengths'].split(','):
+        cases.append(('word', 'a' * int(length)))
+        cases.append(('dotted word', 'a.' * (int(length) // 2)))
+
+    for name, text in cases:
+        old_ms = '-'
+        if not args['--no-old']:
+            old_ms = '{:.3f} ms'.format(best_time(runs, OLD_URL_REGEX.findall, text))
+        print(RESULT_LINE.format(name=name, chars=len(text), new_ms=best_time(runs, find_urls, text),
+                                 old_ms=old_ms, urls=len(find_urls(text))))
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 4chan Archiver Tests
+from __future__ import absolute_import
+from __future__ import print_function
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.dirname(TESTS_DIR), os.path.join(os.path.dirname(TESTS_DIR), 'benchmarks')]
+
+from basc_archiver import Options, Archiver
+from standin import StandinSite, StandinServer
+
+
+def wait_for(condition, timeout=30):
+    """Wait until condition() is true, returning whether it ever was."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return condition()
+
+
+class StandinTestCase(unittest.TestCase):
+    """Runs an archiver against the benchmark stand-in server."""
+
+    def setUp(self):
+        self.site = StandinSite(threads=2, posts=10, file_ratio=0.3, media_size=500, thumb_size=50)
+        self.server = StandinServer(self.site)
+        self.environ = dict(os.environ)
+        os.environ['HTTP_PROXY'] = os.environ['http_proxy'] = self.server.proxy_url
+        os.environ.pop('NO_PROXY', None)
+        os.environ.pop('no_proxy', None)
+        self.path = tempfile.mkdtemp(prefix='basc-test-')
+        self.archiver = None
+
+    def tearDown(self):
+        if self.archiver is not None:
+            self.archiver.shutdown()
+        self.server.shutdown()
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.path)
+
+    def start(self, **options):
+        self.archiver = Archiver(Options(self.path, silent=True, dl_thread_wait=0, **options))
+        return self.archiver
+
+    def thread_url(self, thread_id):
+        return 'http://boards.4chan.org/{}/thread/{}'.format(self.site.board, thread_id)
+
+
+class WatcherTest(StandinTestCase):
+    def test_404_while_parked(self):
+        """A watched thread that drops off threads.json and 404s is marked dead, and the watcher stops."""
+        archiver = self.start(thread_check_delay=0.2)
+        thread_id = min(self.site.threads)
+        archiver.add_thread(self.thread_url(thread_id))
+        fourchan = archiver.archivers[0]
+
+        # polled once, then parked waiting on the board watcher
+        self.assertTrue(wait_for(lambda: thread_id in fourchan.parked_threads.get(self.site.board, {})))
+
+        # gone from threads.json, and its JSON 404s
+        del self.site.threads[thread_id]
+
+        record = fourchan.threads.get(thread_id)
+        self.assertTrue(wait_for(lambda: record.ended is not None))
+        self.assertEqual(record.ended, '404')
+        self.assertFalse(record.alive)
+        self.assertTrue(wait_for(lambda: self.site.board not in fourchan.watched_boards))
+
+
+class PageTest(StandinTestCase):
+    def test_page_failure_keeps_media(self):
+        """A failed page download is retried on its own, and the thread's media still gets queued."""
+        thread_id = min(self.site.threads)
+        self.site.failures[('boards.4chan.org', '/{}/thread/{}'.format(self.site.board, thread_id))] = 1
+        archiver = self.start(run_once=True)
+        archiver.add_thread(self.thread_url(thread_id))
+        self.assertTrue(wait_for(lambda: not archiver.files_to_download))
+
+        thread_dir = os.path.join(self.path, '4chan', self.site.board, str(thread_id))
+        files = [post for post in self.site.threads[thread_id] if 'tim' in post]
+        self.assertEqual(len(os.listdir(os.path.join(thread_dir, 'images'))), len(files))
+        self.assertEqual(len(os.listdir(os.path.join(thread_dir, 'thumbs'))), len(files))
+        self.assertTrue(os.path.exists(os.path.join(thread_dir, '{}.html'.format(thread_id))))
+
+
+if __name__ == '__main__':
+    unittest.main()